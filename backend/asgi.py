@@ -0,0 +1,437 @@
+import asyncio, io, json, re, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+from backend.models import get_load_job
+import backend.events as events
+
+# ASGI serving mode (server.py --asgi, needs uvicorn). Under waitress every open stream pins one of a fixed number of
+# threads. Here the Flask app still handles every request on a small pool of request threads, but streaming endpoints
+# only queue their work and return: generations and autotuning are tasks on their model replica's worker thread
+# (backend/replicas.py) and model loads are followed from the loading thread. The endpoint hands its DecoupledStream
+# over through the environ ("exui.decoupled") and the event loop sends packets as they arrive, so a waiting or open
+# stream costs a queue entry and a coroutine, not a thread. Model load progress is pushed from the loading thread
+# too. Any other streamed body is iterated on a separate pool that queues excess jobs, each chunk reaching its client
+# through an asyncio queue. Packets are passed through unchanged, so clients still see the same JSON-lines (or SSE)
+# framing.
+#
+# /ws is a WebSocket channel multiplexing API calls and server pushes, one per browser tab (see static/socket.js).
+# Client messages:
+#
+#   { "id": n, "method": "POST", "path": "/api/...", "body": "..." }     call an endpoint
+#   { "id": n, "cancel": true }                                           stop a streamed response
+#
+# Server messages:
+#
+#   { "id": n, "status": 200 }       response started
+#   { "id": n, "chunk": "..." }      body, streamed responses send one chunk per packet
+#   { "id": n, "end": true }         response complete
+#   { "push": topic, "data": ... }   event from backend/events.py
+#   { "error": "..." }               malformed client message without a usable id, ignored otherwise
+#
+# A malformed call with an id gets status 400 and an end message.
+
+request_threads = 8
+stream_threads = 16
+stream_credits = 2  # Chunks a stream can have in flight before the next one is read from its body
+
+
+def wsgi_environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = \
+    {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[name] = value
+            continue
+        key = "HTTP_" + name
+        environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+
+async def read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect": return None
+        body += message.get("body", b"")
+        if not message.get("more_body", False): return bytes(body)
+
+
+async def wait_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect": return
+
+
+def close_body(body_iter):
+    if hasattr(body_iter, "close"): body_iter.close()
+
+
+def encode_headers(headers):
+    return [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+
+
+class ASGIApp:
+
+    wsgi_app: object
+    routes: list
+
+    def __init__(self, wsgi_app, native_load_progress = True):
+        self.wsgi_app = wsgi_app
+        self.request_executor = ThreadPoolExecutor(max_workers = request_threads, thread_name_prefix = "asgi_request")
+        self.stream_executor = ThreadPoolExecutor(max_workers = stream_threads, thread_name_prefix = "asgi_stream")
+        self.routes = []
+        if native_load_progress:
+            self.routes.append((re.compile(r"/api/load_progress/(?P<job_id>[^/]+)"), self.load_progress))
+
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+            return
+        if scope["type"] == "websocket":
+            await self.websocket(scope, receive, send)
+            return
+        if scope["type"] != "http": return
+
+        for pattern, handler in self.routes:
+            m = pattern.fullmatch(scope["path"])
+            if m:
+                await handler(scope, receive, send, **m.groupdict())
+                return
+        await self.call_wsgi(scope, receive, send)
+
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({ "type": "lifespan.startup.complete" })
+            elif message["type"] == "lifespan.shutdown":
+                self.request_executor.shutdown(wait = False)
+                self.stream_executor.shutdown(wait = False)
+                await send({ "type": "lifespan.shutdown.complete" })
+                return
+
+
+    def start_wsgi(self, environ):
+        response = {}
+        def start_response(status, headers, exc_info = None):
+            response["status"] = int(status.split(" ", 1)[0])
+            response["headers"] = headers
+            return lambda data: None
+        body = self.wsgi_app(environ, start_response)
+        return response, body
+
+
+    @staticmethod
+    def environ(scope, body):
+        environ = wsgi_environ(scope, body)
+        environ["exui.decoupled"] = []
+        return environ
+
+
+    @staticmethod
+    def collect(body):
+        try:
+            return b"".join(body)
+        finally:
+            if hasattr(body, "close"): body.close()
+
+
+    async def call_wsgi(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+
+        body = await read_body(receive)
+        if body is None: return
+        environ = self.environ(scope, body)
+        response, body_iter = await loop.run_in_executor(self.request_executor, self.start_wsgi, environ)
+
+        # Flask sets Content-Length on everything but streamed responses
+
+        await send({ "type": "http.response.start", "status": response["status"], "headers": encode_headers(response["headers"]) })
+        if any(k.lower() == "content-length" for k, v in response["headers"]):
+            data = await loop.run_in_executor(self.request_executor, self.collect, body_iter)
+            await send({ "type": "http.response.body", "body": data })
+        elif environ["exui.decoupled"]:
+            stop = threading.Event()
+            disconnect = asyncio.ensure_future(wait_disconnect(receive))
+            disconnect.add_done_callback(lambda f: stop.set())
+            try:
+                async def send_chunk(text):
+                    await send({ "type": "http.response.body", "body": text.encode("utf-8"), "more_body": True })
+                await self.drain_decoupled(environ["exui.decoupled"][0], body_iter, stop, send_chunk)
+                await send({ "type": "http.response.body", "body": b"", "more_body": False })
+            finally:
+                disconnect.cancel()
+        else:
+            await self.stream_body(body_iter, receive, send)
+
+
+    def start_stream(self, body_iter, stop):
+        """
+        Iterate body_iter on the stream pool, returning an asyncio queue that receives its chunks and then None, and a
+        semaphore to release once each chunk is sent. Reading waits for sends, so a streamed body sees its client's
+        pace. Setting stop ends the iteration early
+        """
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        credits = threading.Semaphore(stream_credits)
+
+        def put(item):
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+            except RuntimeError:
+                stop.set()
+
+        def produce():
+            try:
+                for chunk in body_iter:
+                    if stop.is_set(): break
+                    if not chunk: continue
+                    put(chunk)
+                    while not credits.acquire(timeout = 0.25):
+                        if stop.is_set(): break
+            except Exception as e:
+                print(f" !! Streaming response failed: {type(e).__name__}: {e}")
+            finally:
+                # Closes the generator, e.g. ending a load whose client went away
+                close_body(body_iter)
+                put(None)
+
+        self.stream_executor.submit(produce)
+        return queue, credits
+
+
+    async def drain_decoupled(self, stream, body_iter, stop, send_chunk):
+        """
+        Pass a stream's packets to send_chunk as they are queued. Setting stop ends it early, and closing the body then
+        cancels the generation
+        """
+
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+
+        def wake():
+            try:
+                loop.call_soon_threadsafe(ready.set)
+            except RuntimeError:
+                stop.set()
+
+        stream.set_waker(wake)
+        try:
+            while not stop.is_set():
+                text, finished = stream.take()
+                if finished: break
+                if text:
+                    t = time.time()
+                    await send_chunk(text)
+                    stream.observe_read(time.time() - t)
+                    continue
+                try:
+                    # Wakes on new packets, polls for stop
+                    await asyncio.wait_for(ready.wait(), timeout = 0.25)
+                except asyncio.TimeoutError:
+                    pass
+                ready.clear()
+        finally:
+            stream.set_waker(None)
+            await loop.run_in_executor(self.request_executor, close_body, body_iter)
+
+
+    async def stream_body(self, body_iter, receive, send):
+        stop = threading.Event()
+        queue, credits = self.start_stream(body_iter, stop)
+        disconnect = asyncio.ensure_future(wait_disconnect(receive))
+        disconnect.add_done_callback(lambda f: stop.set())
+        try:
+            while True:
+                chunk = await queue.get()
+                if chunk is None: break
+                if not stop.is_set():
+                    await send({ "type": "http.response.body", "body": chunk, "more_body": True })
+                credits.release()
+            await send({ "type": "http.response.body", "body": b"", "more_body": False })
+        finally:
+            disconnect.cancel()
+
+
+    async def load_progress(self, scope, receive, send, job_id):
+        loop = asyncio.get_running_loop()
+
+        load = get_load_job(job_id)
+        if load is None:
+            await send({ "type": "http.response.start", "status": 404, "headers": [(b"content-type", b"application/json")] })
+            await send({ "type": "http.response.body", "body": b'{"result": "fail", "error": "Unknown load job."}\n' })
+            return
+
+        queue = asyncio.Queue()
+        def listener(packet):
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, packet)
+            except RuntimeError:
+                pass
+        load.subscribe(listener)
+
+        # A client that goes away ends the stream (and drops the listener) without waiting for the load to finish
+
+        disconnected = False
+        def on_disconnect(f):
+            nonlocal disconnected
+            disconnected = True
+            queue.put_nowait(None)
+        disconnect = asyncio.ensure_future(wait_disconnect(receive))
+        disconnect.add_done_callback(on_disconnect)
+
+        try:
+            headers = [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")]
+            await send({ "type": "http.response.start", "status": 200, "headers": headers })
+            while True:
+                packet = await queue.get()
+                if packet is None: break
+                data = "data: " + packet.rstrip("\n") + "\n\n"
+                await send({ "type": "http.response.body", "body": data.encode("utf-8"), "more_body": True })
+            if not disconnected:
+                await send({ "type": "http.response.body", "body": b"", "more_body": False })
+        finally:
+            load.unsubscribe(listener)
+            disconnect.cancel()
+
+
+    async def websocket(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+
+        message = await receive()
+        if message["type"] != "websocket.connect": return
+        if scope["path"] != "/ws":
+            await send({ "type": "websocket.close", "code": 1003 })
+            return
+        await send({ "type": "websocket.accept" })
+
+        send_lock = asyncio.Lock()
+        closed = False
+
+        async def send_json(obj):
+            if closed: return
+            async with send_lock:
+                try:
+                    await send({ "type": "websocket.send", "text": json.dumps(obj) })
+                except Exception:
+                    pass
+
+        def on_event(topic, data):
+            try:
+                loop.call_soon_threadsafe(lambda: asyncio.ensure_future(send_json({ "push": topic, "data": data })))
+            except RuntimeError:
+                pass
+
+        calls = {}
+        events.subscribe(on_event)
+        try:
+            while True:
+                message = await receive()
+                if message["type"] == "websocket.disconnect": break
+                if message["type"] != "websocket.receive": continue
+
+                call_id = None
+                try:
+                    call = json.loads(message.get("text") or message.get("bytes", b"").decode("utf-8"))
+                    call_id = call["id"]
+                    if not isinstance(call_id, (int, str)): raise ValueError("Bad id")
+                    if not call.get("cancel", False) and not isinstance(call.get("path"), str):
+                        raise ValueError("Missing path")
+                except Exception as e:
+                    if call_id is None or not isinstance(call_id, (int, str)):
+                        await send_json({ "error": f"Malformed message: {type(e).__name__}: {e}" })
+                    else:
+                        await send_json({ "id": call_id, "status": 400 })
+                        await send_json({ "id": call_id, "end": True })
+                    continue
+
+                if call.get("cancel", False):
+                    if call_id in calls: calls[call_id].set()
+                    continue
+
+                stop = threading.Event()
+                calls[call_id] = stop
+                task = asyncio.ensure_future(self.ws_call(scope, call, stop, send_json))
+                task.add_done_callback(lambda t, i = call_id: calls.pop(i, None))
+        finally:
+            closed = True
+            events.unsubscribe(on_event)
+            for stop in calls.values(): stop.set()
+
+
+    async def ws_call(self, scope, call, stop, send_json):
+        loop = asyncio.get_running_loop()
+        call_id = call["id"]
+
+        path, _, query = call["path"].partition("?")
+        body = (call.get("body") or "").encode("utf-8")
+        call_scope = \
+        {
+            "method": call.get("method", "GET"),
+            "path": path,
+            "query_string": query.encode("latin-1"),
+            "headers": [(b"content-type", b"application/json")] if body else [],
+            "server": scope.get("server"),
+            "client": scope.get("client"),
+            "root_path": scope.get("root_path", ""),
+        }
+
+        environ = self.environ(call_scope, body)
+        try:
+            response, body_iter = await loop.run_in_executor(self.request_executor, self.start_wsgi, environ)
+        except Exception as e:
+            print(f" !! Request failed: {call['path']}: {type(e).__name__}: {e}")
+            await send_json({ "id": call_id, "status": 500 })
+            await send_json({ "id": call_id, "end": True })
+            return
+
+        await send_json({ "id": call_id, "status": response["status"] })
+        if any(k.lower() == "content-length" for k, v in response["headers"]):
+            data = await loop.run_in_executor(self.request_executor, self.collect, body_iter)
+            await send_json({ "id": call_id, "chunk": data.decode("utf-8") })
+        elif environ["exui.decoupled"]:
+            async def send_chunk(text):
+                await send_json({ "id": call_id, "chunk": text })
+            await self.drain_decoupled(environ["exui.decoupled"][0], body_iter, stop, send_chunk)
+        else:
+            queue, credits = self.start_stream(body_iter, stop)
+            while True:
+                chunk = await queue.get()
+                if chunk is None: break
+                if not stop.is_set():
+                    await send_json({ "id": call_id, "chunk": chunk.decode("utf-8") })
+                credits.release()
+        await send_json({ "id": call_id, "end": True })
+
+
+def serve_asgi(asgi_app, host, port):
+    try:
+        import uvicorn
+    except ImportError:
+        print(' !! ASGI mode requires uvicorn: pip install "uvicorn[standard]"')
+        sys.exit(1)
+    uvicorn.run(asgi_app, host = host, port = int(port), log_level = "warning")
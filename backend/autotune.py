@@ -0,0 +1,178 @@
+import json, gc, time
+
+import backend.models as models
+
+# Autotune chunk size and cache mode for the loaded model. Each trial allocates a small cache of the given mode next to
+# the model's own, prefills a synthetic prompt in chunks of the given size and then decodes greedily, measuring prompt
+# and decode speed and peak memory. Chunk sizes above the configured one would need a reload (scratch buffers are
+# sized at load time) and are not swept.
+#
+# Speed is not the only difference between cache modes, the quantized ones lose precision. The recommended setting
+# ("best", the one applied) is the fastest trial whose cache mode is no lossier than the model's current one. The
+# fastest trial at each quality level is reported next to it, so a lossier but faster mode is a choice left to the user
+
+chunk_sizes = [128, 256, 512, 1024, 2048, 4096, 8192]
+cache_modes = ["FP16", "Q8", "Q6", "Q4"]
+
+# Cache modes from least to most lossy. FP8 has more error than Q6 (see backend/estimate.py) and isn't swept
+
+quality_order = ["FP16", "Q8", "Q6", "FP8", "Q4"]
+
+prompt_tokens = 2048
+decode_tokens = 128
+
+# Reference workload used to rank configurations
+
+ref_prompt_tokens = 2048
+ref_decode_tokens = 256
+
+
+def score(trial):
+    return ref_prompt_tokens / trial["prompt_speed"] + ref_decode_tokens / trial["decode_speed"]
+
+
+def quality(cache_mode):
+    return quality_order.index(cache_mode) if cache_mode in quality_order else 0
+
+
+def summary(trial):
+    return { "chunk_size": trial["chunk_size"], "cache_mode": trial["cache_mode"], "score": score(trial) }
+
+
+def rank_trials(valid, current_mode):
+    """
+    The fastest trial no lossier than current_mode (None if there is none), and the fastest trial per cache mode
+    """
+
+    by_mode = {}
+    for mode in cache_modes:
+        trials = [t for t in valid if t["cache_mode"] == mode]
+        if len(trials) > 0: by_mode[mode] = summary(min(trials, key = score))
+    allowed = [t for t in valid if quality(t["cache_mode"]) <= quality(current_mode)]
+    best = summary(min(allowed, key = score)) if len(allowed) > 0 else None
+    return best, by_mode
+
+
+def run_trial(model, cache_type, input_ids, chunk_size):
+    import torch
+
+    prompt_len = input_ids.shape[-1]
+    cache = cache_type(model, max_seq_len = prompt_len + decode_tokens + 16)
+
+    for d in range(torch.cuda.device_count()):
+        torch.cuda.reset_peak_memory_stats(d)
+    torch.cuda.synchronize()
+
+    t = time.time()
+    for a in range(0, prompt_len - 1, chunk_size):
+        b = min(a + chunk_size, prompt_len - 1)
+        model.forward(input_ids[:, a:b], cache, preprocess_only = True)
+    torch.cuda.synchronize()
+    prompt_time = time.time() - t
+
+    t = time.time()
+    last = input_ids[:, -1:]
+    for _ in range(decode_tokens):
+        logits = model.forward(last, cache)
+        last = torch.argmax(logits[:, -1, :], dim = -1, keepdim = True).cpu()
+    torch.cuda.synchronize()
+    decode_time = time.time() - t
+
+    peak = sum(torch.cuda.max_memory_allocated(d) for d in range(torch.cuda.device_count()))
+
+    del cache
+    gc.collect()
+    torch.cuda.empty_cache()
+
+    trial = {}
+    trial["chunk_size"] = chunk_size
+    trial["prompt_speed"] = (prompt_len - 1) / (prompt_time + 1e-8)
+    trial["decode_speed"] = decode_tokens / (decode_time + 1e-8)
+    trial["peak_memory"] = peak
+    return trial
+
+
+def autotune_model(data, stream):
+    """
+    Queue autotuning on a replica of the model, its packets going to stream (a DecoupledStream)
+    """
+
+    # Runs like a generation on the replica's worker, holding it for all trials. Generations on it wait until tuning is
+    # done rather than share the model and skew the timings
+
+    models.queue_generation(data["model_uuid"], None, stream, lambda replica: autotune_on(replica, data))
+
+
+def autotune_on(replica, data):
+    import torch
+    from exllamav2 import ExLlamaV2Cache, ExLlamaV2Cache_Q4, ExLlamaV2Cache_Q6, ExLlamaV2Cache_Q8
+
+    if replica is None or replica.backend.get_uuid() != data["model_uuid"]:
+        packet = { "result": "fail", "error": "Model must be loaded to autotune." }
+        yield json.dumps(packet) + "\n"
+        return packet
+    loaded_model = replica.backend
+    if loaded_model.model_dict.get("tensor_p", False):
+        packet = { "result": "fail", "error": "Autotuning is not supported with tensor parallelism." }
+        yield json.dumps(packet) + "\n"
+        return packet
+
+    cache_types = { "FP16": ExLlamaV2Cache, "Q8": ExLlamaV2Cache_Q8, "Q6": ExLlamaV2Cache_Q6, "Q4": ExLlamaV2Cache_Q4 }
+    model = loaded_model.model
+    config = loaded_model.config
+
+    prompt_len = min(prompt_tokens, config.max_seq_len - decode_tokens - 16)
+    input_ids = torch.randint(0, config.vocab_size, (1, prompt_len), dtype = torch.long)
+    trials = [(c, m) for m in cache_modes for c in chunk_sizes if c <= config.max_input_len]
+
+    curve = []
+    for idx, (chunk_size, cache_mode) in enumerate(trials):
+
+        packet = { "result": "progress", "trial": idx, "num_trials": len(trials), "chunk_size": chunk_size, "cache_mode": cache_mode }
+        yield json.dumps(packet) + "\n"
+
+        try:
+            trial = run_trial(model, cache_types[cache_mode], input_ids, chunk_size)
+        except Exception as e:
+            gc.collect()
+            torch.cuda.empty_cache()
+            trial = { "chunk_size": chunk_size, "error": type(e).__name__ + ": " + str(e) }
+        trial["cache_mode"] = cache_mode
+        curve.append(trial)
+
+    valid = [t for t in curve if "error" not in t]
+    if len(valid) == 0:
+        packet = { "result": "fail", "error": "All autotune trials failed.", "curve": curve }
+        yield json.dumps(packet) + "\n"
+        return packet
+
+    model_dict = models.models[data["model_uuid"]]
+    current_mode = model_dict.get("cache_mode", "FP16")
+    best, by_cache_mode = rank_trials(valid, current_mode)
+    if best is None:
+        packet = { "result": "fail", "error": f"No trial with a cache mode as precise as {current_mode} succeeded.", "curve": curve }
+        yield json.dumps(packet) + "\n"
+        return packet
+
+    fastest = summary(min(valid, key = score))
+    fastest["lossier"] = quality(fastest["cache_mode"]) > quality(current_mode)
+
+    model_dict["autotune"] = \
+    {
+        "best": best,
+        "fastest": fastest,
+        "by_cache_mode": by_cache_mode,
+        "baseline_cache_mode": current_mode,
+        "curve": curve,
+        "prompt_tokens": prompt_len,
+        "decode_tokens": decode_tokens,
+        "timestamp": time.time()
+    }
+    if data.get("apply", False):
+        model_dict["chunk_size"] = best["chunk_size"]
+        model_dict["cache_mode"] = best["cache_mode"]
+    models.save_models()
+
+    packet = { "result": "ok", "best": best, "fastest": fastest, "by_cache_mode": by_cache_mode, "curve": curve }
+    yield json.dumps(packet) + "\n"
+    return packet
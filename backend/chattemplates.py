@@ -0,0 +1,211 @@
+import hashlib, json, os, threading
+
+# Chat templates from tokenizer metadata. prepare_model reads the model's Jinja chat template (tokenizer_config.json or
+# chat_template.jinja) and renders a few probe conversations with it. The first built-in prompt format that produces the
+# same text for every probe becomes the model's default format for new sessions. If none does, the template itself is
+# used through the "Model template" format, which renders each turn with it. Compiled templates are cached by hash,
+# along with the text each closes an assistant turn with.
+#
+# Jinja comes with Flask and is imported on first use
+
+template_format_name = "Model template"
+
+max_compiled = 16
+compiled: dict = {}
+compiled_lock = threading.Lock()
+
+# Probe conversations: (system prompt or None, [(prompt, response or None), ...]), the last turn is unanswered
+
+probes = \
+[
+    (None, [("Hello there.", None)]),
+    (None, [("Hello there.", "Hi! How can I help?"), ("Tell me a joke.", None)]),
+    ("You are a helpful assistant.", [("What is the capital of France?", None)]),
+]
+
+# Placeholders for rendering single turns, see render_turn
+
+placeholder_prompt = "\ue010"
+placeholder_response = "\ue011"
+
+
+def token_text(token):
+    # Special tokens in tokenizer_config.json are either strings or AddedToken dicts
+    if isinstance(token, dict): return token.get("content")
+    return token
+
+
+def read_chat_template(model_dir):
+    """
+    The model's chat template as { "template", "bos_token", "eos_token" }, or None
+    """
+
+    config = {}
+    config_path = os.path.join(model_dir, "tokenizer_config.json")
+    if os.path.exists(config_path):
+        try:
+            with open(config_path, encoding = "utf-8") as f:
+                config = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            config = {}
+
+    template = config.get("chat_template")
+    jinja_path = os.path.join(model_dir, "chat_template.jinja")
+    if template is None and os.path.exists(jinja_path):
+        with open(jinja_path, encoding = "utf-8") as f:
+            template = f.read()
+
+    # Named templates (e.g. "default", "tool_use")
+    if isinstance(template, list):
+        named = { t.get("name"): t.get("template") for t in template if isinstance(t, dict) }
+        template = named.get("default") or next(iter(named.values()), None)
+
+    if not isinstance(template, str) or template.strip() == "": return None
+    return { "template": template, "bos_token": token_text(config.get("bos_token")) or "", "eos_token": token_text(config.get("eos_token")) or "" }
+
+
+def compile_template(source):
+    return compiled_entry(source)["template"]
+
+
+def compiled_entry(source):
+    """
+    { "template", "turn_ends" } for source, turn_ends maps (bos_token, eos_token) to the turn_end found with them
+    """
+
+    from jinja2.exceptions import TemplateError
+    from jinja2.sandbox import ImmutableSandboxedEnvironment
+
+    key = hashlib.sha256(source.encode("utf-8")).hexdigest()
+    with compiled_lock:
+        if key in compiled: return compiled[key]
+
+    def raise_exception(message):
+        raise TemplateError(message)
+
+    env = ImmutableSandboxedEnvironment(trim_blocks = True, lstrip_blocks = True)
+    env.globals["raise_exception"] = raise_exception
+    entry = { "template": env.from_string(source), "turn_ends": {} }
+
+    with compiled_lock:
+        if len(compiled) >= max_compiled: compiled.clear()
+        compiled[key] = entry
+    return entry
+
+
+def render(chat_template, system_prompt, turns):
+    """
+    Render a conversation, ending with a generation prompt if the last turn is unanswered
+    """
+
+    messages = []
+    if system_prompt is not None: messages.append({ "role": "system", "content": system_prompt })
+    for prompt, response in turns:
+        messages.append({ "role": "user", "content": prompt })
+        if response is not None: messages.append({ "role": "assistant", "content": response })
+
+    template = compile_template(chat_template["template"])
+    return template.render(messages = messages,
+                           add_generation_prompt = turns[-1][1] is None,
+                           bos_token = chat_template["bos_token"],
+                           eos_token = chat_template["eos_token"])
+
+
+def render_turn(chat_template, prompt, response, system_prompt):
+    """
+    One prompt-response pair as the template renders it within a conversation. system_prompt is None for every turn
+    but the first, which is rendered after an earlier exchange so the conversation preamble (BOS, default system
+    prompt) is left out
+    """
+
+    turns = [(prompt, response if response else None)]
+    if system_prompt is not None:
+        return render(chat_template, system_prompt if system_prompt.strip() != "" else None, turns)
+
+    earlier = [(placeholder_prompt, placeholder_response)]
+    head = render(chat_template, None, earlier)
+    text = render(chat_template, None, earlier + turns)
+    if text.startswith(head): return text[len(head):]
+    text = render(chat_template, None, turns)
+    bos = chat_template["bos_token"]
+    if bos and text.startswith(bos): text = text[len(bos):]
+    return text
+
+
+def turn_end(chat_template):
+    """
+    Text the template closes an assistant turn with, e.g. "<|im_end|>", to stop generation at. Rendered once per
+    template
+    """
+
+    try:
+        entry = compiled_entry(chat_template["template"])
+    except Exception:
+        return None
+    key = (chat_template["bos_token"], chat_template["eos_token"])
+    with compiled_lock:
+        if key in entry["turn_ends"]: return entry["turn_ends"][key]
+
+    try:
+        text = render(chat_template, None, [(placeholder_prompt, placeholder_response)])
+        end = text[text.rfind(placeholder_response) + len(placeholder_response):].strip() or None
+    except Exception:
+        end = None
+
+    with compiled_lock:
+        entry["turn_ends"][key] = end
+    return end
+
+
+def normalize(text, bos_token):
+    text = text.strip()
+    while bos_token and text.startswith(bos_token): text = text[len(bos_token):].lstrip()
+    return text
+
+
+def format_conversation(prompt_format, system_prompt, turns, bos_token):
+    # As Session.create_context_instruct would build it
+    text = ""
+    for i, (prompt, response) in enumerate(turns):
+        sp = (system_prompt or "") if i == 0 else None
+        text += prompt_format.format(prompt, response, sp, {})
+    if prompt_format.context_bos(): text = bos_token + text
+    return text
+
+
+def detect_prompt_format(chat_template, prompt_formats):
+    """
+    Name of the prompt format in prompt_formats that renders the probe conversations like chat_template, otherwise
+    template_format_name if the template renders, or None if there is no template or it doesn't render
+    """
+
+    if chat_template is None: return None
+
+    rendered = []
+    for system_prompt, turns in probes:
+        try:
+            rendered.append(normalize(render(chat_template, system_prompt, turns), chat_template["bos_token"]))
+        except Exception:
+            # Templates may reject a system role, probes they can't render aren't compared
+            rendered.append(None)
+    if rendered[0] is None or rendered[1] is None: return None
+
+    for name, cls in prompt_formats.items():
+        if name == template_format_name: continue
+        prompt_format = cls()
+        if not prompt_format.is_instruct(): continue
+        match = True
+        for (system_prompt, turns), expected in zip(probes, rendered):
+            if expected is None: continue
+            if system_prompt is not None and not prompt_format.supports_system_prompt(): continue
+            try:
+                text = format_conversation(prompt_format, system_prompt, turns, chat_template["bos_token"])
+            except Exception:
+                match = False
+                break
+            if normalize(text, chat_template["bos_token"]) != expected:
+                match = False
+                break
+        if match: return name
+
+    return template_format_name
@@ -1,4 +1,10 @@
-import sys, os, json
+import sys, os, json, threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 config_dir: str = "///"
 
@@ -14,29 +20,124 @@ def config_filename(filename: str):
     return os.path.join(config_dir, filename)
 
 
+# Config files shared with the inference worker process (state.json, models.json, model_cache.json) are written under
+# an exclusive lock on a .lock file next to them, to a temporary file that then replaces the original, so neither
+# process can see a half-written file. Writers that keep the whole file in memory merge their changes into what is on
+# disk (merge_json) rather than overwrite changes made by the other process
+
+file_locks = {}
+file_locks_lock = threading.Lock()
+held_locks = threading.local()
+missing = object()
+
+
+@contextmanager
+def locked_file(filename):
+    # Reentrant within a thread, e.g. GlobalState.update around save
+    held = held_locks.__dict__.setdefault("held", set())
+    if filename in held:
+        yield
+        return
+
+    with file_locks_lock:
+        thread_lock = file_locks.setdefault(filename, threading.Lock())
+    with thread_lock:
+        held.add(filename)
+        try:
+            if fcntl is None:
+                yield
+                return
+            with open(filename + ".lock", "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        finally:
+            held.discard(filename)
+
+
+def read_json(filename, default = None):
+    if not os.path.exists(filename): return default
+    try:
+        with open(filename, "r") as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        return default
+
+
+def write_json(filename, obj):
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as outfile:
+        outfile.write(json.dumps(obj, indent = 4))
+    os.replace(tmp_filename, filename)
+
+
+def merge_json(base, ours, theirs, depth = 0):
+    """
+    Three-way merge of JSON objects: keys changed here since base (ours) win, all others are taken from disk (theirs).
+    Values that are objects on all sides are merged the same way, down to depth levels
+    """
+
+    merged = {}
+    for k in set(base) | set(ours) | set(theirs):
+        b = base.get(k, missing)
+        o = ours.get(k, missing)
+        t = theirs.get(k, missing)
+        if o == b: v = t
+        elif t == b: v = o
+        elif depth > 0 and isinstance(o, dict) and isinstance(t, dict):
+            v = merge_json(b if isinstance(b, dict) else {}, o, t, depth - 1)
+        else: v = o
+        if v is not missing: merged[k] = v
+    return merged
+
+
 class GlobalState:
 
+    last_model_uuid: str or None
+    current_session_uuid: str or None
+    current_notepad_uuid: str or None
+
     def __init__(self):
-        pass
+        self.last_model_uuid = None
+        self.current_session_uuid = None
+        self.current_notepad_uuid = None
 
     def load(self):
 
         filename = config_filename("state.json")
-        if os.path.exists(filename):
-            with open(filename, "r") as f:
-                r = json.load(f)
-        else:
-            r = {}
+        r = read_json(filename, {})
+
+        self.last_model_uuid = r.get("last_model_uuid", None)
+        self.current_session_uuid = r.get("current_session_uuid", None)
+        self.current_notepad_uuid = r.get("current_notepad_uuid", None)
 
 
     def save(self):
 
         r = {}
+        r["last_model_uuid"] = self.last_model_uuid
+        r["current_session_uuid"] = self.current_session_uuid
+        r["current_notepad_uuid"] = self.current_notepad_uuid
+
+        filename = config_filename("state.json")
+        with locked_file(filename):
+            write_json(filename, r)
+
+
+    def update(self, **kwargs):
 
+        # state.json is shared with the inference worker process, if any, so apply changes on top of what is on disk
         filename = config_filename("state.json")
-        r_json = json.dumps(r, indent = 4)
-        with open(filename, "w") as outfile:
-            outfile.write(r_json)
+        with locked_file(filename):
+            self.load()
+            changed = False
+            for k, v in kwargs.items():
+                if getattr(self, k) != v:
+                    setattr(self, k, v)
+                    changed = True
+            if changed: self.save()
 
 
 global_state = GlobalState()
\ No newline at end of file
@@ -0,0 +1,195 @@
+import os
+
+from backend.prefetch import read_safetensors_index
+
+# VRAM footprint estimates from the model stats recorded by prepare_model. Plain arithmetic, no torch, so it can be
+# checked on CPU
+
+# Bytes per cached K/V element for each cache mode. Quantized modes store one FP16 scale per group of 32 values
+
+cache_element_bytes = \
+{
+    "FP16": 2.0,
+    "FP8": 1.0,
+    "Q8": 1.0 + 2 / 32,
+    "Q6": 0.75 + 2 / 32,
+    "Q4": 0.5 + 2 / 32,
+}
+
+# Cache modes tried by auto-fit, best quality first. FP8 is left out since Q8/Q6 are both smaller-error options
+
+auto_fit_cache_modes = ["FP16", "Q8", "Q6", "Q4"]
+
+# Reserved on the first device by the autosplit loader, and logits rows kept by ModelContainer (max_output_len)
+
+device_reserve_bytes = 96 * 1024**2
+max_output_len = 16
+seq_len_granularity = 256
+
+
+def weights_bytes(model_dir):
+    if not model_dir or not os.path.isdir(model_dir): return 0
+    total = 0
+    for f in os.listdir(model_dir):
+        if f.endswith(".safetensors"):
+            total += os.path.getsize(os.path.join(model_dir, f))
+    return total
+
+
+def weights_breakdown(model_dir):
+    """
+    Exact tensor bytes for the input embeddings (kept in system RAM by ExLlamaV2), the output head and everything else
+    """
+
+    embed = 0
+    head = 0
+    total = 0
+    for name, (filename, begin, end) in read_safetensors_index(model_dir).items():
+        size = end - begin
+        total += size
+        if "embed_tokens" in name or name.startswith("transformer.wte"): embed += size
+        elif name.startswith("lm_head"): head += size
+    return { "embed_bytes": embed, "head_bytes": head, "layers_bytes": total - embed - head }
+
+
+def cache_bytes(stats, seq_len, cache_mode):
+    per_token = 2 * stats["num_hidden_layers"] * stats["num_key_value_heads"] * stats["head_dim"]
+    return int(per_token * seq_len * cache_element_bytes[cache_mode])
+
+
+def scratch_bytes(stats, chunk_size):
+    """
+    Upper bound on temporary buffers for one forward pass of chunk_size tokens, assuming no flash-attn (attention
+    weights materialized, limited to chunk_size ** 2 per head as set by ModelContainer)
+    """
+
+    c = chunk_size
+    hidden = 2 * c * stats["hidden_size"] * 2
+    qkv = c * (stats["num_attention_heads"] + 2 * stats["num_key_value_heads"]) * stats["head_dim"] * 2
+    attn = stats["num_attention_heads"] * c * c * 2
+    mlp = 2 * c * stats["intermediate_size"] * 2
+    logits = max_output_len * stats["vocab_size"] * 4
+    return hidden + qkv + attn + mlp + logits
+
+
+def layer_weights(stats):
+    layers_bytes = stats.get("layers_bytes")
+    if layers_bytes is None:
+        layers_bytes = stats.get("weights_bytes", 0) - stats.get("embed_bytes", 0) - stats.get("head_bytes", 0)
+    return layers_bytes / stats["num_hidden_layers"]
+
+
+def component_bytes(stats, seq_len, cache_mode, chunk_size):
+    """
+    (weights, cache, scratch) bytes in VRAM for one model
+    """
+
+    weights = int(layer_weights(stats) * stats["num_hidden_layers"] + stats.get("head_bytes", 0))
+    return weights, cache_bytes(stats, seq_len, cache_mode), scratch_bytes(stats, chunk_size)
+
+
+def estimate_vram(model, seq_len = None, cache_mode = None, chunk_size = None):
+    """
+    Predicted VRAM use in bytes, by component, for a model config. Overrides for seq_len, cache_mode and chunk_size
+    default to the model's own settings
+    """
+
+    stats = model.get("stats")
+    if stats is None: return None
+
+    seq_len = seq_len or model.get("seq_len", stats["default_seq_len"])
+    cache_mode = cache_mode or model.get("cache_mode", "FP16")
+    chunk_size = chunk_size or model.get("chunk_size", 2048)
+
+    e = {}
+    e["weights"], e["cache"], e["scratch"] = component_bytes(stats, seq_len, cache_mode, chunk_size)
+    e["draft"] = 0
+
+    draft_stats = model.get("draft_stats")
+    if model.get("speculative_mode", "None") == "Draft model" and draft_stats is not None:
+        e["draft"] = sum(component_bytes(draft_stats, seq_len, "FP16", chunk_size))
+
+    e["total"] = e["weights"] + e["cache"] + e["scratch"] + e["draft"]
+    return e
+
+
+def model_footprint(model):
+    """
+    Estimated total VRAM in bytes for a model config, 0 if the model has no stats
+    """
+
+    e = estimate_vram(model)
+    return e["total"] if e else 0
+
+
+def fits(model, budgets, seq_len, cache_mode, tensor_p = False):
+    """
+    Simulate the autosplit loader: fill devices in order with layers and their share of the cache, then the output
+    head and scratch space on the device holding the last layer. budgets is free bytes per device
+    """
+
+    stats = model["stats"]
+    e = estimate_vram(model, seq_len = seq_len, cache_mode = cache_mode)
+    num_layers = stats["num_hidden_layers"]
+    layer_cost = layer_weights(stats) + e["cache"] / num_layers
+    tail_cost = stats.get("head_bytes", 0) + e["scratch"]
+
+    budgets = list(budgets)
+    if len(budgets) == 0: return False
+    if tensor_p: budgets = [sum(budgets)]
+    budgets[0] -= device_reserve_bytes + e["draft"]
+
+    device = 0
+    free = budgets[0]
+    placed = 0
+    while placed < num_layers:
+        if free >= layer_cost:
+            free -= layer_cost
+            placed += 1
+            continue
+        device += 1
+        if device >= len(budgets): return False
+        free = budgets[device]
+
+    while free < tail_cost:
+        device += 1
+        if device >= len(budgets): return False
+        free = budgets[device]
+    return True
+
+
+def max_fitting_seq_len(model, budgets, cache_mode, tensor_p = False):
+    """
+    Largest seq_len, a multiple of seq_len_granularity up to the model's native length, that fits with cache_mode
+    """
+
+    g = seq_len_granularity
+    lo = 0
+    hi = model["stats"]["default_seq_len"] // g
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if fits(model, budgets, mid * g, cache_mode, tensor_p): lo = mid
+        else: hi = mid - 1
+    return lo * g
+
+
+def auto_fit(model, budgets, tensor_p = False):
+    """
+    Pick the best cache mode that reaches the model's native context length within budgets, or failing that, the
+    mode allowing the longest context. Returns None if nothing fits
+    """
+
+    if model.get("stats") is None: return None
+    native = model["stats"]["default_seq_len"]
+
+    best = None
+    for cache_mode in auto_fit_cache_modes:
+        seq_len = max_fitting_seq_len(model, budgets, cache_mode, tensor_p)
+        if seq_len == 0: continue
+        if best is None or seq_len > best["seq_len"]:
+            best = { "seq_len": seq_len, "cache_mode": cache_mode }
+        if seq_len >= native: break
+
+    if best is not None:
+        best["estimate"] = estimate_vram(model, seq_len = best["seq_len"], cache_mode = best["cache_mode"])
+    return best
@@ -0,0 +1,33 @@
+import threading
+
+# Server-side events pushed to connected clients (over the /ws channel in ASGI mode). Topics:
+#
+#   sessions    session list changed
+#   notepads    notepad list changed
+#   models      active or resident models changed, data: { "current_model", "resident_models" }
+#   model_load  packet from a model load job, data: { "job_id", "model_uuid", "packet" }
+#
+# Listeners are called on the publishing thread and must not block
+
+listeners: list = []
+listeners_lock = threading.Lock()
+
+
+def subscribe(listener):
+    with listeners_lock:
+        listeners.append(listener)
+
+
+def unsubscribe(listener):
+    with listeners_lock:
+        if listener in listeners: listeners.remove(listener)
+
+
+def publish(topic, data = None):
+    with listeners_lock:
+        current = list(listeners)
+    for listener in current:
+        try:
+            listener(topic, data)
+        except Exception as e:
+            print(f" !! Event listener failed: {type(e).__name__}: {e}")
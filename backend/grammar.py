@@ -0,0 +1,485 @@
+import hashlib, json, re, threading, time
+from collections import OrderedDict
+
+from backend.util import tokenizer_key
+
+# Constrained generation. A session or notepad can restrict its output to a regular expression or a JSON schema
+# (grammar_mode "Regex" or "JSON schema", with the pattern or schema in "grammar"). The grammar is compiled to an NFA over
+# characters, and generation follows it as a DFA whose states, and the token mask of each state, are built the first
+# time a generation reaches them. A mask is found by walking the tokenizer's character trie, so only tokens whose whole
+# text keeps the output in the language are allowed. Compiled grammars are kept in an LRU keyed by (grammar hash,
+# tokenizer), so a schema used again costs dictionary lookups per token. See backend/grammarfilter.py for the filter.
+#
+# Regex syntax: literals, ., classes with ranges and negation, \d \w \s (and negations outside classes), escaped
+# punctuation, \n \t \r \f \v \0 \xhh \uhhhh, groups, |, *, +, ?, {m}, {m,} and {m,n}. Other escapes (\b, \1, ...)
+# are rejected. The whole output must match, ^ and $ are ignored.
+#
+# JSON schema subset: type (or a list of types), object with properties (emitted in order, all of them), array with
+# items, minItems and maxItems, string with minLength and maxLength, number, integer, boolean, null, enum, const, anyOf
+# and oneOf. Objects without properties and arrays without items hold any JSON value, nested up to max_free_depth.
+# Output is formatted like json.dumps, with ", " and ": " separators
+
+grammar_modes = ["None", "Regex", "JSON schema"]
+
+max_compiled = 8
+max_nfa_states = 200000
+max_free_depth = 2
+
+dead = -1
+
+compiled: OrderedDict = OrderedDict()
+compiled_lock = threading.Lock()
+totals = { "compiled": 0, "compile_time": 0.0, "masks": 0, "mask_time": 0.0, "tokens": 0, "filter_time": 0.0 }
+
+
+# Syntax tree: ("set", (negated, ranges)), ("seq", [nodes]), ("alt", [nodes]), ("rep", node, min, max or None)
+
+def char_set(ranges, negated = False):
+    return "set", (negated, tuple(ranges))
+
+
+def literal(text):
+    return "seq", [char_set([(ord(c), ord(c))]) for c in text]
+
+
+def alternatives(nodes):
+    return nodes[0] if len(nodes) == 1 else ("alt", nodes)
+
+
+def optional(node):
+    return "rep", node, 0, 1
+
+
+digits = ((48, 57),)
+word_chars = ((48, 57), (65, 90), (95, 95), (97, 122))
+space_chars = ((9, 13), (32, 32))
+class_escapes = { "d": digits, "w": word_chars, "s": space_chars }
+char_escapes = { "n": "\n", "t": "\t", "r": "\r", "f": "\f", "v": "\v", "0": "\0" }
+
+
+class RegexParser:
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.pos = 0
+
+
+    def error(self, message):
+        return ValueError(f"Regex: {message} at position {self.pos}")
+
+
+    def peek(self):
+        return self.pattern[self.pos] if self.pos < len(self.pattern) else None
+
+
+    def take(self):
+        if self.pos >= len(self.pattern): raise self.error("unexpected end")
+        c = self.pattern[self.pos]
+        self.pos += 1
+        return c
+
+
+    def parse(self):
+        node = self.alt()
+        if self.peek() is not None: raise self.error(f"unexpected {self.peek()!r}")
+        return node
+
+
+    def alt(self):
+        options = [self.seq()]
+        while self.peek() == "|":
+            self.pos += 1
+            options.append(self.seq())
+        return alternatives(options)
+
+
+    def seq(self):
+        items = []
+        while self.peek() is not None and self.peek() not in "|)":
+            items.append(self.repeat(self.atom()))
+        return "seq", items
+
+
+    def atom(self):
+        c = self.take()
+        if c == "(":
+            if self.pattern.startswith("?:", self.pos): self.pos += 2
+            node = self.alt()
+            if self.peek() != ")": raise self.error("missing )")
+            self.pos += 1
+            return node
+        if c == "[": return self.char_class()
+        if c == ".": return char_set([(10, 10)], negated = True)
+        if c == "\\": return self.escape(in_class = False)
+        if c in "^$": return "seq", []
+        if c in "*+?{": raise self.error("nothing to repeat")
+        return char_set([(ord(c), ord(c))])
+
+
+    def escape(self, in_class):
+        c = self.take()
+        if c.lower() in class_escapes:
+            if c.isupper():
+                if in_class: raise self.error(f"\\{c} in a character class is not supported")
+                return char_set(class_escapes[c.lower()], negated = True)
+            return char_set(class_escapes[c])
+        if c in "xu":
+            n = 2 if c == "x" else 4
+            code = self.pattern[self.pos:self.pos + n]
+            if len(code) != n or not all(h in "0123456789abcdefABCDEF" for h in code): raise self.error(f"bad \\{c} escape")
+            self.pos += n
+            o = int(code, 16)
+            return char_set([(o, o)])
+        # Anchors, backreferences and the like would silently become literals
+        if c.isalnum() and c not in char_escapes: raise self.error(f"\\{c} is not supported")
+        c = char_escapes.get(c, c)
+        return char_set([(ord(c), ord(c))])
+
+
+    def char_class(self):
+        negated = False
+        if self.peek() == "^":
+            negated = True
+            self.pos += 1
+        ranges = []
+        first = True
+        while True:
+            c = self.take()
+            if c == "]" and not first: break
+            first = False
+            if c == "\\":
+                _, (_, r) = self.escape(in_class = True)
+            else:
+                r = ((ord(c), ord(c)),)
+            if len(r) == 1 and r[0][0] == r[0][1] and self.peek() == "-" and self.pattern[self.pos + 1:self.pos + 2] not in ("]", ""):
+                self.pos += 1
+                c = self.take()
+                if c == "\\":
+                    _, (_, r2) = self.escape(in_class = True)
+                    if len(r2) != 1 or r2[0][0] != r2[0][1]: raise self.error("bad range")
+                    hi = r2[0][0]
+                else:
+                    hi = ord(c)
+                if hi < r[0][0]: raise self.error("bad range")
+                r = ((r[0][0], hi),)
+            ranges += r
+        return char_set(ranges, negated)
+
+
+    def repeat(self, node):
+        while True:
+            c = self.peek()
+            if c == "*": lo, hi, n = 0, None, 1
+            elif c == "+": lo, hi, n = 1, None, 1
+            elif c == "?": lo, hi, n = 0, 1, 1
+            elif c == "{":
+                m = re.match(r"\{(\d+)(,?)(\d*)\}", self.pattern[self.pos:])
+                if m is None: return node
+                lo = int(m.group(1))
+                hi = lo if not m.group(2) else (int(m.group(3)) if m.group(3) else None)
+                if hi is not None and hi < lo: raise self.error("bad repeat")
+                n = len(m.group(0))
+            else:
+                return node
+            self.pos += n
+            # Lazy and possessive quantifiers match the same language
+            if self.peek() in ("?", "+"): self.pos += 1
+            node = "rep", node, lo, hi
+
+
+# JSON schema
+
+def json_string(min_length = 0, max_length = None):
+    char = alternatives([
+        char_set([(0, 31), (34, 34), (92, 92)], negated = True),
+        ("seq", [literal("\\"), char_set([(ord(c), ord(c)) for c in "\"\\/bfnrt"])]),
+        ("seq", [literal("\\u"), ("rep", char_set([(48, 57), (65, 70), (97, 102)]), 4, 4)]),
+    ])
+    return "seq", [literal("\""), ("rep", char, min_length, max_length), literal("\"")]
+
+
+def json_integer():
+    return "seq", [optional(literal("-")), alternatives([literal("0"), ("seq", [char_set([(49, 57)]), ("rep", char_set(digits), 0, None)])])]
+
+
+def json_number():
+    fraction = "seq", [literal("."), ("rep", char_set(digits), 1, None)]
+    exponent = "seq", [char_set([(69, 69), (101, 101)]), optional(char_set([(43, 43), (45, 45)])), ("rep", char_set(digits), 1, None)]
+    return "seq", [json_integer(), optional(fraction), optional(exponent)]
+
+
+def json_list(item, min_items = 0, max_items = None):
+    if max_items is not None and max_items <= 0: return literal("")
+    more = "rep", ("seq", [literal(", "), item]), max(min_items - 1, 0), None if max_items is None else max(max_items - 1, 0)
+    items = "seq", [item, more]
+    if min_items == 0: items = optional(items)
+    return items
+
+
+def json_free(depth):
+    """
+    Any JSON value, with containers nested at most depth deep
+    """
+
+    values = [json_string(), json_number(), literal("true"), literal("false"), literal("null")]
+    if depth > 0:
+        inner = json_free(depth - 1)
+        values.append(("seq", [literal("["), json_list(inner), literal("]")]))
+        values.append(("seq", [literal("{"), json_list(("seq", [json_string(), literal(": "), inner])), literal("}")]))
+    return alternatives(values)
+
+
+def json_schema(schema):
+    if not isinstance(schema, dict): raise ValueError("JSON schema: schema must be an object")
+    if "$ref" in schema: raise ValueError("JSON schema: $ref is not supported")
+
+    if "const" in schema: return literal(json.dumps(schema["const"]))
+    if "enum" in schema: return alternatives([literal(json.dumps(v)) for v in schema["enum"]])
+    for key in ("anyOf", "oneOf"):
+        if key in schema: return alternatives([json_schema(s) for s in schema[key]])
+
+    t = schema.get("type")
+    if t is None: return json_free(max_free_depth)
+    if isinstance(t, list): return alternatives([json_schema(dict(schema, type = tt)) for tt in t])
+
+    if t == "string": return json_string(schema.get("minLength", 0), schema.get("maxLength"))
+    if t == "integer": return json_integer()
+    if t == "number": return json_number()
+    if t == "boolean": return alternatives([literal("true"), literal("false")])
+    if t == "null": return literal("null")
+    if t == "array":
+        item = json_schema(schema["items"]) if "items" in schema else json_free(max_free_depth - 1)
+        return "seq", [literal("["), json_list(item, schema.get("minItems", 0), schema.get("maxItems")), literal("]")]
+    if t == "object":
+        properties = schema.get("properties")
+        if not properties:
+            member = "seq", [json_string(), literal(": "), json_free(max_free_depth - 1)]
+            return "seq", [literal("{"), json_list(member), literal("}")]
+        items = [literal("{")]
+        for i, (name, s) in enumerate(properties.items()):
+            items.append(literal((", " if i > 0 else "") + json.dumps(name) + ": "))
+            items.append(json_schema(s))
+        items.append(literal("}"))
+        return "seq", items
+    raise ValueError(f"JSON schema: unsupported type {t!r}")
+
+
+# Automaton
+
+class NFA:
+
+    edges: list
+    eps: list
+
+    def __init__(self):
+        self.edges = []
+        self.eps = []
+
+
+    def state(self):
+        if len(self.edges) >= max_nfa_states: raise ValueError("Grammar is too large")
+        self.edges.append([])
+        self.eps.append([])
+        return len(self.edges) - 1
+
+
+    def build(self, node, start):
+        """
+        Add node following state start, returns the state at its end
+        """
+
+        kind = node[0]
+        if kind == "set":
+            end = self.state()
+            self.edges[start].append((node[1], end))
+            return end
+        if kind == "seq":
+            for n in node[1]: start = self.build(n, start)
+            return start
+        if kind == "alt":
+            end = self.state()
+            for n in node[1]:
+                s = self.state()
+                self.eps[start].append(s)
+                self.eps[self.build(n, s)].append(end)
+            return end
+        if kind == "rep":
+            _, n, lo, hi = node
+            for _ in range(lo): start = self.build(n, start)
+            if hi is None:
+                loop = self.state()
+                self.eps[start].append(loop)
+                self.eps[self.build(n, loop)].append(loop)
+                return loop
+            end = self.state()
+            self.eps[start].append(end)
+            for _ in range(hi - lo):
+                start = self.build(n, start)
+                self.eps[start].append(end)
+            return end
+        raise ValueError(f"Bad grammar node: {kind}")
+
+
+def matches(charset, o):
+    negated, ranges = charset
+    for lo, hi in ranges:
+        if lo <= o <= hi: return not negated
+    return negated
+
+
+class Grammar:
+
+    states: list
+    steps: dict
+    masks: dict
+    finals: dict
+    compile_time: float
+
+    def __init__(self, tree):
+        t = time.time()
+        self.nfa = NFA()
+        start = self.nfa.state()
+        self.accept = self.nfa.build(tree, start)
+        self.states = []
+        self.ids = {}
+        self.steps = {}
+        self.masks = {}
+        self.finals = {}
+        self.lock = threading.Lock()
+        self.start = self.intern(self.closure({ start }))
+        self.compile_time = time.time() - t
+
+
+    def closure(self, states):
+        stack = list(states)
+        closed = set(states)
+        while len(stack) > 0:
+            for t in self.nfa.eps[stack.pop()]:
+                if t not in closed:
+                    closed.add(t)
+                    stack.append(t)
+        return frozenset(closed)
+
+
+    def intern(self, states):
+        i = self.ids.get(states)
+        if i is None:
+            i = len(self.states)
+            self.states.append(states)
+            self.ids[states] = i
+        return i
+
+
+    def step(self, state, c):
+        key = (state, c)
+        r = self.steps.get(key)
+        if r is None:
+            o = ord(c)
+            targets = set()
+            for s in self.states[state]:
+                for charset, t in self.nfa.edges[s]:
+                    if matches(charset, o): targets.add(t)
+            r = self.intern(self.closure(targets)) if len(targets) > 0 else dead
+            self.steps[key] = r
+        return r
+
+
+    def advance(self, state, text):
+        with self.lock:
+            for c in text:
+                if state == dead: break
+                state = self.step(state, c)
+        return state
+
+
+    def accepting(self, state):
+        return state != dead and self.accept in self.states[state]
+
+
+    def final(self, state):
+        # Accepting with nothing that could follow
+        r = self.finals.get(state)
+        if r is None:
+            r = self.accepting(state) and all(len(self.nfa.edges[s]) == 0 for s in self.states[state])
+            self.finals[state] = r
+        return r
+
+
+    def mask(self, state, char_trie):
+        """
+        (pass_tokens, end_tokens) in state, the tokens whose text keeps the output in the language and those that
+        complete it. Returns the mask and the time spent building it, 0 if it was cached
+        """
+
+        m = self.masks.get(state)
+        if m is not None: return m, 0.0
+
+        with self.lock:
+            t = time.time()
+            pass_tokens = set()
+            end_tokens = set()
+            stack = [(char_trie, state)]
+            while len(stack) > 0:
+                node, s = stack.pop()
+                for c, child in node.children.items():
+                    n = self.step(s, c)
+                    if n == dead: continue
+                    if len(child.leaf) > 0:
+                        pass_tokens.update(child.leaf)
+                        if self.final(n): end_tokens.update(child.leaf)
+                    stack.append((child, n))
+            m = (frozenset(pass_tokens), frozenset(end_tokens))
+            self.masks[state] = m
+            elapsed = time.time() - t
+
+        with compiled_lock:
+            totals["masks"] += 1
+            totals["mask_time"] += elapsed
+        return m, elapsed
+
+
+def parse_grammar(grammar_mode, source):
+    if grammar_mode == "Regex": return RegexParser(source).parse()
+    if grammar_mode == "JSON schema":
+        try:
+            schema = json.loads(source)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"JSON schema: {e}")
+        return json_schema(schema)
+    raise ValueError(f"Unknown grammar mode: {grammar_mode}")
+
+
+def get_grammar(grammar_mode, source, tokenizer):
+    """
+    The compiled grammar for source in tokenizer's vocabulary, and whether it was cached
+    """
+
+    key = (hashlib.sha256((grammar_mode + "\0" + source).encode("utf-8")).hexdigest(), tokenizer_key(tokenizer))
+    with compiled_lock:
+        if key in compiled:
+            compiled.move_to_end(key)
+            return compiled[key], True
+
+    grammar = Grammar(parse_grammar(grammar_mode, source))
+    with compiled_lock:
+        compiled[key] = grammar
+        while len(compiled) > max_compiled: compiled.popitem(last = False)
+        totals["compiled"] += 1
+        totals["compile_time"] += grammar.compile_time
+    return grammar, False
+
+
+def record(tokens, filter_time):
+    with compiled_lock:
+        totals["tokens"] += tokens
+        totals["filter_time"] += filter_time
+
+
+def grammar_stats():
+    with compiled_lock:
+        s = dict(totals)
+        s["cached"] = len(compiled)
+        s["dfa_states"] = sum(len(g.states) for g in compiled.values())
+        s["cached_masks"] = sum(len(g.masks) for g in compiled.values())
+        s["filter_time_per_token"] = totals["filter_time"] / totals["tokens"] if totals["tokens"] else 0.0
+        return s
@@ -0,0 +1,122 @@
+import time
+
+from exllamav2.generator.filters import ExLlamaV2Filter
+
+import backend.grammar as grammar
+
+# Imported where it is used, like exllamav2 itself, see backend/runtime.py
+
+
+class GrammarFilter(ExLlamaV2Filter):
+    """
+    Constrains generation to a compiled grammar (see backend/grammar.py). stop_tokens are allowed wherever the output
+    is complete, and end the stream
+    """
+
+    state: int
+    started: bool
+    complete_masks: dict
+    compile_time: float
+    filter_time: float
+    tokens: int
+
+    def __init__(self, model, tokenizer, compiled, stop_tokens):
+        super().__init__(model, tokenizer)
+        self.compiled = compiled
+        self.stop_tokens = frozenset(stop_tokens)
+        self.char_trie = tokenizer.get_char_trie()
+        self.pieces = tokenizer.get_id_to_piece_list()
+        self.state = compiled.start
+        self.started = False
+        self.complete_masks = {}
+        self.compile_time = 0.0
+        self.filter_time = 0.0
+        self.tokens = 0
+
+
+    def clone(self, c = None):
+        if c is None: c = GrammarFilter.__new__(GrammarFilter)
+        super().clone(c)
+        c.compiled = self.compiled
+        c.stop_tokens = self.stop_tokens
+        c.char_trie = self.char_trie
+        c.pieces = self.pieces
+        c.state = self.state
+        c.started = self.started
+        c.complete_masks = self.complete_masks
+        c.compile_time = self.compile_time
+        c.filter_time = self.filter_time
+        c.tokens = self.tokens
+        return c
+
+
+    def begin(self, prefix_str = ""):
+        # Generators begin their filters again when they restart the stream on a truncated context, the output
+        # continues from where it was. Token healing is not used with a grammar, prefix_str is always empty
+        if self.started: return
+        self.state = self.compiled.start
+        self.started = True
+
+
+    def feed(self, token):
+        # The generator passes the sampled token as a 1x1 tensor
+        if not isinstance(token, int): token = token.item()
+        t = time.time()
+        if token not in self.stop_tokens:
+            piece = self.pieces[token] if token < len(self.pieces) else ""
+            self.state = self.compiled.advance(self.state, piece)
+        self.tokens += 1
+        self.filter_time += time.time() - t
+
+
+    def next(self):
+        t = time.time()
+        if self.state == grammar.dead:
+            pass_tokens, end_tokens = self.stop_tokens, self.stop_tokens
+        else:
+            (pass_tokens, end_tokens), elapsed = self.compiled.mask(self.state, self.char_trie)
+            self.compile_time += elapsed
+            if self.compiled.accepting(self.state):
+                m = self.complete_masks.get(self.state)
+                if m is None:
+                    m = (pass_tokens | self.stop_tokens, end_tokens | self.stop_tokens)
+                    self.complete_masks[self.state] = m
+                pass_tokens, end_tokens = m
+            elif len(pass_tokens) == 0:
+                pass_tokens, end_tokens = self.stop_tokens, self.stop_tokens
+        self.filter_time += time.time() - t
+        return pass_tokens, end_tokens
+
+
+def grammar_meta(filters, cached):
+    """
+    Timings of a generation's grammar filters for block meta. filter_time includes building the masks not cached yet,
+    counted in compile_time
+    """
+
+    compile_time = sum(f.compile_time for f in filters)
+    filter_time = sum(f.filter_time for f in filters)
+    tokens = sum(f.tokens for f in filters)
+    grammar.record(tokens, filter_time - compile_time)
+
+    m = {}
+    m["grammar_cached"] = cached
+    m["grammar_compile_time"] = compile_time + (0.0 if cached else filters[0].compiled.compile_time)
+    m["grammar_filter_time"] = filter_time
+    m["grammar_time_per_token"] = (filter_time - compile_time) / tokens if tokens else 0.0
+    return m
+
+
+def grammar_filters(model, tokenizer, settings, stop_tokens, num = 1):
+    """
+    (filters, cached), num filters for the grammar in settings (one per sequence generated), or ([], False) if there is
+    none. Raises ValueError if the grammar doesn't compile
+    """
+
+    mode = settings.get("grammar_mode", "None")
+    source = settings.get("grammar", "").strip()
+    if mode == "None" or source == "": return [], False
+    compiled, cached = grammar.get_grammar(mode, source, tokenizer)
+    stop_tokens = set(stop_tokens)
+    if tokenizer.eos_token_id is not None: stop_tokens.add(tokenizer.eos_token_id)
+    return [GrammarFilter(model, tokenizer, compiled, stop_tokens) for _ in range(num)], cached
@@ -0,0 +1,152 @@
+import threading, time, uuid
+from collections import OrderedDict, deque
+
+# Generation jobs. Every chat or notepad generation gets a job with its own cancel token (passed to ExLlamaV2 as the
+# abort event), so canceling one request can't affect another and a cancel is never cleared by a later request.
+# Jobs are queued until they hold their model replica, canceling a queued job makes it end without generating.
+# Cancel latency, from the cancel request to the last packet the job emitted, is recorded per job kind
+
+max_jobs = 64
+max_latencies = 256
+
+
+class CancelToken(threading.Event):
+
+    requested_at: float or None
+
+    def __init__(self):
+        super().__init__()
+        self.requested_at = None
+
+
+    def cancel(self):
+        if self.requested_at is None: self.requested_at = time.time()
+        self.set()
+
+
+class GenerationJob:
+
+    job_id: str
+    kind: str
+    owner: str
+    state: str
+    token: CancelToken
+    created_at: float
+    started_at: float or None
+    finished_at: float or None
+    last_packet_at: float or None
+
+    def __init__(self, kind, owner):
+        self.job_id = str(uuid.uuid4())
+        self.kind = kind
+        self.owner = owner
+        self.state = "queued"
+        self.token = CancelToken()
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.last_packet_at = None
+
+
+    def start(self):
+        self.state = "running"
+        self.started_at = time.time()
+
+
+    def cancel_latency(self):
+        if self.token.requested_at is None: return None
+        last = self.last_packet_at or self.token.requested_at
+        return max(0.0, last - self.token.requested_at)
+
+
+    def status(self):
+        s = {}
+        s["job_id"] = self.job_id
+        s["kind"] = self.kind
+        s["owner"] = self.owner
+        s["state"] = self.state
+        s["canceled"] = self.token.is_set()
+        s["created_at"] = self.created_at
+        s["started_at"] = self.started_at
+        s["finished_at"] = self.finished_at
+        s["cancel_latency"] = self.cancel_latency() if self.state == "done" else None
+        return s
+
+
+jobs: OrderedDict = OrderedDict()
+jobs_lock = threading.Lock()
+cancel_latencies: dict = {}
+
+
+def create_job(kind, owner):
+    job = GenerationJob(kind, owner)
+    with jobs_lock:
+        jobs[job.job_id] = job
+        while len(jobs) > max_jobs:
+            oldest = next(iter(jobs.values()))
+            if oldest.state != "done": break
+            jobs.popitem(last = False)
+    return job
+
+
+def finish_job(job):
+    with jobs_lock:
+        job.state = "done"
+        job.finished_at = time.time()
+        latency = job.cancel_latency()
+        if latency is not None:
+            cancel_latencies.setdefault(job.kind, deque(maxlen = max_latencies)).append(latency)
+
+
+def tracked(job, gen):
+    """
+    Pass through the packets of gen, recording when the last one was emitted, and return its return value
+    """
+
+    while True:
+        try:
+            packet = next(gen)
+        except StopIteration as e:
+            return e.value
+        job.last_packet_at = time.time()
+        yield packet
+
+
+def get_job(job_id):
+    with jobs_lock:
+        return jobs.get(job_id)
+
+
+def cancel_jobs(kind, job_id = None):
+    """
+    Cancel job_id, or without a job_id every unfinished job of this kind. Returns the number of jobs canceled
+    """
+
+    with jobs_lock:
+        if job_id is not None:
+            job = jobs.get(job_id)
+            targets = [job] if job is not None and job.kind == kind else []
+        else:
+            targets = list(jobs.values())
+        targets = [j for j in targets if j.kind == kind and j.state != "done"]
+    for job in targets: job.token.cancel()
+    return len(targets)
+
+
+def job_stats():
+    with jobs_lock:
+        s = {}
+        s["jobs"] = [j.status() for j in jobs.values() if j.state != "done"]
+        s["cancel_latency"] = {}
+        for kind, latencies in cancel_latencies.items():
+            if len(latencies) == 0: continue
+            ordered = sorted(latencies)
+            s["cancel_latency"][kind] = \
+            {
+                "count": len(ordered),
+                "mean": sum(ordered) / len(ordered),
+                "p50": ordered[len(ordered) // 2],
+                "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                "max": ordered[-1],
+            }
+        return s
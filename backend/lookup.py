@@ -0,0 +1,81 @@
+# exllamav2 is imported where it is used, see backend/runtime.py
+
+from backend.util import tokenizer_key
+
+# Prompt lookup speculation (speculative_mode "Prompt lookup"). Draft tokens come from n-gram matches against the
+# current context, as in "N-gram" mode, and against an index of the session's or notepad's own text, including what no
+# longer fits in the context or comes after the notepad cursor. Chats repeat code, names and quotes from earlier blocks
+# and notepad edits repeat the surrounding text, matches the current context alone doesn't have.
+#
+# The index is built from parts (blocks, notepad lines) and kept between generations. When the parts it was built from
+# are still a prefix of the current ones, only the new parts are tokenized
+
+lookup_modes = ["N-gram", "Prompt lookup"]
+
+
+class LookupIndex:
+
+    parts: list
+    cache: object or None
+    tokenizer_id: int or None
+
+    def __init__(self):
+        self.parts = []
+        self.cache = None
+        self.tokenizer_id = None
+
+
+    def update(self, generator, tokenizer, parts):
+        """
+        Index parts, a list of (key, text), and return the NgramCache to preload the generator with
+        """
+
+        from exllamav2.generator.ngram import NgramCache
+
+        keys = [key for key, text in parts]
+        if self.cache is None or self.tokenizer_id != tokenizer_key(tokenizer) or keys[:len(self.parts)] != self.parts:
+            self.cache = NgramCache(generator.speculative_ngram_min, generator.speculative_ngram_max, None)
+            self.parts = []
+            self.tokenizer_id = tokenizer_key(tokenizer)
+
+        for key, text in parts[len(self.parts):]:
+            if text:
+                ids = tokenizer.encode(text, encode_special_tokens = False)
+                self.cache.update(ids[0].tolist())
+            self.parts.append(key)
+
+        return self.cache
+
+
+def block_parts(history):
+    return [((h["block_uuid"], hash(h["text"] or "")), h["text"] or "") for h in history]
+
+
+def text_parts(text):
+    lines = text.split("\n")
+    return [(hash(line), line + "\n") for line in lines]
+
+
+def begin_speculation(generator, speculative_mode, index = None):
+    """
+    Configure the generator's n-gram speculation for the next generation, with index preloaded in "Prompt lookup" mode,
+    and reset its draft counters
+    """
+
+    generator.speculative_ngram = speculative_mode in lookup_modes
+    generator.ngram_preloaded = index if speculative_mode == "Prompt lookup" else None
+    generator.reset_sd_stats()
+
+
+def speculation_meta(generator, speculative_mode):
+    """
+    Draft statistics since begin_speculation, for block meta
+    """
+
+    efficiency, accuracy, total_tokens, draft_tokens, accepted_tokens = generator.get_sd_stats()
+    meta = {}
+    meta["speculative_mode"] = speculative_mode
+    meta["draft_tokens"] = draft_tokens
+    meta["accepted_tokens"] = accepted_tokens
+    meta["acceptance_rate"] = accepted_tokens / draft_tokens if draft_tokens else 0.0
+    return meta
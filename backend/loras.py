@@ -0,0 +1,114 @@
+import os
+from collections import OrderedDict
+
+from backend.settings import get_settings
+from backend.util import expanduser
+
+# exllamav2 is imported where it is used, see backend/runtime.py
+
+# LoRA adapters on a resident model. A model config lists its adapters in "loras" and a session picks one by name with
+# its "lora" setting. Adapters are loaded on first use, on top of the weights already in VRAM, and kept in an LRU
+# bounded by the lora_vram_budget setting, so switching between fine-tunes of one base is no model load.
+#
+# Only the base weights are shared. An adapter changes the keys and values of every position in every layer it adapts,
+# so a prefix cached under one adapter (or none) is not valid under another, and the cache is only reused between
+# generations with the same adapter
+
+
+def parse_lora_list(loras):
+    """
+    Parse an adapter spec like "assistant=~/loras/assistant; ~/loras/coder" into an ordered dict of name: directory.
+    An adapter without a name is named after its directory
+    """
+
+    adapters = OrderedDict()
+    if loras is None or loras.strip() == "": return adapters
+    for entry in loras.split(";"):
+        if entry.strip() == "": continue
+        if "=" in entry:
+            name, directory = entry.split("=", 1)
+        else:
+            directory = entry
+            name = os.path.basename(os.path.normpath(expanduser(entry.strip())))
+        name = name.strip()
+        if name in adapters: raise ValueError(f"Duplicate LoRA adapter name: {name}")
+        adapters[name] = expanduser(directory.strip())
+    return adapters
+
+
+def adapter_size(directory):
+    """
+    Bytes of adapter weights in directory, roughly what they take in VRAM
+    """
+
+    size = 0
+    for filename in os.listdir(directory):
+        if filename.startswith("adapter_model"): size += os.path.getsize(os.path.join(directory, filename))
+    return size
+
+
+class LoraCache:
+
+    loaded: OrderedDict
+    active: str or None
+
+    def __init__(self, container):
+        self.container = container
+        self.loaded = OrderedDict()
+        self.active = None
+
+
+    def used(self):
+        return sum(size for lora, size in self.loaded.values())
+
+
+    def get(self, name):
+        from exllamav2 import ExLlamaV2Lora
+
+        if name in self.loaded:
+            self.loaded.move_to_end(name)
+            return self.loaded[name][0]
+
+        adapters = parse_lora_list(self.container.model_dict.get("loras", ""))
+        if name not in adapters: raise ValueError(f"Unknown LoRA adapter: {name}")
+        directory = adapters[name]
+        size = adapter_size(directory)
+
+        budget = get_settings().get("lora_vram_budget", 2) * 1024**3
+        while len(self.loaded) > 0 and self.used() + size > budget:
+            evict, (lora, _) = self.loaded.popitem(last = False)
+            print(f" -- Unloading LoRA adapter: {evict}")
+            lora.unload()
+
+        print(f" -- Loading LoRA adapter: {name} ({directory})")
+        lora = ExLlamaV2Lora.from_directory(self.container.model, directory)
+        self.loaded[name] = (lora, size)
+        return lora
+
+
+    def activate(self, name):
+        """
+        The loras argument for a generation with adapter name (empty for none). Invalidates the cache if the previous
+        generation on this container used a different adapter
+        """
+
+        name = name or None
+        loras = [self.get(name)] if name is not None else None
+        if name != self.active:
+            self.container.invalidate_cache()
+            self.active = name
+        return loras
+
+
+    def clear(self):
+        for lora, _ in self.loaded.values(): lora.unload()
+        self.loaded.clear()
+        self.active = None
+
+
+    def status(self):
+        s = {}
+        s["loaded"] = list(self.loaded.keys())
+        s["active"] = self.active
+        s["used"] = self.used()
+        return s
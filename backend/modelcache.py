@@ -0,0 +1,154 @@
+import json, os, threading, copy
+
+from backend.config import config_filename, locked_file, read_json, write_json, merge_json
+from backend.estimate import weights_bytes, weights_breakdown
+from backend.chattemplates import read_chat_template, detect_prompt_format
+from backend.prompts import prompt_formats
+
+# Persistent cache of model directory inspections (ExLlamaV2Config.prepare(), generation_config.json, chat template and
+# the prompt format it matches, tensor sizes), keyed by directory and invalidated by the sizes and mtimes of its config,
+# index and weights files, or when cache_version changes
+
+cache_lock = threading.Lock()
+dir_cache: dict or None = None
+cache_base: dict = {}  # model_cache.json as last read or written
+
+fingerprint_files = ["config.json", "generation_config.json", "tokenizer_config.json", "chat_template.jinja"]
+cache_version = 2
+
+
+def load_cache():
+    global dir_cache, cache_base
+
+    if dir_cache is not None: return
+    filename = config_filename("model_cache.json")
+    with locked_file(filename):
+        dir_cache = read_json(filename, {})
+    cache_base = copy.deepcopy(dir_cache)
+
+
+def save_cache():
+    global cache_base
+
+    # Merged with entries the worker process wrote since, see backend/config.py
+    filename = config_filename("model_cache.json")
+    with locked_file(filename):
+        merged = merge_json(cache_base, dir_cache, read_json(filename, {}))
+        write_json(filename, merged)
+    dir_cache.clear()
+    dir_cache.update(merged)
+    cache_base = copy.deepcopy(merged)
+
+
+def dir_fingerprint(model_dir):
+    fp = []
+    for f in sorted(os.listdir(model_dir)):
+        if f in fingerprint_files or f.endswith(".safetensors") or f.endswith(".index.json"):
+            st = os.stat(os.path.join(model_dir, f))
+            fp.append([f, st.st_size, st.st_mtime])
+    return fp
+
+
+def read_generation_config(model_dir):
+    config_path = os.path.join(model_dir, "generation_config.json")
+    if not os.path.exists(config_path): return None, None
+    try:
+        with open(config_path, encoding = 'utf-8') as f:
+            gen_config = json.load(f)
+        if not isinstance(gen_config, dict):
+            raise ValueError("generation_config.json must contain a JSON object")
+        return gen_config, None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def read_prompt_format(model_dir):
+    try:
+        chat_template = read_chat_template(model_dir)
+        return chat_template, detect_prompt_format(chat_template, prompt_formats)
+    except Exception as e:
+        print(f" !! Unable to read chat template in {model_dir}: {type(e).__name__}: {e}")
+        return None, None
+
+
+def inspect_dir(model_dir):
+    from exllamav2 import ExLlamaV2Config
+
+    info = {}
+    info["generation_config"], info["generation_config_error"] = read_generation_config(model_dir)
+    info["chat_template"], info["prompt_format"] = read_prompt_format(model_dir)
+
+    prep_config = ExLlamaV2Config()
+    prep_config.fasttensors = False
+    prep_config.model_dir = model_dir
+
+    try:
+        prep_config.prepare()
+        info["status"] = "ok"
+        info["error"] = None
+    except Exception as e:
+        info["status"] = "error"
+        info["error"] = str(e)
+        return info
+
+    stats = {}
+    stats["hidden_size"] = prep_config.hidden_size
+    stats["intermediate_size"] = prep_config.intermediate_size
+    stats["num_attention_heads"] = prep_config.num_attention_heads
+    stats["num_key_value_heads"] = prep_config.num_key_value_heads
+    stats["num_hidden_layers"] = prep_config.num_hidden_layers
+    stats["vocab_size"] = prep_config.vocab_size
+    stats["head_dim"] = prep_config.head_dim
+    stats["default_seq_len"] = prep_config.max_seq_len
+    stats["weights_bytes"] = weights_bytes(model_dir)
+    try:
+        stats.update(weights_breakdown(model_dir))
+    except Exception as e:
+        print(f" !! Unable to read tensor sizes in {model_dir}: {type(e).__name__}: {e}")
+    info["stats"] = stats
+
+    config = {}
+    config["max_seq_len"] = prep_config.max_seq_len
+    config["scale_pos_emb"] = prep_config.scale_pos_emb
+    config["scale_alpha_value"] = prep_config.scale_alpha_value
+    config["max_input_len"] = prep_config.max_input_len
+    info["config"] = config
+
+    return info
+
+
+def cached_fingerprint(model_dir):
+    """
+    Fingerprint of model_dir when it was last inspected, or None if it wasn't
+    """
+
+    with cache_lock:
+        load_cache()
+        entry = dir_cache.get(model_dir)
+        return entry["fingerprint"] if entry is not None else None
+
+
+def inspect_model_dir(model_dir, force = False):
+    """
+    Stats, config defaults and generation config for model_dir, from the cache unless any fingerprinted file changed
+    """
+
+    if not os.path.isdir(model_dir):
+        return { "status": "error", "error": f"Directory not found: {model_dir}", "generation_config": None, "generation_config_error": None,
+                 "chat_template": None, "prompt_format": None }
+
+    fingerprint = dir_fingerprint(model_dir)
+
+    with cache_lock:
+        load_cache()
+        entry = dir_cache.get(model_dir)
+        if not force and entry is not None and entry["fingerprint"] == fingerprint and entry.get("version") == cache_version:
+            return entry["info"]
+
+    info = inspect_dir(model_dir)
+
+    with cache_lock:
+        dir_cache[model_dir] = { "fingerprint": fingerprint, "info": info, "version": cache_version }
+        save_cache()
+
+    return info
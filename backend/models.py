@@ -1,30 +1,29 @@
-import json, uuid, os, gc
-import torch
-from pynvml import *
-
-from exllamav2 import(
-    ExLlamaV2,
-    ExLlamaV2Config,
-    ExLlamaV2Cache,
-    ExLlamaV2Cache_8bit,
-    ExLlamaV2Cache_Q4,
-    ExLlamaV2Cache_Q6,
-    ExLlamaV2Cache_Q8,
-    ExLlamaV2Cache_TP,
-    ExLlamaV2Tokenizer,
-)
-
-from exllamav2.generator import(
-    ExLlamaV2StreamingGenerator,
-    ExLlamaV2Sampler
-)
-
-from exllamav2.attn import ExLlamaV2Attention
-# from exllamav2.util import list_live_tensors
-from backend.config import config_filename
+from __future__ import annotations
+import json, uuid, os, gc, threading, time, copy
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# torch, pynvml and exllamav2 are imported where they are used, see backend/runtime.py
+
+from backend.config import config_filename, global_state, locked_file, read_json, write_json, merge_json
+from backend.runtime import wait_runtime, runtime_status
+from backend.estimate import model_footprint, estimate_vram, auto_fit, component_bytes
+from backend.modelcache import inspect_model_dir, cached_fingerprint
+from backend.prompts import forget_templates
+from concurrent.futures import ThreadPoolExecutor
+from backend.settings import get_settings
+import backend.weightcache as weightcache
+from backend.prefetch import Prefetcher
+from backend.replicas import ReplicaRouter, parse_device_groups, group_split
+from backend.loras import LoraCache
+from backend.events import publish
 from backend.util import *
 
-from typing import Callable, Optional, Dict, Any
+from typing import Callable, Optional, Dict, Any, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from exllamav2 import ExLlamaV2, ExLlamaV2Config, ExLlamaV2Cache, ExLlamaV2Tokenizer
+    from exllamav2.generator import ExLlamaV2StreamingGenerator, ExLlamaV2DynamicGenerator
 
 # Callback type for model parameter updates
 ModelLoadedCallback = Callable[[Dict[str, Any]], None]
@@ -46,28 +45,47 @@ def set_model_loaded_callback(callback: Optional[ModelLoadedCallback]) -> None:
 # Reserve memory for auto-split functionality
 auto_split_reserve_bytes = 512 * 1024**2
 
+# Most jobs the batch generator runs at once
+max_batch_size = 8
+
 models = {}
+models_base = {}  # models.json as last read or written, see save_models
 
 # Load/save config
 
 def load_models():
-    global models
+    global models, models_base
 
     filename = config_filename("models.json")
-    if os.path.exists(filename):
-        with open(filename, "r") as f:
-            models = json.load(f)
-    else:
-        models = {}
+    with locked_file(filename):
+        models = read_json(filename, {})
+    models_base = copy.deepcopy(models)
 
 
 def save_models():
-    global models
+    global models, models_base
+
+    # The worker process saves models.json too. Settings changed here since the file was last read or written replace
+    # those on disk, everything else on disk is kept and taken over. Model dicts are updated in place, containers hold
+    # references to them
 
     filename = config_filename("models.json")
-    models_json = json.dumps(models, indent = 4)
-    with open(filename, "w") as outfile:
-        outfile.write(models_json)
+    with locked_file(filename):
+        merged = merge_json(models_base, models, read_json(filename, {}), depth = 1)
+        write_json(filename, merged)
+
+    for k in list(models.keys()):
+        if k not in merged: del models[k]
+    for k, v in merged.items():
+        model = models.get(k)
+        if model is None:
+            models[k] = v
+            continue
+        for key in list(model.keys()):
+            if key not in v: del model[key]
+        for key, value in v.items():
+            if model.get(key) != value: model[key] = value
+    models_base = copy.deepcopy(merged)
 
 
 # List models
@@ -81,6 +99,16 @@ def list_models():
     return models_list, current_model
 
 
+def list_resident_models():
+    with pool_lock:
+        return list(resident_models.keys())
+
+
+def publish_models():
+    current_model = loaded_model.get_uuid() if loaded_model is not None else None
+    publish("models", { "current_model": current_model, "resident_models": list_resident_models() })
+
+
 # Get model
 
 def get_model_info(data = None):
@@ -96,6 +124,12 @@ def get_model_info(data = None):
         m["speculative_mode"] = "Draft model"
     if "speculative_mode" not in m: m["speculative_mode"] = "None"
     if "tensor_p" not in m: m["tensor_p"] = False
+    if "auto_fit" not in m: m["auto_fit"] = False
+    if "replicas" not in m: m["replicas"] = ""
+    if "loras" not in m: m["loras"] = ""
+    if "stats" in m and "layers_bytes" not in m["stats"]:
+        info = inspect_model_dir(expanduser(m["model_directory"]))
+        if info["status"] == "ok": m["stats"] = dict(info["stats"])
     return m
 
 # Remove model config
@@ -106,6 +140,8 @@ def remove_model(data):
     i = data["model_uuid"]
     if i is None: return
 
+    with pool_lock:
+        if i in resident_models: unload_resident(i)
     del models[i]
     save_models()
 
@@ -151,118 +187,92 @@ def prepare_draft_model(model):
 
     if model["speculative_mode"] == "Draft model":
 
-        prep_draft_config = ExLlamaV2Config()
-        prep_draft_config.fasttensors = False
-        prep_draft_config.model_dir = expanduser(model.get("draft_model_directory", ""))
-        try:
-            prep_draft_config.prepare()
-            model["draft_config_status"] = "ok"
-            model["draft_config_status_error"] = None
-        except Exception as e:
+        info = inspect_model_dir(expanduser(model.get("draft_model_directory", "")))
+        if info["status"] != "ok":
             model["draft_config_status"] = "error"
-            model["draft_config_status_error"] = str(e)
+            model["draft_config_status_error"] = info["error"]
             return
 
-        draft_stats = {}
-        draft_stats["hidden_size"] = prep_draft_config.hidden_size
-        draft_stats["intermediate_size"] = prep_draft_config.intermediate_size
-        draft_stats["num_attention_heads"] = prep_draft_config.num_attention_heads
-        draft_stats["num_key_value_heads"] = prep_draft_config.num_key_value_heads
-        draft_stats["num_hidden_layers"] = prep_draft_config.num_hidden_layers
-        draft_stats["vocab_size"] = prep_draft_config.vocab_size
-        draft_stats["head_dim"] = prep_draft_config.head_dim
-        draft_stats["default_seq_len"] = prep_draft_config.max_seq_len
-        model["draft_stats"] = draft_stats
+        model["draft_config_status"] = "ok"
+        model["draft_config_status_error"] = None
+        model["draft_stats"] = dict(info["stats"])
 
         if "draft_rope_alpha" not in model: model["draft_rope_alpha"] = 1.0
         if "draft_rope_alpha_auto" not in model: model["draft_rope_alpha_auto"] = True
 
 
-def prepare_model(model: Dict[str, Any]) -> None:
+def prepare_model(model: Dict[str, Any], apply_generation_config: bool = True) -> None:
     """Prepare model for loading by configuring parameters and resources.
+
+    Directory inspection is cached, see backend/modelcache.py
     
     Args:
         model: Dictionary containing model configuration
+        apply_generation_config: Copy sampling parameters from generation_config.json over the model's own
         
     Raises:
         ValueError: If model directory is invalid
         JSONDecodeError: If generation_config.json exists but is malformed
     """
-    # Read generation_config.json if present
-    config_path = os.path.join(expanduser(model["model_directory"]), "generation_config.json")
-    if os.path.exists(config_path):
-        try:
-            with open(config_path, encoding='utf-8') as f:
-                gen_config = json.load(f)
-
-            if not isinstance(gen_config, dict):
-                raise ValueError("generation_config.json must contain a JSON object")
-                
-            print(f"Found generation_config.json: {gen_config}")
-
-            # Map generation config parameters to internal names
-            params_to_check = {
-                "temperature": "temperature",
-                "top_k": "top_k",
-                "top_p": "top_p",
-                "repetition_penalty": "repp"
-            }
-
-            # Store original values for logging
-            orig_values = {k: model.get(k) for k in params_to_check.values()}
-            
-            # Update model with values from generation_config.json
-            for config_name, internal_name in params_to_check.items():
-                if config_name in gen_config:
-                    # Validate parameter types
-                    value = gen_config[config_name]
-                    if not isinstance(value, (int, float)):
-                        print(f"Warning: Invalid type for {config_name} in generation_config.json. Expected number, got {type(value)}")
-                        continue
-                        
-                    model[internal_name] = value
-                    print(f"Setting {internal_name} from {orig_values.get(internal_name)} to {value}")
-
-            # Save updated model config
-            save_models()
-        except json.JSONDecodeError as e:
-            print(f"Error parsing generation_config.json: {e}")
-            print("Using default parameter values")
-        except Exception as e:
-            print(f"Unexpected error reading generation_config.json: {e}")
-            print("Using default parameter values")
 
-    prep_config = ExLlamaV2Config()
-    prep_config.fasttensors = False
-    prep_config.model_dir = expanduser(model["model_directory"])
-
-    try:
-        prep_config.prepare()
-        model["config_status"] = "ok"
-        model["config_status_error"] = None
-    except Exception as e:
+    info = inspect_model_dir(expanduser(model["model_directory"]))
+
+    # Apply generation_config.json if present
+    gen_config = info["generation_config"] if apply_generation_config else None
+    if apply_generation_config and info["generation_config_error"] is not None:
+        print(f"Error reading generation_config.json: {info['generation_config_error']}")
+        print("Using default parameter values")
+    elif gen_config is not None:
+        print(f"Found generation_config.json: {gen_config}")
+
+        # Map generation config parameters to internal names
+        params_to_check = {
+            "temperature": "temperature",
+            "top_k": "top_k",
+            "top_p": "top_p",
+            "repetition_penalty": "repp"
+        }
+
+        # Store original values for logging
+        orig_values = {k: model.get(k) for k in params_to_check.values()}
+
+        # Update model with values from generation_config.json
+        for config_name, internal_name in params_to_check.items():
+            if config_name in gen_config:
+                # Validate parameter types
+                value = gen_config[config_name]
+                if not isinstance(value, (int, float)):
+                    print(f"Warning: Invalid type for {config_name} in generation_config.json. Expected number, got {type(value)}")
+                    continue
+
+                model[internal_name] = value
+                print(f"Setting {internal_name} from {orig_values.get(internal_name)} to {value}")
+
+    # Prompt format matching the model's chat template, the default for new sessions. Kept up to date unless it was
+    # changed by hand
+    detected = info.get("prompt_format")
+    if model.get("prompt_format") == model.get("detected_prompt_format"):
+        if detected is None: model.pop("prompt_format", None)
+        else: model["prompt_format"] = detected
+    model["detected_prompt_format"] = detected
+
+    if info["status"] != "ok":
         model["config_status"] = "error"
-        model["config_status_error"] = str(e)
+        model["config_status_error"] = info["error"]
         return
 
-    stats = {}
-    stats["hidden_size"] = prep_config.hidden_size
-    stats["intermediate_size"] = prep_config.intermediate_size
-    stats["num_attention_heads"] = prep_config.num_attention_heads
-    stats["num_key_value_heads"] = prep_config.num_key_value_heads
-    stats["num_hidden_layers"] = prep_config.num_hidden_layers
-    stats["vocab_size"] = prep_config.vocab_size
-    stats["head_dim"] = prep_config.head_dim
-    stats["default_seq_len"] = prep_config.max_seq_len
-    model["stats"] = stats
-
-    model["default_seq_len"] = prep_config.max_seq_len
-    if "seq_len" not in model: model["seq_len"] = prep_config.max_seq_len
-    if "rope_scale" not in model: model["rope_scale"] = prep_config.scale_pos_emb
-    if "rope_alpha" not in model: model["rope_alpha"] = prep_config.scale_alpha_value
+    model["config_status"] = "ok"
+    model["config_status_error"] = None
+    model["stats"] = dict(info["stats"])
+
+    config = info["config"]
+    model["default_seq_len"] = config["max_seq_len"]
+    if "seq_len" not in model: model["seq_len"] = config["max_seq_len"]
+    if "rope_scale" not in model: model["rope_scale"] = config["scale_pos_emb"]
+    if "rope_alpha" not in model: model["rope_alpha"] = config["scale_alpha_value"]
 
     if "cache_mode" not in model: model["cache_mode"] = "FP16"
-    if "chunk_size" not in model: model["chunk_size"] = prep_config.max_input_len
+    if "chunk_size" not in model: model["chunk_size"] = config["max_input_len"]
     if "gpu_split" not in model: model["gpu_split"] = ""
     if "gpu_split_auto" not in model: model["gpu_split_auto"] = True
 
@@ -275,6 +285,34 @@ def prepare_model(model: Dict[str, Any]) -> None:
     })
 
 
+def rescan_models():
+    """
+    Re-inspect every registered model directory in parallel, bypassing the cache, then refresh the model configs.
+    Sampling parameters from generation_config.json are only applied again to models whose files changed, so values
+    edited by hand are kept
+    """
+    global models
+
+    dirs = set()
+    for model in models.values():
+        dirs.add(expanduser(model["model_directory"]))
+        if model.get("speculative_mode", "None") == "Draft model":
+            dirs.add(expanduser(model.get("draft_model_directory", "")))
+
+    fingerprints = { d: cached_fingerprint(d) for d in dirs }
+    with ThreadPoolExecutor(max_workers = 8) as executor:
+        list(executor.map(lambda d: inspect_model_dir(d, force = True), dirs))
+
+    for model in models.values():
+        model_dir = expanduser(model["model_directory"])
+        changed = fingerprints[model_dir] is None or cached_fingerprint(model_dir) != fingerprints[model_dir]
+        prepare_model(model, apply_generation_config = changed)
+        prepare_draft_model(model)
+    save_models()
+
+    return { k: v.get("config_status", "error") for k, v in models.items() }
+
+
 class ModelContainer:
 
     config: ExLlamaV2Config or None = None
@@ -286,12 +324,21 @@ class ModelContainer:
     tokenizer: ExLlamaV2Tokenizer or None = None
     generator: ExLlamaV2StreamingGenerator or None = None
     model_dict = None
+    load_times = None
+    device_group = None
+    device_split = None
+    draft_time = 0.0
+    batch_generator: ExLlamaV2DynamicGenerator or None = None
 
     # draft_enabled: bool = False
 
-    def __init__(self, model, progress_callback = None):
+    def __init__(self, model, progress_callback = None, device_group = None):
+        from exllamav2 import ExLlamaV2Config
 
         self.model_dict = model
+        self.device_group = device_group
+        self.loras = LoraCache(self)
+        self.chat_template = inspect_model_dir(expanduser(model["model_directory"])).get("chat_template")
 
         self.config = ExLlamaV2Config()
         self.config.model_dir = expanduser(model["model_directory"])
@@ -334,6 +381,12 @@ class ModelContainer:
 
 
     def load(self, progress_callback = None):
+        import torch
+        from exllamav2 import(
+            ExLlamaV2,
+            ExLlamaV2Cache,
+            ExLlamaV2Tokenizer,
+        )
 
         ExLlamaV2Tokenizer.unspecial_piece_to_id = {}  # TODO: won't be necessary from exllamav2 0.0.17
         ExLlamaV2Tokenizer.unspecial_id_to_piece = {}
@@ -349,22 +402,62 @@ class ModelContainer:
             self.draft_model = ExLlamaV2(self.draft_config)
             print("Loading draft model: " + self.draft_config.model_dir)
 
-            self.draft_cache = ExLlamaV2Cache(self.draft_model, lazy = True)
-            reserve = [96 * 1024**2] + [0] * 16
-            yield from self.draft_model.load_autosplit_gen(self.draft_cache, reserve_vram = reserve, last_id_only = True, callback_gen = progress_callback)
+            weightcache.begin_load(self.draft_config.model_dir)
+            draft_callback, prefetcher = self.start_prefetch(self.draft_config.model_dir, self.draft_model, progress_callback)
+            try:
+                if self.device_group is not None:
+                    split = self.group_split(self.model_dict.get("draft_stats"), "FP16")
+                    for value in self.draft_model.load_gen(split, callback_gen = draft_callback):
+                        if isinstance(value, str):
+                            yield value
+                    self.draft_cache = ExLlamaV2Cache(self.draft_model)
+                else:
+                    self.draft_cache = ExLlamaV2Cache(self.draft_model, lazy = True)
+                    reserve = [96 * 1024**2] + [0] * 16
+                    yield from self.draft_model.load_autosplit_gen(self.draft_cache, reserve_vram = reserve, last_id_only = True, callback_gen = draft_callback)
+            finally:
+                if prefetcher: prefetcher.close()
+            weightcache.end_load(success = True)
 
             # Test VRAM allocation with a full-length forward pass
 
             input_ids = torch.zeros((1, self.config.max_input_len), dtype = torch.long)
             self.draft_model.forward(input_ids, cache = self.cache, preprocess_only = True)
 
-        # Load model
+            self.time_draft_model()
+
+        # Load model. A replica's split is measured after its draft model is loaded
+
+        if self.device_group is not None:
+            self.device_split = self.group_split(self.model_dict.get("stats"), self.model_dict["cache_mode"])
 
         self.model = ExLlamaV2(self.config)
         print("Loading model: " + self.config.model_dir)
 
+        model_callback, prefetcher = self.start_prefetch(self.config.model_dir, self.model, progress_callback)
+        try:
+            yield from self.load_main(model_callback)
+        finally:
+            if prefetcher: prefetcher.close()
+
+
+    def load_main(self, progress_callback):
+        import torch
+        from exllamav2 import(
+            ExLlamaV2Cache,
+            ExLlamaV2Cache_8bit,
+            ExLlamaV2Cache_Q4,
+            ExLlamaV2Cache_Q6,
+            ExLlamaV2Cache_Q8,
+            ExLlamaV2Cache_TP,
+        )
+        from exllamav2.generator import ExLlamaV2StreamingGenerator
+
         tp = self.model_dict["tensor_p"]
-        if self.model_dict["gpu_split_auto"]:
+        if self.device_split is not None:
+            auto_split = False
+            split = self.device_split
+        elif self.model_dict["gpu_split_auto"]:
             auto_split = True
             split = None
         elif self.model_dict["gpu_split"] is None or self.model_dict["gpu_split"].strip() == "":
@@ -374,6 +467,8 @@ class ModelContainer:
             auto_split = False
             split = [float(alloc) for alloc in self.model_dict["gpu_split"].split(",")]
 
+        weightcache.begin_load(self.config.model_dir)
+
         if tp:
             for value in self.model.load_tp_gen(split, callback_gen = progress_callback):
                 if isinstance(value, str):
@@ -406,6 +501,9 @@ class ModelContainer:
             reserve = [96 * 1024**2, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]
             yield from self.model.load_autosplit_gen(self.cache, reserve_vram = reserve, last_id_only = True, callback_gen = progress_callback)
 
+        self.load_times = weightcache.get_load_times()
+        weightcache.end_load(success = True)
+
         # Test VRAM allocation with a full-length forward pass
 
         input_ids = torch.zeros((1, self.config.max_input_len), dtype = torch.long)
@@ -416,18 +514,93 @@ class ModelContainer:
         self.generator = ExLlamaV2StreamingGenerator(self.model, self.cache, self.tokenizer, self.draft_model, self.draft_cache)
 
 
-    def get_free_vram(self):
-        global auto_split_reserve_bytes
+    def group_split(self, stats, cache_mode):
+        """
+        GPU split confining a model with stats to this replica's devices, leaving room for its cache and scratch space
+        in the VRAM free right now
+        """
+
+        weights, cache, scratch = 0, 0, 0
+        if stats is not None:
+            weights, cache, scratch = component_bytes(stats, self.config.max_seq_len, cache_mode, self.config.max_input_len)
+        return group_split(self.device_group, get_free_vram(), weights, cache, scratch)
+
+
+    def invalidate_cache(self):
+        # The next streaming generation prefills its whole context
+        self.cache.current_seq_len = 0
+        if self.draft_cache is not None: self.draft_cache.current_seq_len = 0
+
+
+    def get_batch_generator(self):
+        """
+        Dynamic generator sharing this container's cache, for batches of jobs that deduplicate a common prefix. The
+        streaming generator and the dynamic generator each overwrite what the other had cached
+        """
+        from exllamav2.generator import ExLlamaV2DynamicGenerator
+
+        if self.batch_generator is None:
+            if self.model_dict["tensor_p"]: raise ValueError("Batched generation is not supported with tensor parallelism.")
+            self.batch_generator = ExLlamaV2DynamicGenerator(
+                model = self.model,
+                cache = self.cache,
+                tokenizer = self.tokenizer,
+                max_batch_size = max_batch_size,
+                max_chunk_size = self.config.max_input_len
+            )
+        else:
+            self.batch_generator.reset_page_table()
+        self.invalidate_cache()
+        return self.batch_generator
+
+
+    def time_draft_model(self):
+        """
+        Accumulate the time spent in draft model forward passes in draft_time, for speculation telemetry
+        """
+        import torch
+
+        forward = self.draft_model.forward
 
-        nvmlInit()
-        device_count = torch.cuda.device_count()
-        free_vram = []
-        for i in range(device_count):
-            handle = nvmlDeviceGetHandleByIndex(i)
-            info = nvmlDeviceGetMemoryInfo(handle)
-            free_vram.append(info.free - auto_split_reserve_bytes)
+        # Synchronizing adds no wait of its own, the generator samples from the draft logits right away
 
-        return free_vram
+        def timed_forward(*args, **kwargs):
+            t = time.time()
+            try:
+                return forward(*args, **kwargs)
+            finally:
+                if torch.cuda.is_available(): torch.cuda.synchronize()
+                self.draft_time += time.time() - t
+
+        self.draft_model.forward = timed_forward
+
+
+    def start_prefetch(self, model_dir, model, progress_callback):
+        """
+        Wrap progress_callback to read ahead upcoming modules' weights, adding per-module I/O wait to the progress
+        packets. Skipped if the weights are already in the host cache
+        """
+
+        settings = get_settings()
+        window = settings.get("prefetch_window", 0)
+        if window <= 0 or progress_callback is None or weightcache.has_entry(model_dir):
+            return progress_callback, None
+
+        try:
+            prefetcher = Prefetcher(model_dir, [m.key for m in model.modules], window, settings.get("prefetch_threads", 4))
+        except Exception as e:
+            print(f" !! Read-ahead disabled: {type(e).__name__}: {e}")
+            return progress_callback, None
+
+        def callback(module, num_modules):
+            io_wait = prefetcher.advance(module)
+            yield from progress_callback(module, num_modules, io_wait = io_wait)
+
+        return callback, prefetcher
+
+
+    def get_free_vram(self):
+        return get_free_vram()
 
 
     def get_uuid(self):
@@ -437,14 +610,21 @@ class ModelContainer:
 
     def unload(self):
 
+        self.loras.clear()
+        if self.tokenizer is not None: forget_templates(self.tokenizer)
         if self.model: self.model.unload()
+        if self.draft_model: self.draft_model.unload()
         self.model = None
+        self.draft_model = None
         self.config = None
         self.cache = None
+        self.draft_cache = None
         self.tokenizer = None
+        self.generator = None
+        self.batch_generator = None
 
 
-def stream_progress(module, num_modules):
+def stream_progress(module, num_modules, io_wait = None):
 
     packet = \
     {
@@ -452,47 +632,490 @@ def stream_progress(module, num_modules):
         "module": module ,
         "num_modules": num_modules
     }
+    packet.update(weightcache.get_load_times())
+    if io_wait is not None: packet["io_wait"] = io_wait
     # print(json.dumps(packet))
     yield json.dumps(packet) + "\n"
 
 
+def replica_progress(replica, num_replicas):
+    """
+    Progress callback for one of several replicas, counting modules across all of them
+    """
+
+    def callback(module, num_modules, io_wait = None):
+        yield from stream_progress(replica * num_modules + module, num_replicas * num_modules, io_wait = io_wait)
+
+    return callback
+
+
+def get_free_vram():
+    global auto_split_reserve_bytes
+    import torch
+    from pynvml import nvmlInit, nvmlDeviceGetHandleByIndex, nvmlDeviceGetMemoryInfo
+
+    nvmlInit()
+    device_count = torch.cuda.device_count()
+    free_vram = []
+    for i in range(device_count):
+        handle = nvmlDeviceGetHandleByIndex(i)
+        info = nvmlDeviceGetMemoryInfo(handle)
+        free_vram.append(info.free - auto_split_reserve_bytes)
+
+    return free_vram
+
+
+def get_device_budgets(model):
+    """
+    Free VRAM per device available to model, capped by its manual GPU split if it has one. With replicas, the devices
+    of the replica group with the least free VRAM, since every replica is loaded with the same settings
+    """
+
+    budgets = get_free_vram()
+    groups = parse_device_groups(model.get("replicas", ""))
+    if len(groups) > 0:
+        group = min(groups, key = lambda g: sum(budgets[d] for d in g if d < len(budgets)))
+        return [budgets[d] for d in group if d < len(budgets)]
+    if not model.get("gpu_split_auto", True) and model.get("gpu_split", "").strip() != "":
+        split = [float(alloc) * 1024**3 for alloc in model["gpu_split"].split(",")]
+        budgets = [min(b, s) for b, s in zip(budgets, split)]
+    return budgets
+
+
+def apply_auto_fit(model):
+    """
+    Set seq_len and cache_mode to the largest context and best cache quantization that fits free VRAM
+    """
+
+    fit = auto_fit(model, get_device_budgets(model), tensor_p = model.get("tensor_p", False))
+    if fit is None: return None
+    model["seq_len"] = fit["seq_len"]
+    model["cache_mode"] = fit["cache_mode"]
+    return fit
+
+
+def auto_fit_model(data):
+    global models
+
+    wait_runtime()
+    model = models[data["model_uuid"]]
+    fit = apply_auto_fit(model)
+    if fit is not None: save_models()
+    return fit
+
+
+# Model pool. Several models can stay resident up to the VRAM budget from settings.json (in GB, 0 keeps only one
+# model loaded). loaded_model is the active model, resident_models is ordered from least to most recently used and
+# holds the first replica of each model, resident_routers routes sessions across all of a model's replicas. Request
+# threads and the load job all touch the pool, hold pool_lock while reading or changing it
+
 loaded_model: ModelContainer or None = None
+resident_models: OrderedDict = OrderedDict()
+resident_footprints: dict = {}
+resident_routers: dict = {}
+pool_lock = threading.RLock()
 
 def get_loaded_model():
     return loaded_model
 
 
-def load_model(data):
+def get_router_for(model_uuid):
+    """
+    Router for a session's chosen model if that is resident, otherwise for the active model
+    """
+
+    with pool_lock:
+        if model_uuid and model_uuid in resident_models:
+            resident_models.move_to_end(model_uuid)
+            return resident_routers[model_uuid]
+        if loaded_model is None: return None
+        return resident_routers.get(loaded_model.get_uuid())
+
+
+def get_model_for(model_uuid, client_id = None):
+    """
+    Model a session should generate with: its chosen model if that is resident, otherwise the active model. With
+    replicas, the replica client_id is assigned to
+    """
+
+    router = get_router_for(model_uuid)
+    if router is None: return loaded_model
+    return router.assign(client_id).backend
+
+
+@contextmanager
+def acquire_model(model_uuid, client_id = None):
+    """
+    Hold the replica client_id is assigned to for one generation, yielding the Replica (None if no model is loaded).
+    Generations on the same replica are serialized
+    """
+
+    router = get_router_for(model_uuid)
+    if router is None:
+        yield None
+        return
+    with router.acquire(client_id) as replica:
+        yield replica
+
+
+def queue_generation(model_uuid, client_id, stream, run):
+    """
+    Queue the packet generator run(replica) on the replica client_id is assigned to, its packets going to stream (a
+    DecoupledStream). Returns at once, the replica's worker runs it when the generations before it are done. With no
+    model loaded, run(None) runs right away on the calling thread
+    """
+
+    router = get_router_for(model_uuid)
+    if router is None:
+        stream.produce(run(None))
+        return
+    router.submit(lambda replica: stream.produce(run(replica)), client_id)
+
+
+def release_client(client_id):
+    with pool_lock:
+        routers = list(resident_routers.values())
+    for router in routers:
+        router.release(client_id)
+
+
+def get_replica_status():
+    with pool_lock:
+        routers = list(resident_routers.items())
+    return { k: r.status() for k, r in routers }
+
+
+def get_vram_budget():
+    budget = get_settings().get("vram_budget", 0)
+    return int(float(budget) * 1024**3)
+
+
+def unload_resident(model_uuid):
+    global loaded_model
+    import torch
+
+    with pool_lock:
+        container = resident_models.pop(model_uuid)
+        del resident_footprints[model_uuid]
+        router = resident_routers.pop(model_uuid)
+        router.close()
+        for backend in router.backends():
+            backend.unload()
+        if loaded_model is container: loaded_model = None
+
+    gc.collect()
+    torch.cuda.empty_cache()
+
+
+def make_room(footprint):
+
+    budget = get_vram_budget()
+    with pool_lock:
+        while len(resident_models) > 0:
+            if budget > 0 and sum(resident_footprints.values()) + footprint <= budget: break
+            lru_uuid = next(iter(resident_models))
+            print(f" -- Evicting model: {resident_models[lru_uuid].model_dict['name']}")
+            unload_resident(lru_uuid)
+
+
+# Model loads run as background jobs. Clients stream the recorded packets, can attach to a load that is already in
+# flight (e.g. the last model being restored at startup) instead of starting another one, and can cancel it. Canceling
+# is cooperative: the job raises LoadCanceled into the loader at the next module boundary, which unloads the partially
+# loaded model
+
+class LoadCanceled(Exception):
+    pass
+
+
+class ModelLoad:
+
+    job_id: str
+    model_uuid: str
+    packets: list
+    done: bool
+    canceled: bool
+    module: int
+    num_modules: int
+
+    def __init__(self, model_uuid):
+        self.job_id = str(uuid.uuid4())
+        self.model_uuid = model_uuid
+        self.packets = []
+        self.done = False
+        self.canceled = False
+        self.module = 0
+        self.num_modules = 0
+        self.cond = threading.Condition()
+        self.cancel_event = threading.Event()
+        self.thread = None
+        self.listeners = []
+
+
+    def start(self):
+        self.thread = threading.Thread(target = self.run, name = "model_load", daemon = True)
+        self.thread.start()
+
+
+    def run(self):
+        gen = load_model_gen(self.model_uuid)
+        thrown = False
+        try:
+            packet = next(gen)
+            while True:
+                result = self.add_packet(packet)
+                if self.cancel_event.is_set() and not thrown and result == "progress":
+                    thrown = True
+                    packet = gen.throw(LoadCanceled("Model load canceled."))
+                else:
+                    packet = next(gen)
+        except StopIteration:
+            pass
+        except Exception as e:
+            result = { "result": "fail", "error": type(e).__name__ + ":\n" + str(e) }
+            self.add_packet(json.dumps(result) + "\n")
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+            for listener in self.listeners: listener(None)
+            self.listeners = []
+        publish_models()
+
+
+    def cancel(self):
+        self.cancel_event.set()
+
+
+    def add_packet(self, packet):
+        p = json.loads(packet)
+        with self.cond:
+            if p["result"] == "progress":
+                self.module = p["module"]
+                self.num_modules = p["num_modules"]
+            if p["result"] == "cancel":
+                self.canceled = True
+            self.packets.append(packet)
+            self.cond.notify_all()
+            for listener in self.listeners: listener(packet)
+        publish("model_load", { "job_id": self.job_id, "model_uuid": self.model_uuid, "packet": p })
+        return p["result"]
+
+
+    def subscribe(self, listener):
+        """
+        Call listener with every packet, starting with those already recorded, then with None when the job is done.
+        Called from the loading thread, so listener must not block
+        """
+
+        with self.cond:
+            for packet in self.packets: listener(packet)
+            if self.done: listener(None)
+            else: self.listeners.append(listener)
+
+
+    def unsubscribe(self, listener):
+        with self.cond:
+            if listener in self.listeners: self.listeners.remove(listener)
+
+
+    def stream(self):
+        i = 0
+        while True:
+            with self.cond:
+                while i >= len(self.packets) and not self.done:
+                    self.cond.wait()
+                new_packets = self.packets[i:]
+                i = len(self.packets)
+                done = self.done
+            yield from new_packets
+            if done: return
+
+
+    def stream_sse(self):
+        for packet in self.stream():
+            yield "data: " + packet.rstrip("\n") + "\n\n"
+
+
+    def status(self):
+        with self.cond:
+            s = {}
+            s["job_id"] = self.job_id
+            s["model_uuid"] = self.model_uuid
+            s["done"] = self.done
+            s["canceled"] = self.canceled
+            s["cancel_requested"] = self.cancel_event.is_set()
+            s["module"] = self.module
+            s["num_modules"] = self.num_modules
+            s["last_packet"] = json.loads(self.packets[-1]) if self.packets else None
+            return s
+
+
+current_load: ModelLoad or None = None
+load_jobs: OrderedDict = OrderedDict()
+max_load_jobs = 16
+load_lock = threading.Lock()
+
+def start_model_load(model_uuid):
+    global current_load
+
+    with load_lock:
+        if current_load is not None and not current_load.done:
+            if current_load.model_uuid == model_uuid: return current_load
+            return None
+        current_load = ModelLoad(model_uuid)
+        load_jobs[current_load.job_id] = current_load
+        while len(load_jobs) > max_load_jobs: load_jobs.popitem(last = False)
+        current_load.start()
+        return current_load
+
+
+def get_load_job(job_id = None):
+    if job_id is None: return current_load
+    return load_jobs.get(job_id)
+
+
+def get_load_status(job_id = None):
+
+    load = get_load_job(job_id)
+    if load is None: return None
+    return load.status()
+
+
+def cancel_load(job_id = None):
+
+    load = get_load_job(job_id)
+    if load is None or load.done: return False
+    load.cancel()
+    return True
+
+
+def restore_last_model():
+    global models
+
+    i = global_state.last_model_uuid
+    if i is None or i not in models: return None
+    print(f" -- Restoring model in background: {models[i]['name']}")
+    return start_model_load(i)
+
+
+def load_model(data, stream):
+    """
+    Start loading a model, its packets going to stream (a DecoupledStream) as the loading thread records them. Closing
+    the stream stops following the load without canceling it
+    """
+
+    load = start_model_load(data["model_uuid"])
+    if load is None:
+        result = { "result": "fail", "error": "Another model is currently loading." }
+        stream.put(json.dumps(result) + "\n")
+        stream.finish()
+        return
+
+    result = { "result": "job", "job_id": load.job_id }
+    stream.put(json.dumps(result) + "\n")
+
+    def listener(packet):
+        if packet is None: stream.finish()
+        else: stream.put(packet)
+
+    stream.on_close = lambda: load.unsubscribe(listener)
+    load.subscribe(listener)
+
+
+def load_model_gen(i):
     global models, loaded_model
 
-    if loaded_model is not None:
-        loaded_model.unload()
+    # Block until the inference stack has been imported
+
+    wait_runtime()
+    status = runtime_status()
+    if not status["ready"]:
+        errors = [k + ": " + v["error"] for k, v in status["components"].items() if v["error"]]
+        result = { "result": "fail", "error": "Inference runtime unavailable:\n" + "\n".join(errors) }
+        yield json.dumps(result) + "\n"
+        return ""
+
+    import torch
+
+    model = models[i]
+
+    # Switch to a resident model without reloading
+
+    with pool_lock:
+        resident = i in resident_models
+        if resident:
+            resident_models.move_to_end(i)
+            loaded_model = resident_models[i]
+    if resident:
+        global_state.update(last_model_uuid = i)
+        result = { "result": "ok", "resident": True }
+        yield json.dumps(result) + "\n"
+        return ""
+
+    # Evict least recently used models until the new one fits
+
+    try:
+        groups = parse_device_groups(model.get("replicas", ""))
+        if len(groups) > 0 and model.get("tensor_p", False):
+            raise ValueError("Replicas can't be combined with tensor parallelism.")
+    except ValueError as e:
+        result = { "result": "fail", "error": type(e).__name__ + ":\n" + str(e) }
+        yield json.dumps(result) + "\n"
+        return ""
+
+    footprint = model_footprint(model) * max(len(groups), 1)
+    with pool_lock:
+        make_room(footprint)
         loaded_model = None
 
     gc.collect()
     torch.cuda.empty_cache()
 
-    i = data["model_uuid"]
-    model = models[i]
+    if model.get("auto_fit", False):
+        fit = apply_auto_fit(model)
+        if fit is not None:
+            print(f" -- Auto-fit: seq_len = {fit['seq_len']}, cache_mode = {fit['cache_mode']}")
+            save_models()
+            footprint = fit["estimate"]["total"] * max(len(groups), 1)
+
+    containers = []
 
     try:
-        loaded_model = ModelContainer(model)
-        yield from loaded_model.load(progress_callback = stream_progress)
+        if len(groups) == 0:
+            container = ModelContainer(model)
+            containers.append(container)
+            yield from container.load(progress_callback = stream_progress)
+        else:
+            for r, group in enumerate(groups):
+                print(f" -- Loading replica {r + 1}/{len(groups)} on devices {group}")
+                container = ModelContainer(model, device_group = group)
+                containers.append(container)
+                yield from container.load(progress_callback = replica_progress(r, len(groups)))
+        container = containers[0]
+        with pool_lock:
+            loaded_model = container
+            resident_models[i] = container
+            resident_footprints[i] = footprint
+            resident_routers[i] = ReplicaRouter(containers)
         success = True
     except Exception as e:
-        loaded_model = None
+        for c in containers: c.unload()
+        weightcache.end_load()
         errormsg = type(e).__name__ + ":\n"
         errormsg += str(e)
+        canceled = isinstance(e, LoadCanceled)
         success = False
 
     if not success:
         gc.collect()
         torch.cuda.empty_cache()
-        result = { "result": "fail", "error": errormsg }
+        if canceled: result = { "result": "cancel" }
+        else: result = { "result": "fail", "error": errormsg }
         # print(json.dumps(result) + "\n")
         yield json.dumps(result) + "\n"
         return ""
 
+    global_state.update(last_model_uuid = i)
+
     # Notify about model load via callback
     if success and model_loaded_callback is not None:
         print("Calling model_loaded_callback with params:", {
@@ -503,7 +1126,7 @@ def load_model(data):
         })
         model_loaded_callback(model)
 
-    result = { "result": "ok" }
+    result = { "result": "ok", "load_times": container.load_times }
     # print(json.dumps(result) + "\n")
     yield json.dumps(result) + "\n"
 
@@ -511,12 +1134,13 @@ def load_model(data):
 def unload_model():
     global loaded_model
 
-    if loaded_model is not None:
-        loaded_model.unload()
-        loaded_model = None
+    global_state.update(last_model_uuid = None)
 
-    gc.collect()
-    torch.cuda.empty_cache()
+    with pool_lock:
+        for i in list(resident_models.keys()):
+            unload_resident(i)
+        loaded_model = None
+    publish_models()
 
     result = { "result": "ok" }
     return result
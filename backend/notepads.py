@@ -1,22 +1,17 @@
 import json, uuid, os, gc, glob, time
-import torch
-
-from exllamav2 import (
-    ExLlamaV2,
-    ExLlamaV2Config,
-    ExLlamaV2Cache,
-    ExLlamaV2Cache_8bit,
-    ExLlamaV2Tokenizer,
-)
-from exllamav2.generator import (
-    ExLlamaV2StreamingGenerator,
-    ExLlamaV2Sampler
-)
+
+# torch and exllamav2 are imported where they are used, see backend/runtime.py
 
 from backend.config import set_config_dir, global_state, config_filename
-from backend.models import get_loaded_model
+from backend.models import get_loaded_model, get_model_for, acquire_model, queue_generation, release_client, max_batch_size
 from backend.prompts import prompt_formats
 from backend.util import MultiTimer
+from backend.events import publish
+from backend.settings import get_settings
+from backend.streaming import FlushPolicy, text_packet
+from backend.lookup import LookupIndex, text_parts, begin_speculation, speculation_meta
+import backend.speculation as speculation
+import backend.jobs as jobs
 import threading
 
 notepad_list: dict or None = None
@@ -24,10 +19,8 @@ current_notepad = None
 
 # Cancel
 
-abort_event = threading.Event()
-def set_notepad_cancel_signal():
-    global abort_event
-    abort_event.set()
+def set_notepad_cancel_signal(job_id = None):
+    return jobs.cancel_jobs("notepad", job_id)
 
 
 def list_notepads():
@@ -64,12 +57,23 @@ def set_notepad(data):
     global current_notepad
     current_notepad = Notepad(data["notepad_uuid"])
     current_notepad.load()
+    global_state.update(current_notepad_uuid = current_notepad.notepad_uuid)
     result = { "notepad": current_notepad.to_json() }
     if get_loaded_model():
         result["tokenized_text"] = current_notepad.get_tokenized_text()
     return result
 
 
+def restore_notepad():
+    global current_notepad
+    i = global_state.current_notepad_uuid
+    if i is None: return
+    notepad = Notepad(i)
+    if not os.path.exists(notepad.filename()): return
+    notepad.load()
+    current_notepad = notepad
+
+
 def new_notepad():
     global current_notepad, notepad_list
     current_notepad = Notepad()
@@ -77,6 +81,8 @@ def new_notepad():
     # print(f"Created notepad {current_notepad.notepad_uuid}")
     filename = current_notepad.save()
     notepad_list[current_notepad.notepad_uuid] = (current_notepad.name, filename)
+    global_state.update(current_notepad_uuid = current_notepad.notepad_uuid)
+    publish("notepads")
     return current_notepad.to_json()
 
 
@@ -86,8 +92,11 @@ def delete_notepad(d_notepad):
         filename = notepad_list[d_notepad][1]
         os.remove(filename)
         del notepad_list[d_notepad]
+    release_client(d_notepad)
     if current_notepad is not None and current_notepad.notepad_uuid == d_notepad:
         current_notepad = None
+        global_state.update(current_notepad_uuid = None)
+    publish("notepads")
 
 
 def get_default_notepad_settings():
@@ -113,7 +122,10 @@ def get_default_notepad_settings():
         "stop_conditions": [ { "text": "</s>", "inclusive": False } ],
         "dry_base": 1.75,
         "dry_multiplier": 0.0,
-        "dry_range": 1024
+        "dry_range": 1024,
+        "grammar_mode": "None",
+        "grammar": "",
+        "model_uuid": ""
     }
 
 
@@ -123,12 +135,14 @@ class Notepad:
     notepad_uuid: str = None
     text = ""
     settings: {} = None
+    branches: {} or None = None
 
     context_head = 0
 
     def __init__(self, notepad_uuid = None):
         self.notepad_uuid = notepad_uuid
         self.context_head = 0
+        self.lookup_index = LookupIndex()
 
 
     def filename(self):
@@ -148,6 +162,7 @@ class Notepad:
         j["name"] = self.name
         j["text"] = self.text
         j["settings"] = self.settings
+        if self.branches is not None: j["branches"] = self.branches
         return j
 
 
@@ -155,6 +170,7 @@ class Notepad:
         self.name = j["name"]
         self.notepad_uuid = j["notepad_uuid"]
         self.text = j["text"]
+        self.branches = j.get("branches")
         settings = get_default_notepad_settings()
         if "settings" in j: settings.update(j["settings"])
         self.settings = settings
@@ -169,6 +185,7 @@ class Notepad:
         notepad_list[self.notepad_uuid] = (data["new_name"], notepad_list[self.notepad_uuid][1])
         self.name = data["new_name"]
         self.save()
+        publish("notepads")
 
 
     def save(self):
@@ -191,13 +208,18 @@ class Notepad:
         self.save()
 
 
+    def get_model(self):
+        return get_model_for(self.settings.get("model_uuid"), self.notepad_uuid)
+
+
     def set_text(self, text):
         self.text = text
+        self.branches = None
         self.save()
 
 
     def get_tokenized_text(self):
-        m = get_loaded_model()
+        m = self.get_model()
         if not m: return None
         tokens = m.tokenizer.encode(self.text, encode_special_tokens = True)[0].tolist()
         id_to_piece = m.tokenizer.get_id_to_piece_list()
@@ -212,6 +234,7 @@ class Notepad:
 
 
     def get_gen_settings(self):
+        from exllamav2.generator import ExLlamaV2Sampler
 
         gen_settings = ExLlamaV2Sampler.Settings()
         gen_settings.temperature = self.settings["temperature"]
@@ -245,16 +268,31 @@ class Notepad:
 
 
     def generate_single_token(self, data):
-        global abort_event
 
-        if get_loaded_model() is None:
+        # A job like any other generation, so it waits for this notepad's replica and can be canceled
+
+        job = jobs.create_job("notepad", self.notepad_uuid)
+        try:
+            with acquire_model(self.settings.get("model_uuid"), self.notepad_uuid) as replica:
+                job.start()
+                if job.token.is_set():
+                    packet = { "result": "cancel" }
+                    return packet
+                return self.generate_single_token_on(replica.backend if replica else None, data, job.token)
+        finally:
+            jobs.finish_job(job)
+
+
+    def generate_single_token_on(self, loaded_model, data, abort_event):
+
+        if loaded_model is None:
             packet = { "result": "fail", "error": "No model loaded." }
             return packet
 
-        model = get_loaded_model().model
-        generator = get_loaded_model().generator
-        tokenizer = get_loaded_model().tokenizer
-        cache = get_loaded_model().cache
+        model = loaded_model.model
+        generator = loaded_model.generator
+        tokenizer = loaded_model.tokenizer
+        cache = loaded_model.cache
 
         # Sampling settings
 
@@ -279,8 +317,10 @@ class Notepad:
         context_ids = context_ids[:, self.context_head:]
         # print(head_ideal, self.context_head)
 
-        # Generate
+        # Generate, a single token has nothing to gain from n-gram speculation
 
+        begin_speculation(generator, "None")
+        loaded_model.loras.activate(None)
         generator.begin_stream_ex(context_ids, gen_settings, token_healing = True, abort_event = abort_event)
         generator.set_stop_conditions([])
 
@@ -288,6 +328,9 @@ class Notepad:
 
         chunk = ""
         while True:
+            if abort_event.is_set():
+                packet = { "result": "cancel" }
+                return packet
             chunk_, eos, tokens = generator.stream()
             chunk += chunk_
             if tokens.shape[-1] != 0 or eos: break
@@ -311,35 +354,18 @@ class Notepad:
         return packet
 
 
-    def generate(self, data):
-        global abort_event
-
-        if get_loaded_model() is None:
-            packet = { "result": "fail", "error": "No model loaded." }
-            return packet
-
-        model = get_loaded_model().model
-        generator = get_loaded_model().generator
-        tokenizer = get_loaded_model().tokenizer
-        cache = get_loaded_model().cache
-
-        # Sampling settings
-
-        gen_settings = self.get_gen_settings()
-
+    def get_banned_strings(self):
         banned_strings = self.settings.get("banned_strings", "").strip()
         banned_strings = banned_strings.split("\n")
         banned_strings = [bs.strip() for bs in banned_strings if bs.strip()]
         if len(banned_strings) == 0: banned_strings = None
+        return banned_strings
 
-        # Context
-
-        context_str = data["context"]
-        context_post_str = data["context_post"]
-        full_context_ids = tokenizer.encode(context_str, encode_special_tokens = True)
-        build_str = ""
 
-        # Stop conditions
+    def get_stop_conditions(self, tokenizer):
+        """
+        Stop conditions as (exclusive, inclusive), inclusive ones are strings kept in the output
+        """
 
         exclusive_sc = []
         inclusive_sc = []
@@ -353,6 +379,99 @@ class Notepad:
                     exclusive_sc.append(tokenizer.extended_piece_to_id[text])
                 else:
                     exclusive_sc.append(text)
+        return exclusive_sc, inclusive_sc
+
+
+    def generate(self, data, stream, policy = None):
+
+        # Each generation is a job with its own cancel token, queued on this notepad's replica. Its packets go to stream
+        # (a DecoupledStream), starting with the job id
+
+        job = jobs.create_job("notepad", self.notepad_uuid)
+        packet = { "result": "job", "job_id": job.job_id }
+        stream.put(json.dumps(packet) + "\n")
+        queue_generation(self.settings.get("model_uuid"), self.notepad_uuid, stream, lambda replica: self.run_job(job, replica, data, policy))
+
+
+    def run_job(self, job, replica, data, policy = None):
+
+        try:
+            job.start()
+            if job.token.is_set():
+                packet = { "result": "cancel" }
+                yield json.dumps(packet) + "\n"
+                return packet
+            t = time.time()
+            packet = yield from jobs.tracked(job, self.generate_on(replica.backend if replica else None, data, job.token, policy))
+            if replica is not None and packet["result"] == "ok":
+                replica.record(packet["gen_tokens"], time.time() - t)
+        finally:
+            jobs.finish_job(job)
+        return packet
+
+
+    def generate_on(self, loaded_model, data, abort_event, policy = None):
+        import torch
+        from backend.grammarfilter import grammar_filters, grammar_meta
+
+        if loaded_model is None:
+            packet = { "result": "fail", "error": "No model loaded." }
+            return packet
+
+        if policy is None: policy = FlushPolicy.from_settings(get_settings())
+
+        model = loaded_model.model
+        generator = loaded_model.generator
+        tokenizer = loaded_model.tokenizer
+        cache = loaded_model.cache
+
+        # Grammar the generated text must follow, from the cursor
+
+        try:
+            gfilters, grammar_cached = grammar_filters(model, tokenizer, self.settings, [], max(data.get("branches", 1), 1))
+        except ValueError as e:
+            packet = { "result": "fail", "error": str(e) }
+            yield json.dumps(packet) + "\n"
+            return packet
+
+        # Several branches are generated as one batch
+
+        if data.get("branches", 1) > 1:
+            return (yield from self.generate_branches(loaded_model, data, abort_event, policy, gfilters, grammar_cached))
+
+        # Sampling settings
+
+        gen_settings = self.get_gen_settings()
+        compact = data.get("framing") == "compact"
+        banned_strings = self.get_banned_strings()
+
+        # Context
+
+        context_str = data["context"]
+        context_post_str = data["context_post"]
+        full_context_ids = tokenizer.encode(context_str, encode_special_tokens = True)
+        build_str = ""
+        chunk_buffer = ""
+
+        # Speculation, prompt lookup also indexes the text after the cursor and before the context window
+
+        model_uuid = loaded_model.model_dict["model_uuid"]
+        auto_speculation = loaded_model.speculative_mode == "Auto"
+        speculative_mode = speculation.resolve_mode(loaded_model.speculative_mode, self.notepad_uuid, model_uuid)
+        index = None
+        if speculative_mode == "Prompt lookup":
+            index = self.lookup_index.update(generator, tokenizer, text_parts(context_str + context_post_str))
+        begin_speculation(generator, speculative_mode, index)
+        draft_time = loaded_model.draft_time
+
+        # Notepads generate with the base model, resetting the cache if the last chat generation used an adapter
+
+        loaded_model.loras.activate(None)
+        gen_start = time.time()
+
+        # Stop conditions
+
+        exclusive_sc, inclusive_sc = self.get_stop_conditions(tokenizer)
 
         # Truncate past
 
@@ -363,12 +482,10 @@ class Notepad:
 
         # Generator loop
 
-        abort_event.clear()
-
         total_tokens = 0
         max_tokens = self.settings["maxtokens"]
         prev_head = -1
-        token_healing = True
+        token_healing = len(gfilters) == 0
         while True:
 
             if abort_event.is_set(): break
@@ -384,9 +501,9 @@ class Notepad:
             if self.context_head != prev_head:
                 prev_head = self.context_head
                 context_ids = full_context_ids[:, self.context_head:]
-                generator.begin_stream_ex(context_ids, gen_settings, token_healing = token_healing, abort_event = abort_event, banned_strings = banned_strings)
+                generator.begin_stream_ex(context_ids, gen_settings, token_healing = token_healing, abort_event = abort_event, banned_strings = banned_strings, filters = gfilters)
                 if abort_event.is_set():
-                    abort_event.clear()
+                    if chunk_buffer != "": yield text_packet("stream_chunk", chunk_buffer, compact)
                     packet = {}
                     packet["result"] = "cancel"
                     yield json.dumps(packet) + "\n"
@@ -407,7 +524,7 @@ class Notepad:
 
             # Stop conditions
 
-            total_tokens += 1
+            total_tokens += max(tokens.shape[-1], 1)
             if total_tokens >= max_tokens: eos = True
             else:
                 for s in inclusive_sc:
@@ -421,14 +538,17 @@ class Notepad:
 
             # Stream
 
-            if chunk != "":
-                packet = {}
-                packet["result"] = "stream_chunk"
-                packet["text"] = chunk
-                yield json.dumps(packet) + "\n"
+            chunk_buffer += chunk
+            flush = policy.add(chunk)
+            if chunk_buffer != "" and (flush or eos):
+                yield text_packet("stream_chunk", chunk_buffer, compact)
+                chunk_buffer = ""
+                policy.flushed()
 
             if eos: break
 
+        if chunk_buffer != "": yield text_packet("stream_chunk", chunk_buffer, compact)
+
         # Save
 
         self.save()
@@ -437,7 +557,6 @@ class Notepad:
 
         packet = {}
         if abort_event.is_set():
-            abort_event.clear()
             packet["result"] = "cancel"
         else:
             packet["result"] = "ok"
@@ -446,9 +565,135 @@ class Notepad:
 
         packet = {}
         packet["result"] = "ok"
+        packet["gen_tokens"] = total_tokens
+        packet["gen_time"] = time.time() - gen_start
+        packet["draft_time"] = loaded_model.draft_time - draft_time
+        packet["canceled"] = abort_event.is_set()
+        packet.update(speculation_meta(generator, speculative_mode))
+        speculation.record(model_uuid, "Notepad", packet, self.notepad_uuid, auto_speculation)
+        if len(gfilters) > 0: packet.update(grammar_meta(gfilters, grammar_cached))
         return packet
 
 
+    def generate_branches(self, loaded_model, data, abort_event, policy, gfilters, grammar_cached):
+        from exllamav2.generator import ExLlamaV2DynamicJob
+
+        model = loaded_model.model
+        tokenizer = loaded_model.tokenizer
+        num_branches = min(int(data["branches"]), max_batch_size)
+        compact = data.get("framing") == "compact"
+        max_tokens = self.settings["maxtokens"]
+
+        # The text isn't changed until a branch is accepted, branches are kept with the notepad until then
+
+        context_str = data["context"]
+        context_post_str = data["context_post"]
+        self.text = context_str + context_post_str
+        self.branches = { "position": len(context_str), "texts": [""] * num_branches }
+
+        # All branches share the context, its pages are deduplicated so it is prefilled once. Each needs room for its
+        # own continuation
+
+        past_tokens = model.config.max_seq_len - num_branches * (max_tokens + 256)
+        if past_tokens < 256:
+            packet = { "result": "fail", "error": f"Not enough context for {num_branches} branches of {max_tokens} tokens." }
+            yield json.dumps(packet) + "\n"
+            return packet
+        context_ids = tokenizer.encode(context_str, encode_special_tokens = True)[:, -past_tokens:]
+
+        try:
+            generator = loaded_model.get_batch_generator()
+            generator.set_loras(None)
+        except Exception as e:
+            packet = { "result": "fail", "error": type(e).__name__ + ":\n" + str(e) }
+            yield json.dumps(packet) + "\n"
+            return packet
+
+        exclusive_sc, inclusive_sc = self.get_stop_conditions(tokenizer)
+        gen_settings = self.get_gen_settings()
+        banned_strings = self.get_banned_strings()
+
+        for i in range(num_branches):
+            job = ExLlamaV2DynamicJob(
+                input_ids = context_ids,
+                gen_settings = gen_settings.clone(),
+                max_new_tokens = max_tokens,
+                stop_conditions = exclusive_sc + inclusive_sc,
+                banned_strings = banned_strings,
+                filters = gfilters[i:i + 1],
+                identifier = i
+            )
+            generator.enqueue(job)
+
+        # Stream
+
+        buffers = {}
+        total_tokens = 0
+        gen_start = time.time()
+        try:
+            while generator.num_remaining_jobs():
+
+                if abort_event.is_set():
+                    generator.clear_queue()
+                    break
+
+                flush = False
+                for r in generator.iterate():
+                    if r["stage"] != "streaming": continue
+                    branch = r["identifier"]
+                    text = r.get("text", "")
+                    if r["eos"]:
+                        flush = True
+                        total_tokens += r.get("new_tokens", 0)
+                        # The job stops before a stop string, inclusive ones belong to the text
+                        if r.get("eos_reason") == "stop_string" and r.get("eos_triggering_string") in inclusive_sc:
+                            text += r["eos_triggering_string"]
+                    buffers[branch] = buffers.get(branch, "") + text
+                    self.branches["texts"][branch] += text
+                    flush = policy.add(text) or flush
+
+                if flush:
+                    for branch, text in buffers.items():
+                        if text: yield text_packet("stream_branch", text, compact, branch = branch)
+                    buffers = {}
+                    policy.flushed()
+        finally:
+            loaded_model.invalidate_cache()
+
+        for branch, text in buffers.items():
+            if text: yield text_packet("stream_branch", text, compact, branch = branch)
+
+        self.save()
+
+        packet = {}
+        packet["result"] = "cancel" if abort_event.is_set() else "ok"
+        packet["branches"] = self.branches["texts"]
+        yield json.dumps(packet) + "\n"
+
+        packet = {}
+        packet["result"] = "ok"
+        packet["gen_tokens"] = total_tokens
+        packet["gen_time"] = time.time() - gen_start
+        if len(gfilters) > 0: packet.update(grammar_meta(gfilters, grammar_cached))
+        return packet
+
+
+    def accept_branch(self, data):
+        """
+        Insert branch data["branch"] at the position it was generated from, returning the new text and the position
+        after the insertion
+        """
+
+        if self.branches is None or not 0 <= data["branch"] < len(self.branches["texts"]):
+            return { "result": "fail", "error": "No such branch." }
+        position = self.branches["position"]
+        branch_text = self.branches["texts"][data["branch"]]
+        self.text = self.text[:position] + branch_text + self.text[position:]
+        self.branches = None
+        self.save()
+        return { "result": "ok", "text": self.text, "position": position + len(branch_text) }
+
+
 
 
 
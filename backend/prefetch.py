@@ -0,0 +1,121 @@
+import json, os, re, struct, time
+from concurrent.futures import ThreadPoolExecutor
+
+# Read-ahead of safetensors byte ranges into the OS page cache while a model loads. Ranges are grouped per module in
+# the order the loader visits them, and a small thread pool keeps a window of upcoming modules in flight so the GPU
+# isn't left waiting on I/O between modules
+
+read_chunk_size = 16 * 1024**2
+
+layer_key = re.compile(r"^(.*\.layers\.\d+)\.")
+
+
+def read_safetensors_index(model_dir):
+    """
+    Map every tensor name in model_dir to (filename, start, end) byte offsets in its .safetensors file
+    """
+
+    index = {}
+    for f in sorted(os.listdir(model_dir)):
+        if not f.endswith(".safetensors"): continue
+        filename = os.path.join(model_dir, f)
+        with open(filename, "rb") as fp:
+            header_size = struct.unpack("<Q", fp.read(8))[0]
+            header = json.loads(fp.read(header_size))
+        data_start = 8 + header_size
+        for k, v in header.items():
+            if k == "__metadata__": continue
+            begin, end = v["data_offsets"]
+            index[k] = (filename, data_start + begin, data_start + end)
+    return index
+
+
+def module_prefix(key):
+    # Layer norms etc. are loaded with their attention/MLP modules, so read ahead the whole layer at once
+    m = layer_key.match(key + ".")
+    return m.group(1) + "." if m else key + "."
+
+
+def module_ranges(module_keys, index):
+    """
+    Merged byte ranges per module, each tensor assigned to the first module whose prefix matches
+    """
+
+    prefixes = [module_prefix(k) for k in module_keys]
+    claimed = set()
+    ranges = []
+    for prefix in prefixes:
+        spans = {}
+        for name, (filename, begin, end) in index.items():
+            if name in claimed or not name.startswith(prefix): continue
+            claimed.add(name)
+            spans.setdefault(filename, []).append((begin, end))
+        merged = []
+        for filename, s in spans.items():
+            s.sort()
+            b, e = s[0]
+            for nb, ne in s[1:]:
+                if nb <= e: e = max(e, ne)
+                else:
+                    merged.append((filename, b, e))
+                    b, e = nb, ne
+            merged.append((filename, b, e))
+        ranges.append(merged)
+    return ranges
+
+
+def read_range(filename, begin, end):
+    with open(filename, "rb", buffering = 0) as fp:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fp.fileno(), begin, end - begin, os.POSIX_FADV_WILLNEED)
+        fp.seek(begin)
+        buffer = bytearray(min(read_chunk_size, end - begin))
+        remaining = end - begin
+        while remaining > 0:
+            n = fp.readinto(memoryview(buffer)[:min(remaining, len(buffer))])
+            if not n: break
+            remaining -= n
+
+
+class Prefetcher:
+
+    ranges: list
+    window: int
+    futures: dict
+
+    def __init__(self, model_dir, module_keys, window, threads):
+        self.ranges = module_ranges(module_keys, read_safetensors_index(model_dir))
+        self.window = window
+        self.futures = {}
+        self.executor = ThreadPoolExecutor(max_workers = threads, thread_name_prefix = "prefetch")
+        self.schedule(0, window)
+
+
+    def schedule(self, first, last):
+        for i in range(first, min(last, len(self.ranges))):
+            if i in self.futures: continue
+            self.futures[i] = [self.executor.submit(read_range, *r) for r in self.ranges[i]]
+
+
+    def advance(self, next_module):
+        """
+        Called after each module is loaded. Waits for the next module's ranges, returning the I/O wait in seconds,
+        and extends the read-ahead window
+        """
+
+        t = time.time()
+        for f in self.futures.get(next_module, []):
+            try:
+                f.result()
+            except OSError:
+                pass
+        io_wait = time.time() - t
+
+        self.schedule(next_module + 1, next_module + 1 + self.window)
+        return io_wait
+
+
+    def close(self):
+        for fs in self.futures.values():
+            for f in fs: f.cancel()
+        self.executor.shutdown(wait = False)
@@ -1,4 +1,8 @@
 
+import backend.chattemplates as chattemplates
+from backend.util import tokenizer_key
+
+
 class PromptFormat:
 
     def __init__(self):
@@ -23,6 +27,10 @@ class PromptFormat:
     def supports_system_prompt():
         return True
 
+    def cache_key(self):
+        # Distinguishes instances of one format that format differently, see get_template
+        return None
+
 
 class PromptFormat_raw(PromptFormat):
 
@@ -533,6 +541,31 @@ class PromptFormat_granite(PromptFormat):
         return True
 
 
+class PromptFormat_template(PromptFormat):
+
+    description = "The model's own chat template, from its tokenizer_config.json"
+
+    def __init__(self, chat_template = None):
+        super().__init__()
+        self.chat_template = chat_template
+
+    def is_instruct(self):
+        return True
+
+    def stop_conditions(self, tokenizer, settings):
+        end = chattemplates.turn_end(self.chat_template) if self.chat_template else None
+        return \
+            [tokenizer.eos_token_id] + \
+            ([end] if end else [])
+
+    def format(self, prompt, response, system_prompt, settings):
+        if self.chat_template is None: raise ValueError("The model has no chat template.")
+        return chattemplates.render_turn(self.chat_template, prompt, response, system_prompt)
+
+    def cache_key(self):
+        return self.chat_template["template"] if self.chat_template else None
+
+
 prompt_formats = \
 {
     "Chat-RP": PromptFormat_raw,
@@ -552,6 +585,7 @@ prompt_formats = \
     "Mistral V1": PromptFormat_mistralv1,
     "Mistral V2/V3": PromptFormat_mistralv2v3,
     "Mistral V3 (Tekken)": PromptFormat_mistralTekken,
+    chattemplates.template_format_name: PromptFormat_template,
 }
 
 def list_prompt_formats():
@@ -564,3 +598,110 @@ def list_prompt_formats():
         for k, v in prompt_formats.items()
     ]
     return prompts
+
+
+# Token-level templates. A format's fixed parts (special tokens, role headers) are encoded once per tokenizer by
+# formatting with placeholders in place of the prompt, response and system prompt, and only the text in between is
+# tokenized for each turn, always with encode_special_tokens = False so text that looks like a special token stays
+# text. Spaces at the end of a fixed part are encoded with the text that follows, as a BPE tokenizer would. A template
+# is only used if it encodes a probe turn exactly like formatting and encoding the whole string does, otherwise the
+# format falls back to the latter
+
+template_slots = ["prompt", "response", "system_prompt"]
+template_placeholders = { "prompt": "\ue000", "response": "\ue001", "system_prompt": "\ue002" }
+template_probes = { "prompt": "Hello, who are you?", "response": "I am an assistant.", "system_prompt": "Answer briefly." }
+template_pad = "\u3000"  # Whitespace, to tell which slots the format strips
+
+template_cache = {}
+max_templates = 256
+
+
+class PromptTemplate:
+
+    parts: list
+    stripped: dict
+
+    def __init__(self, prompt_format, tokenizer, values, settings):
+        """
+        values has the placeholder for slots with text, and the literal value for slots that are None or blank, since
+        formats treat those differently
+        """
+
+        padded = { k: template_pad + v + template_pad if v in template_placeholders.values() else v for k, v in values.items() }
+        text = prompt_format.format(padded["prompt"], padded["response"], padded["system_prompt"], settings)
+
+        self.stripped = {}
+        for slot, placeholder in template_placeholders.items():
+            if values[slot] != placeholder: continue
+            padded_placeholder = template_pad + placeholder + template_pad
+            self.stripped[slot] = padded_placeholder not in text
+            text = text.replace(padded_placeholder, placeholder)
+
+        slot_of = { v: k for k, v in template_placeholders.items() }
+        self.parts = []
+        fixed = ""
+        for c in text + "\0":
+            if c in slot_of or c == "\0":
+                spaces = len(fixed) - len(fixed.rstrip(" ")) if c != "\0" else 0
+                if len(fixed) > spaces:
+                    ids = tokenizer.encode(fixed[:len(fixed) - spaces], encode_special_tokens = prompt_format.encode_special_tokens())
+                    self.parts.append(ids)
+                if c != "\0": self.parts.append((slot_of[c], fixed[len(fixed) - spaces:]))
+                fixed = ""
+            else:
+                fixed += c
+
+
+    def encode(self, tokenizer, texts):
+        import torch
+
+        ids = []
+        for part in self.parts:
+            if isinstance(part, tuple):
+                slot, spaces = part
+                text = texts[slot].strip() if self.stripped[slot] else texts[slot]
+                if spaces + text: ids.append(tokenizer.encode(spaces + text, encode_special_tokens = False))
+            else:
+                ids.append(part)
+        if len(ids) == 0: return torch.empty((1, 0), dtype = torch.long)
+        return torch.cat(ids, dim = -1)
+
+
+def get_template(prompt_format, tokenizer, values, settings):
+    import torch
+
+    key = (type(prompt_format), prompt_format.cache_key(), tokenizer_key(tokenizer), tuple(values[slot] for slot in template_slots))
+    if key in template_cache: return template_cache[key]
+
+    template = PromptTemplate(prompt_format, tokenizer, values, settings)
+    probe = { slot: template_probes[slot] if values[slot] == template_placeholders[slot] else values[slot] for slot in template_slots }
+    expected = tokenizer.encode(prompt_format.format(probe["prompt"], probe["response"], probe["system_prompt"], settings),
+                                encode_special_tokens = prompt_format.encode_special_tokens())
+    if not torch.equal(template.encode(tokenizer, probe), expected): template = None
+
+    if len(template_cache) >= max_templates: template_cache.clear()
+    template_cache[key] = template
+    return template
+
+
+def forget_templates(tokenizer):
+    """
+    Drop the cached templates of a tokenizer that is being unloaded
+    """
+
+    key = tokenizer_key(tokenizer)
+    for k in list(template_cache.keys()):
+        if k[2] == key: template_cache.pop(k, None)
+
+
+def encode_turn(prompt_format, tokenizer, prompt, response, system_prompt, settings):
+    """
+    Token IDs of prompt_format.format(prompt, response, system_prompt, settings)
+    """
+
+    texts = { "prompt": prompt, "response": response, "system_prompt": system_prompt }
+    values = { slot: template_placeholders[slot] if v is not None and v.strip() != "" else v for slot, v in texts.items() }
+    template = get_template(prompt_format, tokenizer, values, settings)
+    if template is not None: return template.encode(tokenizer, texts)
+    text = prompt_format.format(prompt, response, system_prompt, settings)
+    return tokenizer.encode(text, encode_special_tokens = prompt_format.encode_special_tokens())
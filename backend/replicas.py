@@ -0,0 +1,222 @@
+import queue, threading, time
+from collections import deque
+from contextlib import contextmanager
+
+# Data-parallel replicas of one model. Each replica is an independent backend (a ModelContainer loaded on its own
+# device group) with its own lock, so sessions on different replicas generate concurrently. Sessions are assigned to
+# the least loaded replica and then stay on it, since the replica's cache may still hold their context. Nothing here
+# touches torch, any object can serve as a backend.
+#
+# Generations are tasks submitted to their replica's queue. One worker thread per replica runs them in order, so a
+# generation waiting for its replica is a queue entry rather than a blocked thread. acquire() holds the same lock as
+# the worker, for the few callers that need a replica from their own thread (autotuning, single tokens)
+
+throughput_window = 60.0
+
+
+def parse_device_groups(replicas):
+    """
+    Parse a replica spec like "0;1" or "0,1;2,3" into device groups, [[0], [1]] or [[0, 1], [2, 3]]. Empty spec
+    means no replicas. Empty groups, stray commas and devices that aren't numbers raise ValueError
+    """
+
+    if replicas is None or replicas.strip() == "": return []
+    groups = []
+    for group in replicas.split(";"):
+        if group.strip() == "": raise ValueError(f"Empty device group in replica spec: {replicas}")
+        devices = []
+        for d in group.split(","):
+            if not d.strip().isdigit(): raise ValueError(f"Bad device \"{d.strip()}\" in replica spec: {replicas}")
+            devices.append(int(d))
+        groups.append(devices)
+    used = [d for g in groups for d in g]
+    if len(used) != len(set(used)): raise ValueError(f"Device used by more than one replica: {replicas}")
+    return groups
+
+
+def group_split(devices, budgets, weights = 0, cache = 0, scratch = 0):
+    """
+    GPU split in GB confining a model to devices, given free bytes per device. The loader fills devices in order with
+    weights up to their split and the cache is allocated afterwards next to each layer, so a device's split is the part
+    of its free memory left for weights once scratch bytes and its share of the cache (cache bytes for weights bytes of
+    layers) are set aside
+    """
+
+    weights_fraction = weights / (weights + cache) if weights + cache > 0 else 1.0
+    split = [0.0] * len(budgets)
+    for d in devices:
+        if d >= len(budgets): raise ValueError(f"No such device: {d}")
+        split[d] = max(budgets[d] - scratch, 0) * weights_fraction / 1024**3
+    return split
+
+
+class Replica:
+
+    index: int
+    backend: object
+    lock: threading.Lock
+    sessions: set
+    active: int
+    tokens: int
+    busy_time: float
+
+    def __init__(self, index, backend):
+        self.index = index
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.sessions = set()
+        self.active = 0
+        self.tokens = 0
+        self.busy_time = 0.0
+        self.events = deque()
+        self.tasks = queue.Queue()
+        self.worker = None
+        self.closed = False
+
+
+    def submit(self, task):
+        """
+        Queue task(replica) for this replica's worker, started on first use
+        """
+
+        self.tasks.put(task)
+        if self.worker is None:
+            self.worker = threading.Thread(target = self.work, name = f"replica_{self.index}", daemon = True)
+            self.worker.start()
+
+
+    def work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None: return
+            try:
+                with self.lock:
+                    # Tasks still queued when the model was unloaded get no replica
+                    task(None if self.closed else self)
+            except Exception as e:
+                print(f" !! Replica {self.index} task failed: {type(e).__name__}: {e}")
+
+
+    def load(self):
+        return self.active, len(self.sessions), self.index
+
+
+    def record(self, tokens, elapsed):
+        self.tokens += tokens
+        self.busy_time += elapsed
+        self.events.append((time.time(), tokens))
+
+
+    def recent_tokens(self, now):
+        while len(self.events) > 0 and self.events[0][0] < now - throughput_window:
+            self.events.popleft()
+        return sum(t for _, t in self.events)
+
+
+    def status(self, now):
+        s = {}
+        s["index"] = self.index
+        s["active"] = self.active
+        s["sessions"] = len(self.sessions)
+        s["tokens"] = self.tokens
+        s["speed"] = self.tokens / self.busy_time if self.busy_time > 0 else 0.0
+        s["throughput"] = self.recent_tokens(now) / throughput_window
+        return s
+
+
+class ReplicaRouter:
+
+    replicas: list
+    assignments: dict
+
+    def __init__(self, backends):
+        self.replicas = [Replica(i, b) for i, b in enumerate(backends)]
+        self.assignments = {}
+        self.router_lock = threading.Lock()
+
+
+    def backends(self):
+        return [r.backend for r in self.replicas]
+
+
+    def assign(self, client_id = None):
+        """
+        Replica for client_id: the one it was assigned before, or the least loaded one by active generations, then
+        number of assigned sessions
+        """
+
+        with self.router_lock:
+            replica = self.assignments.get(client_id) if client_id is not None else None
+            if replica is None:
+                replica = min(self.replicas, key = Replica.load)
+                if client_id is not None:
+                    self.assignments[client_id] = replica
+                    replica.sessions.add(client_id)
+            return replica
+
+
+    def release(self, client_id):
+        with self.router_lock:
+            replica = self.assignments.pop(client_id, None)
+            if replica is not None: replica.sessions.discard(client_id)
+
+
+    def submit(self, task, client_id = None):
+        """
+        Queue task(replica) on client_id's replica and return without waiting. The task gets None instead of the
+        replica if the model is unloaded before its turn
+        """
+
+        replica = self.assign(client_id)
+
+        def run(r):
+            try:
+                task(r)
+            finally:
+                with self.router_lock:
+                    replica.active -= 1
+
+        with self.router_lock:
+            replica.active += 1
+            closed = replica.closed
+            if not closed: replica.submit(run)
+        if closed: run(None)
+
+
+    def close(self):
+        """
+        Stop the replicas' workers after the tasks already queued, which get None
+        """
+
+        with self.router_lock:
+            for r in self.replicas:
+                r.closed = True
+                if r.worker is not None: r.tasks.put(None)
+
+
+    @contextmanager
+    def acquire(self, client_id = None):
+        """
+        Hold client_id's replica for the duration of one generation
+        """
+
+        replica = self.assign(client_id)
+        with self.router_lock:
+            replica.active += 1
+        try:
+            with replica.lock:
+                yield replica
+        finally:
+            with self.router_lock:
+                replica.active -= 1
+
+
+    def status(self):
+        now = time.time()
+        with self.router_lock:
+            replicas = [r.status(now) for r in self.replicas]
+        s = {}
+        s["replicas"] = replicas
+        s["tokens"] = sum(r["tokens"] for r in replicas)
+        s["throughput"] = sum(r["throughput"] for r in replicas)
+        return s
@@ -0,0 +1,105 @@
+import threading
+from collections import OrderedDict
+
+from exllamav2.generator.filters import ExLlamaV2Filter
+
+from backend.util import tokenizer_key
+
+# Imported where it is used (Session.generate_on), like exllamav2 itself, see backend/runtime.py
+
+# Speaker selection for chat formats that aren't instruct. The role list is compiled once per tokenizer into a table
+# from the text matched so far to the tokens allowed next, the tokens that complete a role and the text each token leads
+# to, so a generation only does dictionary lookups instead of walking the vocabulary trie per sampled token. Tables are
+# kept in a small LRU shared by all sessions, a session's roles rarely change between generations
+
+max_compiled = 16
+
+compiled: OrderedDict = OrderedDict()
+compiled_lock = threading.Lock()
+
+
+class CompiledRoles:
+
+    options: tuple
+    table: dict
+
+    def __init__(self, tokenizer, options):
+        self.options = options
+        self.table = {}
+
+        char_trie = tokenizer.get_char_trie()
+        pending = [""]
+        while len(pending) > 0:
+            matched = pending.pop()
+            if matched in self.table: continue
+            pass_tokens = set()
+            end_tokens = set()
+            transitions = {}
+            for option in options:
+                if not option.startswith(matched) or option == matched: continue
+                rest = option[len(matched):]
+                w = char_trie
+                for i, c in enumerate(rest):
+                    if c not in w.children: break
+                    w = w.children[c]
+                    if len(w.leaf) == 0: continue
+                    pass_tokens.update(w.leaf)
+                    following = matched + rest[:i + 1]
+                    for token in w.leaf: transitions[token] = following
+                    if i == len(rest) - 1: end_tokens.update(w.leaf)
+                    else: pending.append(following)
+            self.table[matched] = (pass_tokens, end_tokens, transitions)
+
+
+def get_compiled(tokenizer, options):
+    key = (tokenizer_key(tokenizer), options)
+    with compiled_lock:
+        if key in compiled:
+            compiled.move_to_end(key)
+            return compiled[key]
+    c = CompiledRoles(tokenizer, options)
+    with compiled_lock:
+        compiled[key] = c
+        while len(compiled) > max_compiled: compiled.popitem(last = False)
+    return c
+
+
+class RoleFilter(ExLlamaV2Filter):
+    """
+    Constrains generation to exactly one of roles, e.g. "Bob:", ending the stream when it is complete
+    """
+
+    roles: tuple
+    matched: str
+
+    def __init__(self, model, tokenizer, roles):
+        super().__init__(model, tokenizer)
+        self.roles = tuple(roles)
+        self.compiled = None
+        self.matched = ""
+
+
+    def clone(self, c = None):
+        if c is None: c = RoleFilter.__new__(RoleFilter)
+        super().clone(c)
+        c.roles = self.roles
+        c.compiled = self.compiled
+        c.matched = self.matched
+        return c
+
+
+    def begin(self, prefix_str = ""):
+        # With token healing the healed token's text precedes the role
+        self.compiled = get_compiled(self.tokenizer, tuple(prefix_str + r for r in self.roles))
+        self.matched = ""
+
+
+    def feed(self, token):
+        # The generator passes the sampled token as a 1x1 tensor, the table is keyed by int
+        if not isinstance(token, int): token = token.item()
+        self.matched = self.compiled.table[self.matched][2].get(token, self.matched)
+
+
+    def next(self):
+        pass_tokens, end_tokens, _ = self.compiled.table.get(self.matched, (set(), set(), {}))
+        return pass_tokens, end_tokens
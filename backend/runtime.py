@@ -0,0 +1,60 @@
+import importlib, threading, time
+
+# Heavy inference stack. Importing these pulls in CUDA/torch and dominates cold start, so they are imported on a
+# background thread (or on first use) while the HTTP server and all persistence endpoints are already serving
+
+components = \
+[
+    ("torch", "torch"),
+    ("pynvml", "pynvml"),
+    ("exllamav2", "exllamav2"),
+    ("generator", "exllamav2.generator"),
+    ("filters", "exllamav2.generator.filters"),
+]
+
+component_status = {}
+for name, module in components:
+    component_status[name] = { "module": module, "ready": False, "error": None, "import_time": None }
+
+import_lock = threading.Lock()
+import_thread: threading.Thread or None = None
+runtime_ready = threading.Event()
+
+
+def import_components():
+
+    for name, module in components:
+        status = component_status[name]
+        t = time.time()
+        try:
+            importlib.import_module(module)
+            status["ready"] = True
+        except Exception as e:
+            status["error"] = type(e).__name__ + ": " + str(e)
+        status["import_time"] = time.time() - t
+
+    runtime_ready.set()
+
+
+def start_runtime_import():
+    global import_thread
+
+    with import_lock:
+        if import_thread is not None: return
+        import_thread = threading.Thread(target = import_components, name = "runtime_import", daemon = True)
+        import_thread.start()
+
+
+def wait_runtime(timeout = None):
+
+    start_runtime_import()
+    return runtime_ready.wait(timeout)
+
+
+def runtime_status():
+
+    status = {}
+    status["started"] = import_thread is not None
+    status["ready"] = runtime_ready.is_set() and all(s["ready"] for s in component_status.values())
+    status["components"] = { k: v.copy() for k, v in component_status.items() }
+    return status
@@ -1,25 +1,17 @@
 import json, uuid, os, gc, glob, time
-import torch
-
-from exllamav2 import (
-    ExLlamaV2,
-    ExLlamaV2Config,
-    ExLlamaV2Cache,
-    ExLlamaV2Cache_8bit,
-    ExLlamaV2Tokenizer,
-)
-from exllamav2.generator import (
-    ExLlamaV2StreamingGenerator,
-    ExLlamaV2Sampler
-)
-from exllamav2.generator.filters import (
-    ExLlamaV2SelectFilter
-)
+
+# torch and exllamav2 are imported where they are used, see backend/runtime.py
 
 from backend.config import set_config_dir, global_state, config_filename
 from backend.models import set_model_loaded_callback
-from backend.prompts import prompt_formats
+from backend.prompts import prompt_formats, encode_turn, PromptFormat_template
 from backend.util import MultiTimer
+from backend.events import publish
+from backend.settings import get_settings
+from backend.streaming import FlushPolicy, text_packet
+from backend.lookup import LookupIndex, block_parts, begin_speculation, speculation_meta
+import backend.speculation as speculation
+import backend.jobs as jobs
 import backend.models as models  # Import as module to avoid circular dependency
 import threading
 
@@ -35,10 +27,8 @@ set_model_loaded_callback(handle_model_loaded)
 
 # Cancel
 
-abort_event = threading.Event()
-def set_cancel_signal():
-    global abort_event
-    abort_event.set()
+def set_cancel_signal(job_id = None):
+    return jobs.cancel_jobs("session", job_id)
 
 
 # List models
@@ -77,9 +67,20 @@ def set_session(data):
     global current_session
     current_session = Session(data["session_uuid"])
     current_session.load()
+    global_state.update(current_session_uuid = current_session.session_uuid)
     return current_session.to_json()
 
 
+def restore_session():
+    global current_session
+    i = global_state.current_session_uuid
+    if i is None: return
+    session = Session(i)
+    if not os.path.exists(session.filename()): return
+    session.load()
+    current_session = session
+
+
 def new_session():
     global current_session, session_list
     current_session = Session()
@@ -87,6 +88,8 @@ def new_session():
     # print(f"Created session {current_session.session_uuid}")
     filename = current_session.save()
     session_list[current_session.session_uuid] = (current_session.name, filename)
+    global_state.update(current_session_uuid = current_session.session_uuid)
+    publish("sessions")
     return current_session.to_json()
 
 
@@ -96,16 +99,34 @@ def delete_session(d_session):
         filename = session_list[d_session][1]
         os.remove(filename)
         del session_list[d_session]
+    models.release_client(d_session)
     if current_session is not None and current_session.session_uuid == d_session:
         current_session = None
+        global_state.update(current_session_uuid = None)
+    publish("sessions")
+
+
+def default_model_dict(model_uuid = None):
+    """
+    Config of the session's model if it has one, else of the model loaded in this process, else of the last model
+    loaded. In worker mode nothing is loaded here, the worker records the last model in state.json
+    """
+
+    if model_uuid: return models.models.get(model_uuid)
+    loaded_model = models.get_loaded_model()
+    if loaded_model is not None: return loaded_model.model_dict
+    global_state.load()
+    if global_state.last_model_uuid: return models.models.get(global_state.last_model_uuid)
+    return None
 
 
-def get_default_session_settings(use_model_params=False):
+def get_default_session_settings(use_model_params=False, model_uuid=None):
     """Get default session settings
     
     Args:
         use_model_params: If True and a model is loaded with custom params,
                          apply those params instead of defaults
+        model_uuid: The session's model, if any, for the default prompt format
     """
     settings = {
         "prompt_format": "Chat-RP",
@@ -133,8 +154,17 @@ def get_default_session_settings(use_model_params=False):
         "skew": 0.0,
         "dry_base": 1.75,
         "dry_multiplier": 0.0,
-        "dry_range": 1024
+        "dry_range": 1024,
+        "lora": "",
+        "grammar_mode": "None",
+        "grammar": "",
+        "model_uuid": ""
     }
+
+    # Prompt format detected from the model's chat template
+    model_dict = default_model_dict(model_uuid)
+    if model_dict is not None and model_dict.get("prompt_format") in prompt_formats:
+        settings["prompt_format"] = model_dict["prompt_format"]
     
     if use_model_params:
         # If requested, try to use model parameters
@@ -167,6 +197,7 @@ class Session:
         self.session_uuid = session_uuid
         self.history = []
         self.settings = {}
+        self.lookup_index = LookupIndex()
 
 
     def filename(self):
@@ -199,7 +230,7 @@ class Session:
         # self.mode = j["mode"]
         
         # Start with hardcoded defaults (no model params)
-        self.settings = get_default_session_settings(use_model_params=False)
+        self.settings = get_default_session_settings(use_model_params=False, model_uuid=j.get("settings", {}).get("model_uuid"))
         
         # Apply ALL saved settings including sampling params
         if "settings" in j:
@@ -226,6 +257,21 @@ class Session:
         self.save()
 
 
+    def get_model(self):
+        return models.get_model_for(self.settings.get("model_uuid"), self.session_uuid)
+
+
+    def get_prompt_format(self, loaded_model = None):
+        """
+        The session's prompt format, rendering with loaded_model's chat template in "Model template" mode
+        """
+
+        cls = prompt_formats[self.settings["prompt_format"]]
+        if cls is PromptFormat_template:
+            return PromptFormat_template(loaded_model.chat_template if loaded_model is not None else None)
+        return cls()
+
+
     def _create_session_name_from_text(self, text, max_length=30):
         """Creates a session name from the first message text.
         
@@ -252,7 +298,7 @@ class Session:
         return name.strip() or "Unnamed session"
 
     def user_input(self, data):
-        prompt_format = prompt_formats[self.settings["prompt_format"]]()
+        prompt_format = self.get_prompt_format()
         input_text = data["user_input_text"]
         new_block = {}
         new_block["block_uuid"] = str(uuid.uuid4())
@@ -281,8 +327,9 @@ class Session:
 
 
     def create_context_instruct(self, prompt_format, max_len, min_len, uptoblock = None, prefix = ""):
+        import torch
 
-        tokenizer = models.get_loaded_model().tokenizer
+        tokenizer = self.get_model().tokenizer
         prompts = []
         responses = []
 
@@ -319,22 +366,17 @@ class Session:
 
         # Get relative length of system prompt
 
-        p1 = prompt_format.format("", None, None, self.settings)
-        p2 = prompt_format.format("", "", self.settings["system_prompt"], self.settings)
-        t1 = tokenizer.encode(p1, encode_special_tokens = prompt_format.encode_special_tokens())
-        t2 = tokenizer.encode(p2, encode_special_tokens = prompt_format.encode_special_tokens())
+        t1 = encode_turn(prompt_format, tokenizer, "", None, None, self.settings)
+        t2 = encode_turn(prompt_format, tokenizer, "", "", self.settings["system_prompt"], self.settings)
         system_length = t2.shape[-1] - t1.shape[-1]
 
-        # Format and tokenize prompt-response pairs without system prompt
+        # Tokenize prompt-response pairs without system prompt
 
-        pairs = []
         tokenized_pairs = []
         for turn in range(len(prompts)):
             p = prompts[turn]
             r = responses[turn] if turn < len(responses) else None
-            pair = prompt_format.format(p, r, None, self.settings)
-            pairs.append(pair)
-            tokenized_pairs.append(tokenizer.encode(pair, encode_special_tokens = prompt_format.encode_special_tokens()))
+            tokenized_pairs.append(encode_turn(prompt_format, tokenizer, p, r, None, self.settings))
         lengths = [tp.shape[-1] for tp in tokenized_pairs]
 
         # Advance or roll back history
@@ -356,36 +398,32 @@ class Session:
 
         p = prompts[self.history_first]
         r = responses[self.history_first] if self.history_first < len(responses) else None
-        pair = prompt_format.format(p, r, self.settings["system_prompt"], self.settings)
-        pairs[self.history_first] = pair
-        tokenized_pairs[self.history_first] = tokenizer.encode(pair, encode_special_tokens = prompt_format.encode_special_tokens())
+        tokenized_pairs[self.history_first] = encode_turn(prompt_format, tokenizer, p, r, self.settings["system_prompt"], self.settings)
 
         # Create context
 
-        context_str = "".join(pairs[self.history_first:])
         context_ids = torch.cat(tokenized_pairs[self.history_first:], dim = -1)
 
         # Add prefix
 
         if prefix_ids is not None:
-            context_str += " " + prefix
             context_ids = torch.cat([context_ids, prefix_ids], dim = -1)
 
         # Add context BOS
 
         if prompt_format.context_bos():
-            context_str = tokenizer.bos_token + context_str
             context_ids = torch.cat([tokenizer.single_token(tokenizer.bos_token_id), context_ids], dim = -1)
 
         # print("self.history_first", self.history_first)
         # print("context_ids.shape[-1]", context_ids.shape[-1])
 
-        return context_str, context_ids
+        return context_ids
 
 
     def create_context_raw(self, prompt_format, max_len, min_len, uptoblock = None, prefix=""):
+        import torch
 
-        tokenizer = models.get_loaded_model().tokenizer
+        tokenizer = self.get_model().tokenizer
         history_copy = []
         for h in self.history:
             if h["block_uuid"] == uptoblock: break
@@ -404,15 +442,12 @@ class Session:
 
         # Format and tokenize block without system prompt
 
-        blocks = []
         tokenized_blocks = []
         for turn in range(len(history_copy)):
             block = history_copy[turn] + "\n"
-            blocks.append(block)
             tokenized_blocks.append(tokenizer.encode(block, encode_special_tokens = prompt_format.encode_special_tokens()))
         if prefix != "":
             block = prefix
-            blocks.append(block)
             tokenized_blocks.append(tokenizer.encode(block, encode_special_tokens = prompt_format.encode_special_tokens()))
 
         lengths = [tp.shape[-1] for tp in tokenized_blocks]
@@ -434,36 +469,149 @@ class Session:
 
         # Create context
 
-        context_str = system_prompt + "".join(blocks[self.history_first:])
         context_ids = torch.cat([system_prompt_tokenized] + tokenized_blocks[self.history_first:], dim = -1)
 
         # print("self.history_first", self.history_first)
         # print("context_ids.shape[-1]", context_ids.shape[-1])
-        return context_str, context_ids
+        return context_ids
+
+
+    def get_gen_settings(self):
+        from exllamav2.generator import ExLlamaV2Sampler
+
+        gen_settings = ExLlamaV2Sampler.Settings()
+        gen_settings.temperature = self.settings["temperature"]
+        gen_settings.temperature_last = self.settings["temperature_last"]
+        gen_settings.top_k = self.settings["top_k"]
+        gen_settings.top_p = self.settings["top_p"]
+        gen_settings.min_p = self.settings["min_p"]
+        gen_settings.smoothing_factor = self.settings["quad_sampling"]
+        gen_settings.tfs = self.settings["tfs"]
+        gen_settings.typical = self.settings["typical"]
+        gen_settings.mirostat = self.settings["mirostat"]
+        gen_settings.mirostat_tau = self.settings["mirostat_tau"]
+        gen_settings.mirostat_eta = self.settings["mirostat_eta"]
+        gen_settings.skew = self.settings["skew"]
+        gen_settings.token_repetition_penalty = self.settings["repp"]
+        gen_settings.token_repetition_range = self.settings["repr"]
+        gen_settings.token_repetition_decay = self.settings["repr"]
+        gen_settings.dry_base = self.settings["dry_base"]
+        gen_settings.dry_multiplier = self.settings["dry_multiplier"]
+        gen_settings.dry_range = self.settings["dry_range"]
+
+        if gen_settings.temperature == 0:
+            gen_settings.temperature = 1.0
+            gen_settings.top_k = 1
+            gen_settings.top_p = 0
+            gen_settings.typical = 0
 
+        return gen_settings
 
-    def generate(self, data):
-        global abort_event
 
-        abort_event.clear()
+    def get_stop_conditions(self, prompt_format, tokenizer):
+        if prompt_format.is_instruct():
+            return prompt_format.stop_conditions(tokenizer, self.settings)
+        if self.settings["stop_newline"]:
+            return ["\n"]
+        stop = set()
+        for r in self.settings["roles"]:
+            if r.strip() != "":
+                stop.add("\n" + r + ":")
+                stop.add("\n " + r + ":")
+                stop.add("\n" + r.upper() + ":")
+                stop.add("\n " + r.upper() + ":")
+                stop.add("\n" + r.lower() + ":")
+                stop.add("\n " + r.lower() + ":")
+        return list(stop) + [tokenizer.eos_token_id]
+
+
+    def get_banned_strings(self):
+        banned_strings = self.settings.get("banned_strings", "").strip()
+        banned_strings = banned_strings.split("\n")
+        banned_strings = [bs.strip() for bs in banned_strings if bs.strip()]
+        if len(banned_strings) == 0: banned_strings = None
+        return banned_strings
+
+
+    def generate(self, data, stream, policy = None):
+
+        # Each generation is a job with its own cancel token, queued on this session's replica. Its packets go to stream
+        # (a DecoupledStream), starting with the job id
+
+        job = jobs.create_job("session", self.session_uuid)
+        packet = { "result": "job", "job_id": job.job_id }
+        stream.put(json.dumps(packet) + "\n")
+        models.queue_generation(self.settings.get("model_uuid"), self.session_uuid, stream, lambda replica: self.run_job(job, replica, data, policy))
+
+
+    def run_job(self, job, replica, data, policy = None):
+
+        try:
+            job.start()
+            if job.token.is_set():
+                packet = { "result": "cancel" }
+                yield json.dumps(packet) + "\n"
+                return packet
+            t = time.time()
+            packet = yield from jobs.tracked(job, self.generate_on(replica.backend if replica else None, data, job.token, policy))
+            if replica is not None and packet["result"] == "ok":
+                replica.record(packet["new_block"]["meta"]["gen_tokens"], time.time() - t)
+        finally:
+            jobs.finish_job(job)
+        return packet
+
+
+    def generate_on(self, loaded_model, data, abort_event, policy = None):
+        import torch
+        from backend.rolefilter import RoleFilter
+        from backend.grammarfilter import grammar_filters, grammar_meta
+
         mt = MultiTimer()
 
         gen_prefix = data.get("prefix", "")
         block_id = data.get("block_id", None)
+        compact = data.get("framing") == "compact"
+        if policy is None: policy = FlushPolicy.from_settings(get_settings())
 
-        if models.get_loaded_model() is None:
+        if loaded_model is None:
             packet = { "result": "fail", "error": "No model loaded." }
             yield json.dumps(packet) + "\n"
             return packet
 
-        loaded_model = models.get_loaded_model()
         model = loaded_model.model
         generator = loaded_model.generator
         tokenizer = loaded_model.tokenizer
         cache = loaded_model.cache
-        speculative_mode = loaded_model.speculative_mode
+        model_uuid = loaded_model.model_dict["model_uuid"]
+        auto_speculation = loaded_model.speculative_mode == "Auto"
+        speculative_mode = speculation.resolve_mode(loaded_model.speculative_mode, self.session_uuid, model_uuid)
+
+        prompt_format = self.get_prompt_format(loaded_model)
+
+        # LoRA adapter, the cache is reset when it differs from the last generation's
+
+        try:
+            loras = loaded_model.loras.activate(self.settings.get("lora", ""))
+        except (ValueError, OSError) as e:
+            packet = { "result": "fail", "error": str(e) }
+            yield json.dumps(packet) + "\n"
+            return packet
 
-        prompt_format = prompt_formats[self.settings["prompt_format"]]()
+        # Grammar the response must follow, without the role prefix. Token healing would have the grammar start inside
+        # the prompt, it is off when there is one
+
+        stop_tokens = [sc for sc in self.get_stop_conditions(prompt_format, tokenizer) if isinstance(sc, int)]
+        try:
+            gfilters, grammar_cached = grammar_filters(model, tokenizer, self.settings, stop_tokens, max(data.get("alternatives", 1), 1))
+        except ValueError as e:
+            packet = { "result": "fail", "error": str(e) }
+            yield json.dumps(packet) + "\n"
+            return packet
+
+        # Several alternatives are generated as one batch
+
+        if data.get("alternatives", 1) > 1:
+            return (yield from self.generate_alternatives(loaded_model, data, abort_event, policy, loras, gfilters, grammar_cached))
 
         # Create response block
 
@@ -491,56 +639,16 @@ class Session:
 
         # Sampling settings
 
-        gen_settings = ExLlamaV2Sampler.Settings()
-        gen_settings.temperature = self.settings["temperature"]
-        gen_settings.temperature_last = self.settings["temperature_last"]
-        gen_settings.top_k = self.settings["top_k"]
-        gen_settings.top_p = self.settings["top_p"]
-        gen_settings.min_p = self.settings["min_p"]
-        gen_settings.smoothing_factor = self.settings["quad_sampling"]
-        gen_settings.tfs = self.settings["tfs"]
-        gen_settings.typical = self.settings["typical"]
-        gen_settings.mirostat = self.settings["mirostat"]
-        gen_settings.mirostat_tau = self.settings["mirostat_tau"]
-        gen_settings.mirostat_eta = self.settings["mirostat_eta"]
-        gen_settings.skew = self.settings["skew"]
-        gen_settings.token_repetition_penalty = self.settings["repp"]
-        gen_settings.token_repetition_range = self.settings["repr"]
-        gen_settings.token_repetition_decay = self.settings["repr"]
-        gen_settings.dry_base = self.settings["dry_base"]
-        gen_settings.dry_multiplier = self.settings["dry_multiplier"]
-        gen_settings.dry_range = self.settings["dry_range"]
-
-        if gen_settings.temperature == 0:
-            gen_settings.temperature = 1.0
-            gen_settings.top_k = 1
-            gen_settings.top_p = 0
-            gen_settings.typical = 0
+        gen_settings = self.get_gen_settings()
+        generator.set_stop_conditions(self.get_stop_conditions(prompt_format, tokenizer))
 
-        if prompt_format.is_instruct():
-            generator.set_stop_conditions(prompt_format.stop_conditions(tokenizer, self.settings))
-        else:
-            if self.settings["stop_newline"]:
-                generator.set_stop_conditions(["\n"])
-            else:
-                stop = set()
-                for r in self.settings["roles"]:
-                    if r.strip() != "":
-                        stop.add("\n" + r + ":")
-                        stop.add("\n " + r + ":")
-                        stop.add("\n" + r.upper() + ":")
-                        stop.add("\n " + r.upper() + ":")
-                        stop.add("\n" + r.lower() + ":")
-                        stop.add("\n " + r.lower() + ":")
-                generator.set_stop_conditions(list(stop) + [tokenizer.eos_token_id])
-
-        if speculative_mode == "N-gram":
-            generator.speculative_ngram = True
+        index = None
+        if speculative_mode == "Prompt lookup":
+            index = self.lookup_index.update(generator, tokenizer, block_parts(self.history))
+        begin_speculation(generator, speculative_mode, index)
+        draft_time = loaded_model.draft_time
 
-        banned_strings = self.settings.get("banned_strings", "").strip()
-        banned_strings = banned_strings.split("\n")
-        banned_strings = [bs.strip() for bs in banned_strings if bs.strip()]
-        if len(banned_strings) == 0: banned_strings = None
+        banned_strings = self.get_banned_strings()
 
         if prompt_format.is_instruct():
             min_tokens = self.settings.get("mintokens", None)
@@ -557,7 +665,6 @@ class Session:
         max_new_tokens = self.settings["maxtokens"]
         chunk_tokens = 0
 
-        last_chunk_time = time.time()
         full_response = ""  # gen_prefix
         save_tokens = torch.empty((1, 0), dtype = torch.long)
         chunk_buffer = ""
@@ -567,6 +674,7 @@ class Session:
         # If not in instruct mode, generate bot name prefix
 
         healing = False
+        select_ids = None
         if not prompt_format.is_instruct():
 
             prefix = ""
@@ -597,9 +705,8 @@ class Session:
 
                 past_tokens = model.config.max_seq_len - chunk_size - save_tokens.shape[-1]
                 past_tokens_min = model.config.max_seq_len - 2 * chunk_size - save_tokens.shape[-1]
-                context_str, context_ids = self.create_context(prompt_format, past_tokens, past_tokens_min, uptoblock = block_id)
-                sfilter = ExLlamaV2SelectFilter(model, tokenizer, bot_roles, case_insensitive = False)
-                gen_settings.filters = [sfilter]
+                context_ids = self.create_context(prompt_format, past_tokens, past_tokens_min, uptoblock = block_id)
+                gen_settings.filters = [RoleFilter(model, tokenizer, bot_roles)]
 
                 mt.set_stage("prompt")
                 generator.begin_stream_ex(
@@ -607,13 +714,13 @@ class Session:
                     gen_settings = gen_settings,
                     token_healing = p_healing,
                     abort_event = abort_event,
+                    loras = loras,
                     banned_strings = banned_strings,
                     filters = gen_settings.filters,
                     filter_prefer_eos = gen_settings.filters
                 )
                 if abort_event.is_set():
-                    abort_event.clear()
-                    packet = { "result": "cancel_pre" }
+                    packet = { "result": "cancel" }
                     yield json.dumps(packet) + "\n"
                     return packet
 
@@ -626,8 +733,11 @@ class Session:
                     if eos: break
                 mt.stop()
 
+                # The reply continues from the selected role's tokens, which are already in the cache
+
                 gen_settings.filters = []
                 gen_prefix = prefix
+                select_ids = generator.sequence_ids.clone()
 
             else:
 
@@ -659,6 +769,10 @@ class Session:
 
         # Stream response
 
+        gfilters = gfilters[:1]
+        gen_settings.filters = gfilters
+        if len(gfilters) > 0: healing = False
+
         mt.set_stage("gen")
         while True:
 
@@ -669,10 +783,14 @@ class Session:
                 packet["block_uuid"] = new_block["block_uuid"]
                 yield json.dumps(packet) + "\n"
 
-                past_tokens = model.config.max_seq_len - chunk_size - save_tokens.shape[-1]
-                past_tokens_min = model.config.max_seq_len - 2 * chunk_size - save_tokens.shape[-1]
-                context_str, context_ids = self.create_context(prompt_format, past_tokens, past_tokens_min, prefix = prefix, uptoblock = block_id)
-                context_ids = torch.cat((context_ids, save_tokens), dim = -1)
+                if select_ids is not None:
+                    context_ids = select_ids
+                    select_ids = None
+                else:
+                    past_tokens = model.config.max_seq_len - chunk_size - save_tokens.shape[-1]
+                    past_tokens_min = model.config.max_seq_len - 2 * chunk_size - save_tokens.shape[-1]
+                    context_ids = self.create_context(prompt_format, past_tokens, past_tokens_min, prefix = prefix, uptoblock = block_id)
+                    context_ids = torch.cat((context_ids, save_tokens), dim = -1)
 
                 mt.set_stage("prompt")
                 generator.begin_stream_ex(
@@ -680,7 +798,9 @@ class Session:
                     gen_settings = gen_settings,
                     token_healing = healing,
                     abort_event = abort_event,
-                    banned_strings = banned_strings
+                    loras = loras,
+                    banned_strings = banned_strings,
+                    filters = gfilters
                 )
                 if abort_event.is_set():
                     break
@@ -697,31 +817,33 @@ class Session:
             res = generator.stream_ex(
                 ban_tokens = temp_ban_tokens
             )
-            if abort_event.is_set(): break
 
             save_tokens = torch.cat((save_tokens, res["chunk_token_ids"]), dim = -1)
 
-            generated_tokens += 1
-            chunk_tokens -= 1
+            # Speculative decoding can return several tokens at once
+
+            new_tokens = res["chunk_token_ids"].shape[-1]
+            generated_tokens += new_tokens
+            chunk_tokens -= max(new_tokens, 1)
 
             chunk_buffer += res["chunk"]
+            flush = policy.add(res["chunk"])
 
-            now = time.time()
-            elapsed = now - last_chunk_time
+            # A cancel still sends, and keeps, the text generated so far
 
-            if chunk_buffer != "" and (elapsed > 0.05 or res["eos"] or generated_tokens == max_new_tokens):
+            if chunk_buffer != "" and (flush or res["eos"] or generated_tokens >= max_new_tokens or abort_event.is_set()):
 
-                packet = {}
-                packet["result"] = "stream_to_block"
-                packet["block_uuid"] = new_block["block_uuid"]
-                packet["text"] = chunk_buffer
-                yield json.dumps(packet) + "\n"
+                yield text_packet("stream_to_block", chunk_buffer, compact, block_uuid = new_block["block_uuid"])
 
                 full_response += chunk_buffer
                 chunk_buffer = ""
-                last_chunk_time = now
+                policy.flushed()
+
+            if res["eos"] or generated_tokens >= max_new_tokens or abort_event.is_set(): break
 
-            if res["eos"] or generated_tokens == max_new_tokens: break
+        if chunk_buffer != "":
+            yield text_packet("stream_to_block", chunk_buffer, compact, block_uuid = new_block["block_uuid"])
+            full_response += chunk_buffer
 
         # Compile metadata
 
@@ -731,10 +853,16 @@ class Session:
         meta["prompt_speed"] = context_ids.shape[-1] / (mt.stages["prompt"] + 1e-8)
         meta["gen_tokens"] = generated_tokens
         meta["gen_speed"] = generated_tokens / (mt.stages["gen"] + 1e-8)
-        meta["overflow"] = max_new_tokens if generated_tokens == max_new_tokens else 0
+        meta["overflow"] = max_new_tokens if generated_tokens >= max_new_tokens else 0
         meta["canceled"] = abort_event.is_set()
         meta["context_tokens"] = context_ids.shape[-1] + save_tokens.shape[-1]  # Total tokens in context
         meta["max_seq_len"] = model.config.max_seq_len  # Maximum sequence length
+        meta["gen_time"] = mt.stages["gen"]
+        meta["draft_time"] = loaded_model.draft_time - draft_time
+        meta["auto_speculation"] = auto_speculation
+        meta.update(speculation_meta(generator, speculative_mode))
+        if len(gfilters) > 0: meta.update(grammar_meta(gfilters, grammar_cached))
+        speculation.record(model_uuid, self.settings["prompt_format"], meta, self.session_uuid, auto_speculation)
         new_block["meta"] = meta
 
         # Save response block
@@ -743,6 +871,9 @@ class Session:
             new_block["text"] = gen_prefix + prefix + full_response.rstrip()
         else:
             new_block["text"] = prefix + full_response.rstrip()
+        if "variants" in new_block:
+            new_block["variants"].append(new_block["text"])
+            new_block["variant"] = len(new_block["variants"]) - 1
         if not block_id:
             self.history.append(new_block)
         self.save()
@@ -755,6 +886,178 @@ class Session:
         return packet
 
 
+    def generate_alternatives(self, loaded_model, data, abort_event, policy, loras, gfilters, grammar_cached):
+        from exllamav2.generator import ExLlamaV2DynamicJob
+
+        mt = MultiTimer()
+
+        block_id = data.get("block_id", None)
+        num_alternatives = min(int(data["alternatives"]), models.max_batch_size)
+        compact = data.get("framing") == "compact"
+
+        model = loaded_model.model
+        tokenizer = loaded_model.tokenizer
+        prompt_format = self.get_prompt_format(loaded_model)
+        max_new_tokens = self.settings["maxtokens"]
+        chunk_size = self.settings["chunktokens"]
+
+        # Response block, responses already on it are kept as variants
+
+        new_block = None
+        if block_id is not None:
+            for b in self.history:
+                if b["block_uuid"] == block_id:
+                    new_block = b
+                    break
+        if new_block is None:
+            new_block = {}
+            new_block["block_uuid"] = str(uuid.uuid4())
+            new_block["author"] = "assistant"
+            new_block["text"] = ""
+        variants = new_block.get("variants") or ([new_block["text"]] if new_block["text"] else [])
+        first = len(variants)
+
+        # Without an instruct template, every alternative answers as the role that answered before, or the first bot
+        # role. Choosing a role per alternative would need a filtered generation each
+
+        prefix = ""
+        if not prompt_format.is_instruct():
+            bot_roles = [r + ":" for r in self.settings["roles"][1:] if r.strip() != ""]
+            prefix = bot_roles[0]
+            for br in bot_roles:
+                if new_block["text"].startswith(br): prefix = br
+
+        # All alternatives share the context, its pages are deduplicated so it is prefilled once. Each needs room for
+        # its own response
+
+        past_tokens = model.config.max_seq_len - num_alternatives * (max_new_tokens + 256)
+        if past_tokens < 256:
+            packet = { "result": "fail", "error": f"Not enough context for {num_alternatives} alternatives of {max_new_tokens} tokens." }
+            yield json.dumps(packet) + "\n"
+            return packet
+        context_ids = self.create_context(prompt_format, past_tokens, max(past_tokens - chunk_size, 0), prefix = prefix, uptoblock = block_id)
+
+        try:
+            generator = loaded_model.get_batch_generator()
+            generator.set_loras(loras)
+        except Exception as e:
+            packet = { "result": "fail", "error": type(e).__name__ + ":\n" + str(e) }
+            yield json.dumps(packet) + "\n"
+            return packet
+
+        new_block["variants"] = variants + [prefix] * num_alternatives
+        new_block["variant"] = first
+        new_block["text"] = prefix
+
+        packet = {}
+        packet["result"] = "begin_block"
+        packet["block"] = new_block
+        yield json.dumps(packet) + "\n"
+
+        # Jobs
+
+        gen_settings = self.get_gen_settings()
+        stop_conditions = self.get_stop_conditions(prompt_format, tokenizer)
+        banned_strings = self.get_banned_strings()
+        min_tokens = self.settings.get("mintokens", 0) if prompt_format.is_instruct() else 0
+
+        for i in range(num_alternatives):
+            job = ExLlamaV2DynamicJob(
+                input_ids = context_ids,
+                gen_settings = gen_settings.clone(),
+                max_new_tokens = max_new_tokens,
+                min_new_tokens = min_tokens,
+                stop_conditions = stop_conditions,
+                banned_strings = banned_strings,
+                filters = gfilters[i:i + 1],
+                identifier = first + i
+            )
+            generator.enqueue(job)
+
+        # Stream
+
+        buffers = {}
+        generated_tokens = 0
+        overflow = False
+        mt.set_stage("prompt")
+        try:
+            while generator.num_remaining_jobs():
+
+                if abort_event.is_set():
+                    generator.clear_queue()
+                    break
+
+                flush = False
+                for r in generator.iterate():
+                    if r["stage"] != "streaming": continue
+                    if mt.current_stage == "prompt": mt.set_stage("gen")
+                    variant = r["identifier"]
+                    text = r.get("text", "")
+                    buffers[variant] = buffers.get(variant, "") + text
+                    new_block["variants"][variant] += text
+                    flush = policy.add(text) or flush
+                    if r["eos"]:
+                        flush = True
+                        generated_tokens += r.get("new_tokens", 0)
+                        if r.get("eos_reason") == "max_new_tokens": overflow = True
+
+                if flush:
+                    for variant, text in buffers.items():
+                        if text: yield text_packet("stream_to_variant", text, compact, block_uuid = new_block["block_uuid"], variant = variant)
+                    buffers = {}
+                    policy.flushed()
+        finally:
+            loaded_model.invalidate_cache()
+
+        for variant, text in buffers.items():
+            if text: yield text_packet("stream_to_variant", text, compact, block_uuid = new_block["block_uuid"], variant = variant)
+
+        # Compile metadata
+
+        mt.stop()
+        meta = {}
+        meta["prompt_tokens"] = context_ids.shape[-1]
+        meta["prompt_speed"] = context_ids.shape[-1] / (mt.stages.get("prompt", 0) + 1e-8)
+        meta["gen_tokens"] = generated_tokens
+        meta["gen_speed"] = generated_tokens / (mt.stages.get("gen", 0) + 1e-8)  # All alternatives together
+        meta["overflow"] = max_new_tokens if overflow else 0
+        meta["canceled"] = abort_event.is_set()
+        meta["context_tokens"] = context_ids.shape[-1] + generated_tokens // num_alternatives
+        meta["max_seq_len"] = model.config.max_seq_len
+        meta["alternatives"] = num_alternatives
+        if len(gfilters) > 0: meta.update(grammar_meta(gfilters, grammar_cached))
+        new_block["meta"] = meta
+
+        # Save response block with the first alternative selected
+
+        for v in range(first, len(new_block["variants"])):
+            new_block["variants"][v] = new_block["variants"][v].rstrip()
+        new_block["text"] = new_block["variants"][first]
+        if not block_id:
+            self.history.append(new_block)
+        self.save()
+
+        packet = { "result": "ok", "new_block": new_block }
+        yield json.dumps(packet) + "\n"
+
+        return packet
+
+
+    def select_variant(self, data):
+        for block in self.history:
+            if block["block_uuid"] == data["block_uuid"]:
+                variants = block.get("variants") or []
+                variant = data["variant"]
+                if not 0 <= variant < len(variants): break
+                # Keep edits made to the shown variant
+                variants[block.get("variant", 0)] = block["text"]
+                block["variant"] = variant
+                block["text"] = variants[variant]
+                self.save()
+                return { "result": "ok", "block": block }
+        return { "result": "fail", "error": "No such variant." }
+
+
     def rename(self, data):
         global session_list
 
@@ -764,6 +1067,7 @@ class Session:
         session_list[self.session_uuid] = (data["new_name"], session_list[self.session_uuid][1])
         self.name = data["new_name"]
         self.save()
+        publish("sessions")
 
 
     def delete_block(self, block_uuid, delete_from_here):
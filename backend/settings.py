@@ -7,6 +7,14 @@ def default_settings():
     j["smooth_scrolling"] = True
     j["show_stats"] = False
     j["theme"] = "Dark"
+    j["vram_budget"] = 0  # GB for resident models, 0 keeps one model loaded
+    j["host_cache_budget"] = 0  # GB of system RAM for host copies of model weights, resident models included, 0 disables
+    j["prefetch_window"] = 0  # Modules to read ahead while loading, 0 disables
+    j["prefetch_threads"] = 4
+    j["lora_vram_budget"] = 2  # GB for loaded LoRA adapters per resident model
+    j["stream_flush_ms"] = 50  # Minimum time between streamed text packets, stretched to the client's read latency
+    j["stream_flush_tokens"] = 0  # Also flush after this many tokens, 0 disables
+    j["stream_flush_bytes"] = 0  # Also flush after this many bytes of text, 0 disables
     return j
 
 def get_settings():
@@ -0,0 +1,109 @@
+import threading
+from collections import deque
+
+# Speculative decoding telemetry and the "Auto" speculative_mode. Every generation reports its drafted and accepted
+# tokens, draft overhead (time in the draft model's forward passes) and speed, aggregated per model, prompt format and
+# speculative mode.
+#
+# In "Auto" mode each session or notepad decides per generation whether to speculate, using prompt lookup (the
+# speculation that needs no extra model), from a rolling window of its own measured speeds with and without. Until both
+# have been measured, and then every explore_interval generations, the mode that is losing is tried again so a change
+# in workload is noticed. Otherwise speculation is only used while it is measurably faster
+
+auto_candidate = "Prompt lookup"
+auto_window = 8
+auto_min_samples = 2
+auto_min_tokens = 16
+explore_interval = 10
+
+stats_lock = threading.Lock()
+totals: dict = {}
+auto_states: dict = {}
+
+
+class AutoState:
+
+    speeds: dict
+    generations: int
+
+    def __init__(self):
+        self.speeds = { auto_candidate: deque(maxlen = auto_window), "None": deque(maxlen = auto_window) }
+        self.generations = 0
+
+
+    def mean(self, mode):
+        s = self.speeds[mode]
+        return sum(s) / len(s) if len(s) > 0 else 0.0
+
+
+    def choose(self):
+        for mode in (auto_candidate, "None"):
+            if len(self.speeds[mode]) < auto_min_samples: return mode
+        best = auto_candidate if self.mean(auto_candidate) > self.mean("None") else "None"
+        if self.generations % explore_interval == explore_interval - 1:
+            return "None" if best == auto_candidate else auto_candidate
+        return best
+
+
+    def status(self):
+        s = {}
+        s["generations"] = self.generations
+        s["speed_on"] = self.mean(auto_candidate)
+        s["speed_off"] = self.mean("None")
+        s["choice"] = self.choose()
+        return s
+
+
+def resolve_mode(speculative_mode, owner, model_uuid):
+    """
+    The speculative mode to use for this generation, deciding for "Auto"
+    """
+
+    if speculative_mode != "Auto": return speculative_mode
+    with stats_lock:
+        state = auto_states.setdefault((owner, model_uuid), AutoState())
+        return state.choose()
+
+
+def record(model_uuid, prompt_format, meta, owner = None, auto = False):
+    """
+    Add a generation's meta (speculative_mode, gen_tokens, gen_time, draft_tokens, accepted_tokens, draft_time) to the
+    totals, and to owner's measurements if it was decided by "Auto"
+    """
+
+    mode = meta["speculative_mode"]
+    with stats_lock:
+        key = (model_uuid, prompt_format, mode)
+        t = totals.setdefault(key, { "generations": 0, "gen_tokens": 0, "gen_time": 0.0, "draft_tokens": 0,
+                                     "accepted_tokens": 0, "draft_time": 0.0 })
+        t["generations"] += 1
+        for k in ("gen_tokens", "gen_time", "draft_tokens", "accepted_tokens", "draft_time"):
+            t[k] += meta[k]
+
+        if auto:
+            state = auto_states.setdefault((owner, model_uuid), AutoState())
+            state.generations += 1
+            if meta["gen_tokens"] >= auto_min_tokens and not meta.get("canceled", False):
+                state.speeds[mode].append(meta["gen_tokens"] / (meta["gen_time"] + 1e-8))
+
+
+def speculation_stats():
+    with stats_lock:
+        s = {}
+        s["totals"] = []
+        for (model_uuid, prompt_format, mode), t in totals.items():
+            e = dict(t)
+            e["model_uuid"] = model_uuid
+            e["prompt_format"] = prompt_format
+            e["speculative_mode"] = mode
+            e["acceptance_rate"] = t["accepted_tokens"] / t["draft_tokens"] if t["draft_tokens"] else 0.0
+            e["gen_speed"] = t["gen_tokens"] / (t["gen_time"] + 1e-8)
+            e["draft_overhead"] = t["draft_time"] / (t["gen_time"] + 1e-8)
+            s["totals"].append(e)
+        s["auto"] = []
+        for (owner, model_uuid), state in auto_states.items():
+            e = state.status()
+            e["owner"] = owner
+            e["model_uuid"] = model_uuid
+            s["auto"].append(e)
+        return s
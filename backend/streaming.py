@@ -0,0 +1,283 @@
+import json, threading, time
+from collections import deque
+
+# Decouples a generation from the client reading it. The generation runs elsewhere, queued on its model replica's
+# worker (backend/replicas.py) or on a producer thread of its own, and its packets go into a queue that the HTTP writer
+# drains, so decoding doesn't wait on a slow socket. When the queue backs up, consecutive
+# text packets for the same block are merged instead of growing it. When the client goes away (the response is closed
+# early, or the server reports a disconnect), the generation is canceled rather than left running to max tokens.
+#
+# Generations buffer their text and send it as one packet when their FlushPolicy says so. With compact framing,
+# requested per request with "framing": "compact", a text packet is [1, text] instead of a JSON object, appending to
+# the block (or notepad position) currently being streamed, [2, n, text] for variant n of that block or [3, n, text]
+# for notepad branch n. All other packets are unchanged
+
+max_queued_packets = 64
+poll_interval = 0.25
+max_flush_interval = 0.5
+
+coalesce_results = ["stream_to_block", "stream_chunk", "stream_to_variant", "stream_branch"]
+compact_text = 1
+compact_variant = 2
+compact_branch = 3
+
+
+class FlushPolicy:
+
+    interval: float
+    max_tokens: int
+    max_bytes: int
+    read_latency: float
+    flushes: int
+
+    def __init__(self, interval = 0.05, max_tokens = 0, max_bytes = 0):
+        self.interval = interval
+        self.max_tokens = max_tokens
+        self.max_bytes = max_bytes
+        self.read_latency = 0.0
+        self.flushes = 0
+        self.tokens = 0
+        self.bytes = 0
+        self.last_flush = time.time()
+
+
+    @staticmethod
+    def from_settings(settings):
+        return FlushPolicy(interval = settings.get("stream_flush_ms", 50) / 1000,
+                           max_tokens = settings.get("stream_flush_tokens", 0),
+                           max_bytes = settings.get("stream_flush_bytes", 0))
+
+
+    def observe_read(self, seconds):
+        # Moving average of how long the client takes to accept a write
+        self.read_latency = 0.8 * self.read_latency + 0.2 * seconds
+
+
+    def current_interval(self):
+        # Flushing faster than the client reads only makes packets that get merged in the queue later
+        if self.interval <= 0: return 0
+        return min(max(self.interval, self.read_latency), max(self.interval, max_flush_interval))
+
+
+    def add(self, text, tokens = 1):
+        """
+        Account for text buffered by the caller, returns True if the buffer should be flushed. Each limit that is 0 is
+        disabled
+        """
+
+        self.tokens += tokens
+        self.bytes += len(text.encode("utf-8"))
+        interval = self.current_interval()
+        if interval > 0 and time.time() - self.last_flush >= interval: return True
+        if self.max_tokens > 0 and self.tokens >= self.max_tokens: return True
+        if self.max_bytes > 0 and self.bytes >= self.max_bytes: return True
+        return False
+
+
+    def flushed(self):
+        self.tokens = 0
+        self.bytes = 0
+        self.flushes += 1
+        self.last_flush = time.time()
+
+
+def text_packet(result, text, compact, **fields):
+    """
+    Serialize a streamed text packet, e.g. text_packet("stream_to_block", text, compact, block_uuid = ...)
+    """
+
+    if compact:
+        if "variant" in fields: return "[" + str(compact_variant) + "," + str(fields["variant"]) + "," + json.dumps(text) + "]\n"
+        if "branch" in fields: return "[" + str(compact_branch) + "," + str(fields["branch"]) + "," + json.dumps(text) + "]\n"
+        return "[" + str(compact_text) + "," + json.dumps(text) + "]\n"
+    packet = { "result": result }
+    packet.update(fields)
+    packet["text"] = text
+    return json.dumps(packet) + "\n"
+
+
+def coalesce(a, b):
+    """
+    Merge packet b into a if both are text streamed to the same block, otherwise None
+    """
+
+    if a.startswith("["):
+        if not b.startswith("["): return None
+        pa = json.loads(a)
+        pb = json.loads(b)
+        if pa[:-1] != pb[:-1]: return None
+        pa[-1] += pb[-1]
+        return json.dumps(pa, separators = (",", ":")) + "\n"
+
+    if b.startswith("["): return None
+    pa = json.loads(a)
+    if pa["result"] not in coalesce_results: return None
+    pb = json.loads(b)
+    if pb["result"] != pa["result"] or pb.get("block_uuid") != pa.get("block_uuid") or pb.get("variant") != pa.get("variant") or pb.get("branch") != pa.get("branch"): return None
+    pa["text"] += pb["text"]
+    return json.dumps(pa) + "\n"
+
+
+class PacketQueue:
+
+    packets: deque
+    done: bool
+    coalesced: int
+
+    def __init__(self, maxsize = max_queued_packets):
+        self.packets = deque()
+        self.maxsize = maxsize
+        self.done = False
+        self.coalesced = 0
+        self.cond = threading.Condition()
+        self.waker = None
+
+
+    def put(self, packet):
+        # Never blocks. Past maxsize, text is merged into the last packet, anything else is appended regardless
+        with self.cond:
+            if len(self.packets) >= self.maxsize:
+                merged = coalesce(self.packets[-1], packet)
+                if merged is not None:
+                    self.packets[-1] = merged
+                    self.coalesced += 1
+                    return
+            self.packets.append(packet)
+            self.cond.notify()
+            waker = self.waker
+        if waker is not None: waker()
+
+
+    def close(self):
+        with self.cond:
+            self.done = True
+            self.cond.notify()
+            waker = self.waker
+        if waker is not None: waker()
+
+
+    def set_waker(self, waker):
+        """
+        Call waker (from the producer thread) whenever packets arrive or the queue closes, for consumers that don't
+        block in get_all
+        """
+
+        with self.cond:
+            self.waker = waker
+
+
+    def get_all(self, timeout):
+        """
+        Wait up to timeout for packets, returning (packets, done)
+        """
+
+        with self.cond:
+            if len(self.packets) == 0 and not self.done and timeout > 0:
+                self.cond.wait(timeout)
+            packets = list(self.packets)
+            self.packets.clear()
+            return packets, self.done and len(packets) == 0
+
+
+def job_id_of(packet):
+    """
+    The job id announced by a { "result": "job" } packet, otherwise None
+    """
+
+    try:
+        p = json.loads(packet)
+    except ValueError:
+        return None
+    if isinstance(p, dict) and p.get("result") == "job": return p.get("job_id")
+    return None
+
+
+class DecoupledStream:
+    """
+    The packets of a generation. With a generator, it runs on a producer thread of its own. Without one, whoever runs
+    the generation feeds the stream with put and finish, or with produce from a thread of its choosing. Iterating yields
+    the packets as the client reads them, batched when more than one is waiting. An event loop can instead drain it
+    without a thread, with set_waker and take (see backend/asgi.py). Closing the stream before the generation ends
+    cancels it with the job id from its first packet, and calls on_close
+    """
+
+    def __init__(self, gen = None, cancel = None, disconnected = None, maxsize = max_queued_packets, policy = None):
+        self.queue = PacketQueue(maxsize)
+        self.cancel = cancel
+        self.disconnected = disconnected
+        self.policy = policy
+        self.job_id = None
+        self.first = True
+        self.finished = False
+        self.on_close = None
+        if gen is not None:
+            producer = threading.Thread(target = self.produce, args = (gen,), name = "stream_producer", daemon = True)
+            producer.start()
+
+
+    def put(self, packet):
+        if self.first:
+            self.first = False
+            self.job_id = job_id_of(packet)
+        self.queue.put(packet)
+
+
+    def fail(self, e):
+        self.put(json.dumps({ "result": "fail", "error": type(e).__name__ + ":\n" + str(e) }) + "\n")
+
+
+    def finish(self):
+        self.queue.close()
+
+
+    def produce(self, gen):
+        """
+        Run the packet generator gen to the end on the calling thread, then finish the stream
+        """
+
+        try:
+            for packet in gen: self.put(packet)
+        except Exception as e:
+            self.fail(e)
+        finally:
+            self.finish()
+
+
+    def __iter__(self):
+        while True:
+            packets, finished = self.queue.get_all(poll_interval)
+            if finished:
+                self.finished = True
+                return
+            if len(packets) > 0:
+                t = time.time()
+                yield "".join(packets)
+                self.observe_read(time.time() - t)
+            elif self.disconnected is not None and self.disconnected():
+                return
+
+
+    def set_waker(self, waker):
+        self.queue.set_waker(waker)
+
+
+    def take(self):
+        """
+        The packets waiting right now, joined, without blocking, and whether the stream is finished
+        """
+
+        packets, finished = self.queue.get_all(0)
+        if finished: self.finished = True
+        return "".join(packets), finished
+
+
+    def observe_read(self, seconds):
+        if self.policy is not None: self.policy.observe_read(seconds)
+
+
+    def close(self):
+        if not self.finished and not self.queue.done and self.cancel is not None and self.job_id is not None:
+            self.cancel(self.job_id)
+        self.finished = True
+        on_close, self.on_close = self.on_close, None
+        if on_close is not None: on_close()
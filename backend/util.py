@@ -1,4 +1,4 @@
-import time, os
+import time, os, itertools, threading
 
 class MultiTimer:
 
@@ -29,3 +29,18 @@ def expanduser(path):
     return os.path.expanduser(path)
 
 
+tokenizer_serials = itertools.count(1)
+tokenizer_serials_lock = threading.Lock()
+
+def tokenizer_key(tokenizer):
+    """
+    Key for caches of per-tokenizer data. Unlike id(tokenizer), never reused by a tokenizer loaded after this one is
+    freed
+    """
+
+    with tokenizer_serials_lock:
+        key = getattr(tokenizer, "exui_key", None)
+        if key is None:
+            key = next(tokenizer_serials)
+            tokenizer.exui_key = key
+        return key
@@ -0,0 +1,223 @@
+import importlib, os, threading, time
+from collections import OrderedDict
+
+from backend.settings import get_settings
+
+# Host memory cache of model weights. Tensors read from safetensors files while loading a model are kept in system RAM,
+# so reloading the same model after it was unloaded is a host-to-device copy instead of reading and processing every
+# file from disk again. Bounded by the host_cache_budget setting, in GB, 0 disables. Least recently loaded models are
+# evicted as tensors are added. Cached tensors are never handed out themselves, a load always gets a copy on its
+# device, even on the CPU, so modifying loaded weights in place can't alter the cache.
+#
+# The copy has to be taken while loading, loaded weights are converted on the device and can't be read back. So a
+# resident model's entry also takes RAM, counted against host_cache_budget like any other, for as long as it is kept.
+# Host copies are ordinary pageable memory, not pinned, so an idle one can be paged out and recording one doesn't add
+# a pinning pass to the first load.
+#
+# Each load has its own HostLoad, held by the loading thread, with its timings and the entry it records into. An entry
+# is complete once a load recorded every tensor of the model and ended successfully. Only complete entries let a load
+# skip read-ahead (has_entry)
+
+class HostModelEntry:
+
+    model_dir: str
+    fingerprint: tuple
+    tensors: dict
+    size: int
+    complete: bool
+
+    def __init__(self, model_dir, fingerprint):
+        self.model_dir = model_dir
+        self.fingerprint = fingerprint
+        self.tensors = {}
+        self.size = 0
+        self.complete = False
+
+
+class HostLoad:
+
+    entry: HostModelEntry or None
+    times: dict
+    dropped: int
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.times = { "read_time": 0.0, "transfer_time": 0.0, "cache_hits": 0, "cache_misses": 0 }
+        self.dropped = 0
+
+
+host_entries: OrderedDict = OrderedDict()
+cache_lock = threading.Lock()
+
+loading = threading.local()
+
+original_get_tensor = None
+
+
+def get_host_cache_budget():
+    budget = get_settings().get("host_cache_budget", 0)
+    return int(float(budget) * 1024**3)
+
+
+def dir_fingerprint(model_dir):
+    fp = []
+    for f in sorted(os.listdir(model_dir)):
+        if f.endswith(".safetensors"):
+            st = os.stat(os.path.join(model_dir, f))
+            fp.append((f, st.st_size, st.st_mtime))
+    return tuple(fp)
+
+
+def find_loader_class():
+    for module_name in ["exllamav2.stloader", "exllamav2.fasttensors"]:
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError:
+            continue
+        if hasattr(module, "STFile"): return module.STFile
+    return None
+
+
+def install():
+    global original_get_tensor
+
+    if original_get_tensor is not None: return True
+    stfile = find_loader_class()
+    if stfile is None: return False
+
+    original_get_tensor = stfile.get_tensor
+
+    def get_tensor(self, key, device, *args, **kwargs):
+        return cached_get_tensor(self, key, device, *args, **kwargs)
+
+    stfile.get_tensor = get_tensor
+    return True
+
+
+def current_load():
+    return getattr(loading, "load", None)
+
+
+def cached_get_tensor(stfile, key, device, *args, **kwargs):
+
+    load = current_load()
+    entry = load.entry if load is not None else None
+    filename = getattr(stfile, "filename", None)
+    if entry is None or filename is None or os.path.dirname(os.path.abspath(filename)) != entry.model_dir:
+        t = time.time()
+        tensor = original_get_tensor(stfile, key, device, *args, **kwargs)
+        if load is not None: load.times["read_time"] += time.time() - t
+        return tensor
+
+    # Cached, copy from host memory
+
+    tensor_key = (filename, key)
+    host_tensor = entry.tensors.get(tensor_key)
+    if host_tensor is not None:
+        t = time.time()
+        tensor = host_tensor.to(device, copy = True)
+        load.times["transfer_time"] += time.time() - t
+        load.times["cache_hits"] += 1
+        return tensor
+
+    # Read to host memory, keep a copy if it fits the budget
+
+    t = time.time()
+    host_tensor = original_get_tensor(stfile, key, "cpu", *args, **kwargs)
+    load.times["read_time"] += time.time() - t
+    load.times["cache_misses"] += 1
+
+    size = host_tensor.numel() * host_tensor.element_size()
+    cached = make_room(entry, size)
+    if cached:
+        entry.tensors[tensor_key] = host_tensor
+        entry.size += size
+    else:
+        load.dropped += 1
+
+    t = time.time()
+    tensor = host_tensor.to(device, copy = cached)
+    load.times["transfer_time"] += time.time() - t
+    return tensor
+
+
+def begin_load(model_dir):
+    """
+    Start a load of model_dir on this thread, recording its tensors into the entry for the same files if there is one
+    """
+
+    budget = get_host_cache_budget()
+    if budget <= 0 or not install():
+        loading.load = HostLoad(None)
+        return
+
+    model_dir = os.path.abspath(model_dir)
+    fingerprint = dir_fingerprint(model_dir)
+
+    with cache_lock:
+        entry = host_entries.get(model_dir)
+        if entry is None or entry.fingerprint != fingerprint:
+            entry = HostModelEntry(model_dir, fingerprint)
+            host_entries[model_dir] = entry
+        host_entries.move_to_end(model_dir)
+    loading.load = HostLoad(entry)
+
+
+def end_load(success = False):
+    """
+    End this thread's load. The entry is complete if the load succeeded without leaving any tensor out
+    """
+
+    load = current_load()
+    loading.load = None
+    if load is not None and load.entry is not None and success and load.dropped == 0:
+        with cache_lock:
+            if host_entries.get(load.entry.model_dir) is load.entry: load.entry.complete = True
+    evict()
+
+
+def make_room(entry, size):
+    """
+    Evict least recently used entries other than entry until size more bytes fit the budget. Returns False if they
+    don't fit even then
+    """
+
+    budget = get_host_cache_budget()
+    with cache_lock:
+        total = sum(e.size for e in host_entries.values())
+        for model_dir in list(host_entries.keys()):
+            if total + size <= budget: break
+            if host_entries[model_dir] is entry: continue
+            total -= host_entries.pop(model_dir).size
+        return total + size <= budget
+
+
+def evict():
+
+    budget = get_host_cache_budget()
+    with cache_lock:
+        total = sum(e.size for e in host_entries.values())
+        while len(host_entries) > 0 and total > budget:
+            model_dir, entry = host_entries.popitem(last = False)
+            total -= entry.size
+
+
+def has_entry(model_dir):
+    with cache_lock:
+        entry = host_entries.get(os.path.abspath(model_dir))
+        return entry is not None and entry.complete
+
+
+def get_load_times():
+    load = current_load()
+    if load is None: return { "read_time": 0.0, "transfer_time": 0.0, "cache_hits": 0, "cache_misses": 0 }
+    return dict(load.times)
+
+
+def cache_status():
+    with cache_lock:
+        s = {}
+        s["budget"] = get_host_cache_budget()
+        s["models"] = { k: v.size for k, v in host_entries.items() }
+        s["complete"] = [k for k, v in host_entries.items() if v.complete]
+        return s
@@ -0,0 +1,336 @@
+import argparse, json, os, socket, struct, subprocess, sys, threading, time
+
+# Out-of-process inference. With --worker, the UI server runs models in a separate worker process and talks to it
+# over a Unix domain socket, so HTTP handling and JSON encoding don't compete with the token loop for the GIL, and a
+# worker that crashes or runs out of memory is restarted without taking down the UI.
+#
+# Protocol: one request per connection. Every frame is a 1-byte type and a 4-byte big-endian payload length:
+#
+#   Q  request, JSON { "op": ..., "args": {...} }
+#   P  packet, one JSON-lines packet exactly as the in-process endpoint would stream it
+#   E  end of response
+#   X  error, UTF-8 message
+#
+# Cancellation is a separate request (cancel_generate etc.), closing the connection mid-stream also cancels a
+# generation.
+# Sessions and notepads are shared through the config directory: the worker reloads them from disk for every request
+# and the UI reloads them after a generation
+
+frame_header = struct.Struct(">cI")
+
+
+def send_frame(sock, kind, payload = b""):
+    if isinstance(payload, str): payload = payload.encode("utf-8")
+    sock.sendall(frame_header.pack(kind, len(payload)) + payload)
+
+
+def recv_exact(sock, n):
+    buffer = bytearray()
+    while len(buffer) < n:
+        chunk = sock.recv(n - len(buffer))
+        if not chunk: raise EOFError("Connection closed")
+        buffer += chunk
+    return bytes(buffer)
+
+
+def recv_frame(sock):
+    kind, length = frame_header.unpack(recv_exact(sock, frame_header.size))
+    return kind, recv_exact(sock, length) if length > 0 else b""
+
+
+def default_socket_path(config_dir):
+    return os.path.join(os.path.expanduser(config_dir), "worker.sock")
+
+
+# Worker side
+
+def worker_ops():
+    import backend.models as models
+    import backend.sessions as sessions
+    import backend.notepads as notepads
+    from backend.runtime import runtime_status
+    from backend.streaming import DecoupledStream, FlushPolicy
+    from backend.settings import get_settings
+    import backend.jobs as jobs
+    import backend.speculation as speculation
+    import backend.grammar as grammar
+
+    session_objs = {}
+    notepad_objs = {}
+
+    # Keep one object per session/notepad for in-memory state (context heads) and refresh the rest from disk
+
+    def get_session(session_uuid):
+        s = session_objs.get(session_uuid)
+        if s is None:
+            s = sessions.Session(session_uuid)
+            session_objs[session_uuid] = s
+        s.load()
+        return s
+
+    def get_notepad(notepad_uuid):
+        n = notepad_objs.get(notepad_uuid)
+        if n is None:
+            n = notepads.Notepad(notepad_uuid)
+            notepad_objs[notepad_uuid] = n
+        n.load()
+        return n
+
+    def load_model(args):
+        models.load_models()
+        stream = DecoupledStream()
+        models.load_model(args, stream)
+        return stream
+
+    def load_progress(args):
+        load = models.get_load_job(args.get("job_id"))
+        if load is None:
+            yield json.dumps({ "result": "fail", "error": "Unknown load job." }) + "\n"
+            return
+        yield from load.stream()
+
+    def auto_fit_model(args):
+        models.load_models()
+        return { "result": "ok", "fit": models.auto_fit_model(args) }
+
+    def autotune_model(args):
+        from backend.autotune import autotune_model
+        models.load_models()
+        stream = DecoupledStream()
+        autotune_model(args, stream)
+        return stream
+
+    def list_models(args):
+        loaded_model = models.get_loaded_model()
+        current_model = loaded_model.get_uuid() if loaded_model is not None else None
+        return { "result": "ok", "current_model": current_model, "resident_models": models.list_resident_models() }
+
+    def count_tokens(args):
+        session_uuid = args.get("session_uuid")
+        loaded_model = get_session(session_uuid).get_model() if session_uuid else models.get_loaded_model()
+        if loaded_model is None: return { "result": "ok", "token_count": 0 }
+        return { "result": "ok", "token_count": loaded_model.tokenizer.encode(args["text"]).shape[-1] }
+
+    def cancel_generate(args):
+        return { "result": "ok", "canceled": sessions.set_cancel_signal(args.get("job_id")) }
+
+    def cancel_notepad_generate(args):
+        return { "result": "ok", "canceled": notepads.set_notepad_cancel_signal(args.get("job_id")) }
+
+    def notepad_tokenize(args):
+        return { "result": "ok", "tokenized_text": get_notepad(args["notepad_uuid"]).get_tokenized_text() }
+
+    ops = {}
+    ops["load_model"] = load_model
+    ops["load_progress"] = load_progress
+    ops["get_load_status"] = lambda args: { "result": "ok", "load_status": models.get_load_status(args.get("job_id")) }
+    ops["cancel_load"] = lambda args: { "result": "ok" if models.cancel_load(args.get("job_id")) else "fail" }
+    ops["unload_model"] = lambda args: models.unload_model()
+    ops["list_models"] = list_models
+    ops["auto_fit_model"] = auto_fit_model
+    ops["autotune_model"] = autotune_model
+    ops["runtime_status"] = lambda args: { "result": "ok", "runtime": runtime_status() }
+    ops["replica_status"] = lambda args: { "result": "ok", "replicas": models.get_replica_status() }
+    ops["count_tokens"] = count_tokens
+    def generate(args):
+        policy = FlushPolicy.from_settings(get_settings())
+        stream = DecoupledStream(None, sessions.set_cancel_signal, policy = policy)
+        get_session(args["session_uuid"]).generate(args["data"], stream, policy)
+        return stream
+
+    def notepad_generate(args):
+        policy = FlushPolicy.from_settings(get_settings())
+        stream = DecoupledStream(None, notepads.set_notepad_cancel_signal, policy = policy)
+        get_notepad(args["notepad_uuid"]).generate(args["data"], stream, policy)
+        return stream
+
+    ops["generate"] = generate
+    ops["cancel_generate"] = cancel_generate
+    ops["notepad_generate"] = notepad_generate
+    ops["notepad_single_token"] = lambda args: get_notepad(args["notepad_uuid"]).generate_single_token(args["data"])
+    ops["notepad_tokenize"] = notepad_tokenize
+    ops["cancel_notepad_generate"] = cancel_notepad_generate
+    ops["speculation_stats"] = lambda args: { "result": "ok", "speculation": speculation.speculation_stats() }
+    ops["grammar_stats"] = lambda args: { "result": "ok", "grammar": grammar.grammar_stats() }
+    ops["generation_jobs"] = lambda args: { "result": "ok", "generation_jobs": jobs.job_stats() }
+    return ops
+
+
+def handle_connection(conn, ops):
+    with conn:
+        try:
+            kind, payload = recv_frame(conn)
+            if kind != b"Q": raise ValueError(f"Expected request frame, got {kind}")
+            request = json.loads(payload)
+            op = ops[request["op"]]
+            result = op(request.get("args", {}))
+        except Exception as e:
+            try: send_frame(conn, b"X", type(e).__name__ + ": " + str(e))
+            except OSError: pass
+            return
+
+        if isinstance(result, dict):
+            send_frame(conn, b"P", json.dumps(result))
+            send_frame(conn, b"E")
+            return
+
+        # Streaming op. Closing the stream when the UI disconnects ends the job
+
+        try:
+            for packet in result:
+                send_frame(conn, b"P", packet)
+            send_frame(conn, b"E")
+        except OSError:
+            pass
+        except Exception as e:
+            try: send_frame(conn, b"X", type(e).__name__ + ": " + str(e))
+            except OSError: pass
+        finally:
+            result.close()
+
+
+def watch_parent(parent_pid):
+    # Exit if the UI server dies without stopping the worker (e.g. SIGKILL), the worker is reparented
+    while os.getppid() == parent_pid:
+        time.sleep(1.0)
+    print(" -- UI server exited, stopping inference worker")
+    os._exit(0)
+
+
+def run_worker(socket_path, config_dir, lazy_import = False):
+    from backend.config import set_config_dir, global_state
+    from backend.models import load_models, restore_last_model
+    from backend.runtime import start_runtime_import
+
+    threading.Thread(target = watch_parent, args = (os.getppid(),), daemon = True).start()
+
+    set_config_dir(config_dir)
+    global_state.load()
+    load_models()
+    if not lazy_import: start_runtime_import()
+    ops = worker_ops()
+
+    if os.path.exists(socket_path): os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(64)
+    print(f" -- Inference worker listening on {socket_path}")
+
+    restore_last_model()
+
+    while True:
+        conn, _ = server.accept()
+        threading.Thread(target = handle_connection, args = (conn, ops), daemon = True).start()
+
+
+# UI side
+
+class WorkerClient:
+
+    socket_path: str
+    config_dir: str
+    process: subprocess.Popen or None
+    restarts: int
+
+    connect_timeout = 30.0
+    restart_delay = 1.0
+    stop_timeout = 10.0
+
+    def __init__(self, socket_path, config_dir, lazy_import = False):
+        self.socket_path = socket_path
+        self.config_dir = config_dir
+        self.lazy_import = lazy_import
+        self.process = None
+        self.restarts = 0
+        self.stopping = False
+
+
+    def spawn(self):
+        app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        cmd = [sys.executable, "-m", "backend.worker", "--socket", self.socket_path, "--dir", self.config_dir]
+        if self.lazy_import: cmd.append("--lazy_import")
+        self.process = subprocess.Popen(cmd, cwd = app_dir)
+
+
+    def start(self):
+        self.spawn()
+        threading.Thread(target = self.supervise, daemon = True).start()
+
+
+    def supervise(self):
+        while not self.stopping:
+            code = self.process.wait()
+            if self.stopping: break
+            self.restarts += 1
+            print(f" !! Inference worker exited with code {code}, restarting")
+            time.sleep(self.restart_delay)
+            self.spawn()
+
+
+    def stop(self):
+        self.stopping = True
+        if self.process is None or self.process.poll() is not None: return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout = self.stop_timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        if os.path.exists(self.socket_path): os.remove(self.socket_path)
+
+
+    def connect(self):
+        deadline = time.time() + self.connect_timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.socket_path)
+                return sock
+            except OSError:
+                sock.close()
+                if time.time() > deadline: raise
+                time.sleep(0.1)
+
+
+    def stream(self, op, args = None):
+        """
+        Run op on the worker, yielding its JSON-lines packets
+        """
+
+        try:
+            sock = self.connect()
+        except OSError as e:
+            yield json.dumps({ "result": "fail", "error": f"Inference worker unavailable: {e}" }) + "\n"
+            return
+
+        with sock:
+            try:
+                send_frame(sock, b"Q", json.dumps({ "op": op, "args": args or {} }))
+                while True:
+                    kind, payload = recv_frame(sock)
+                    if kind == b"P": yield payload.decode("utf-8")
+                    elif kind == b"E": return
+                    else:
+                        yield json.dumps({ "result": "fail", "error": payload.decode("utf-8") }) + "\n"
+                        return
+            except (EOFError, OSError):
+                yield json.dumps({ "result": "fail", "error": "Inference worker exited." }) + "\n"
+
+
+    def call(self, op, args = None):
+        """
+        Run a non-streaming op, returning its result packet
+        """
+
+        result = None
+        for packet in self.stream(op, args):
+            result = json.loads(packet)
+        return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "ExUI inference worker")
+    parser.add_argument("--socket", type = str, required = True, help = "Unix domain socket to listen on")
+    parser.add_argument("-d", "--dir", type = str, default = "~/exui", help = "Location for user data and sessions")
+    parser.add_argument("-li", "--lazy_import", action = "store_true", help = "Import the inference stack on first model load")
+    args = parser.parse_args()
+    run_worker(args.socket, args.dir, args.lazy_import)
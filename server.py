@@ -1,19 +1,26 @@
-import sys, os, json, argparse
+import sys, os, json, argparse, atexit, signal
 from threading import Timer, Lock
 
 from flask import Flask, render_template, request
-from flask import Response, stream_with_context
+from flask import Response
 from waitress import serve
 import webbrowser
 
-import torch
-
-from backend.models import update_model, load_models, get_model_info, list_models, remove_model, load_model, unload_model, get_loaded_model
+from backend.models import update_model, load_models, get_model_info, list_models, remove_model, load_model, unload_model, get_loaded_model, get_load_status, get_load_job, cancel_load, restore_last_model, list_resident_models, auto_fit_model, rescan_models, get_replica_status
 from backend.config import set_config_dir, global_state
-from backend.sessions import list_sessions, set_session, get_session, get_default_session_settings, new_session, delete_session, set_cancel_signal
-from backend.notepads import list_notepads, set_notepad, get_notepad, get_default_notepad_settings, new_notepad, delete_notepad, set_notepad_cancel_signal
+from backend.sessions import list_sessions, set_session, restore_session, get_session, get_default_session_settings, new_session, delete_session, set_cancel_signal
+from backend.notepads import list_notepads, set_notepad, restore_notepad, get_notepad, get_default_notepad_settings, new_notepad, delete_notepad, set_notepad_cancel_signal
 from backend.prompts import list_prompt_formats
 from backend.settings import get_settings, set_settings
+from backend.runtime import start_runtime_import, runtime_status
+from backend.weightcache import cache_status
+from backend.estimate import estimate_vram
+from backend.autotune import autotune_model
+from backend.worker import WorkerClient, default_socket_path
+from backend.streaming import DecoupledStream, FlushPolicy
+from backend.jobs import job_stats
+from backend.speculation import speculation_stats
+from backend.grammar import grammar_stats
 
 
 if os.name == "nt":
@@ -38,11 +45,43 @@ parser.add_argument("-host", "--host", type = str, help = "IP:PORT eg, 0.0.0.0:5
 parser.add_argument("-d", "--dir", type = str, help = "Location for user data and sessions, default: ~/exui", default = "~/exui")
 parser.add_argument("-v", "--verbose", action = "store_true", help = "Verbose (debug) mode")
 parser.add_argument("-nb,", "--no_browser", action = "store_true", help = "Don't launch browser on startup")
+parser.add_argument("-li", "--lazy_import", action = "store_true", help = "Don't preload the inference stack (torch, ExLlamaV2) in the background, import on first model load")
+parser.add_argument("-w", "--worker", action = "store_true", help = "Run inference in a separate worker process, restarted if it crashes")
+parser.add_argument("-ws", "--worker_socket", type = str, help = "Unix domain socket for the inference worker, default: worker.sock in the user dir", default = None)
+parser.add_argument("-asgi", "--asgi", action = "store_true", help = "Serve with uvicorn (ASGI) instead of waitress, streams don't hold a thread each while waiting")
 args = parser.parse_args()
 
 verbose = args.verbose
 no_browser = args.no_browser
 
+# Inference worker process, if enabled. Endpoints that touch the model are forwarded to it
+
+worker: WorkerClient or None = None
+
+def then_reload(stream, reload_func):
+    # The worker saves sessions, notepads and model configs to the shared user dir, pick up its changes afterwards
+    yield from stream
+    reload_func()
+
+def new_stream(cancel = None, policy = None, gen = None):
+    # Generations, autotuning and loads are queued on the model replica's worker (or followed on the loading thread)
+    # and feed the stream, so the request returns without waiting for them. Streams from the worker process read a
+    # socket and get a producer thread for gen instead, see backend/streaming.py
+    return DecoupledStream(gen, cancel, request.environ.get("waitress.client_disconnected"), policy = policy)
+
+def stream_response(stream):
+    # The ASGI server finds the stream in the environ and drains it from its event loop instead of iterating it on a
+    # thread
+    if "exui.decoupled" in request.environ: request.environ["exui.decoupled"].append(stream)
+    return Response(stream, mimetype = 'application/json')
+
+def loaded_model_dict():
+    if worker is not None:
+        i = worker.call("list_models").get("current_model")
+        return get_model_info({ "model_uuid": i }) if i else None
+    model = get_loaded_model()
+    return model.model_dict if model is not None else None
+
 @app.route("/")
 def home():
     # global api_lock, verbose
@@ -50,6 +89,64 @@ def home():
     # with api_lock:
     return render_template("index.html")
 
+@app.route("/api/runtime_status")
+def api_runtime_status():
+    global verbose
+    if verbose: print("/api/runtime_status")
+    # No api_lock, must respond while a model is loading
+    if worker is not None:
+        result = worker.call("runtime_status")
+    else:
+        result = { "result": "ok", "runtime": runtime_status(), "host_cache": cache_status() }
+    if verbose: print("->", result)
+    return json.dumps(result) + "\n"
+
+@app.route("/api/replica_status")
+def api_replica_status():
+    global verbose
+    if verbose: print("/api/replica_status")
+    # No api_lock, reports on generations in progress
+    if worker is not None:
+        result = worker.call("replica_status")
+    else:
+        result = { "result": "ok", "replicas": get_replica_status() }
+    if verbose: print("->", result)
+    return json.dumps(result) + "\n"
+
+@app.route("/api/speculation_stats")
+def api_speculation_stats():
+    global verbose
+    if verbose: print("/api/speculation_stats")
+    if worker is not None:
+        result = worker.call("speculation_stats")
+    else:
+        result = { "result": "ok", "speculation": speculation_stats() }
+    if verbose: print("->", result)
+    return json.dumps(result) + "\n"
+
+@app.route("/api/grammar_stats")
+def api_grammar_stats():
+    global verbose
+    if verbose: print("/api/grammar_stats")
+    if worker is not None:
+        result = worker.call("grammar_stats")
+    else:
+        result = { "result": "ok", "grammar": grammar_stats() }
+    if verbose: print("->", result)
+    return json.dumps(result) + "\n"
+
+@app.route("/api/generation_jobs")
+def api_generation_jobs():
+    global verbose
+    if verbose: print("/api/generation_jobs")
+    # No api_lock, reports on generations in progress
+    if worker is not None:
+        result = worker.call("generation_jobs")
+    else:
+        result = { "result": "ok", "generation_jobs": job_stats() }
+    if verbose: print("->", result)
+    return json.dumps(result) + "\n"
+
 @app.route("/api/list_models")
 def api_list_models():
     global api_lock, verbose
@@ -58,7 +155,13 @@ def api_list_models():
         m, c = list_models()
         result = { "result": "ok",
                    "models": m,
-                   "current_model": c }
+                   "current_model": c,
+                   "resident_models": list_resident_models(),
+                   "prompt_formats": list_prompt_formats() }
+        if worker is not None:
+            w = worker.call("list_models")
+            result["current_model"] = w.get("current_model")
+            result["resident_models"] = w.get("resident_models", [])
         if verbose: print("->", result)
         return json.dumps(result) + "\n"
 
@@ -71,7 +174,8 @@ def api_get_model_info():
         if verbose: print("<-", data)
         info = get_model_info(data)
         if info: result = { "result": "ok",
-                            "model_info": info }
+                            "model_info": info,
+                            "vram_estimate": estimate_vram(info) }
         else: result = { "result": "fail" }
         if verbose: print("->", result)
         return json.dumps(result) + "\n"
@@ -88,6 +192,50 @@ def api_update_model():
         if verbose: print("->", result)
         return json.dumps(result) + "\n"
 
+@app.route("/api/rescan_models")
+def api_rescan_models():
+    global api_lock, verbose
+    if verbose: print("/api/rescan_models")
+    with api_lock:
+        status = rescan_models()
+        result = { "result": "ok", "config_status": status }
+        if verbose: print("->", result)
+        return json.dumps(result) + "\n"
+
+@app.route("/api/auto_fit_model", methods=['POST'])
+def api_auto_fit_model():
+    global api_lock, verbose
+    if verbose: print("/api/auto_fit_model")
+    with api_lock:
+        data = request.get_json()
+        if verbose: print("<-", data)
+        if worker is not None:
+            fit = worker.call("auto_fit_model", data).get("fit")
+            load_models()
+        else:
+            fit = auto_fit_model(data)
+        if fit: result = { "result": "ok", "fit": fit }
+        else: result = { "result": "fail", "error": "Model does not fit in available VRAM." }
+        if verbose: print("->", result)
+        return json.dumps(result) + "\n"
+
+@app.route("/api/autotune_model", methods=['POST'])
+def api_autotune_model():
+    global api_lock, verbose
+    if verbose: print("/api/autotune_model")
+    with api_lock:
+        data = request.get_json()
+        if verbose: print("<-", data)
+        if verbose: print("-> ...")
+        if worker is not None:
+            stream = new_stream(gen = then_reload(worker.stream("autotune_model", data), load_models))
+        else:
+            stream = new_stream()
+            autotune_model(data, stream)
+        result = stream_response(stream)
+        if verbose: print("->", result)
+        return result
+
 @app.route("/api/load_model", methods=['POST'])
 def api_load_model():
     global api_lock, verbose
@@ -96,16 +244,67 @@ def api_load_model():
         data = request.get_json()
         if verbose: print("<-", data)
         if verbose: print("-> ...")
-        result = Response(stream_with_context(load_model(data)), mimetype = 'application/json')
+        if worker is not None:
+            stream = new_stream(gen = then_reload(worker.stream("load_model", data), load_models))
+        else:
+            stream = new_stream()
+            load_model(data, stream)
+        result = stream_response(stream)
         if verbose: print("->", result)
         return result
 
+@app.route("/api/get_load_status")
+def api_get_load_status():
+    global verbose
+    if verbose: print("/api/get_load_status")
+    # No api_lock, must respond while a model is loading
+    if worker is not None:
+        result = worker.call("get_load_status", { "job_id": request.args.get("job_id") })
+    else:
+        result = { "result": "ok", "load_status": get_load_status(request.args.get("job_id")) }
+    if verbose: print("->", result)
+    return json.dumps(result) + "\n"
+
+@app.route("/api/load_progress/<job_id>")
+def api_load_progress(job_id):
+    global verbose
+    if verbose: print("/api/load_progress")
+    if worker is not None:
+        if verbose: print("-> ...")
+        stream = ("data: " + packet.rstrip("\n") + "\n\n" for packet in worker.stream("load_progress", { "job_id": job_id }))
+        return Response(stream, mimetype = 'text/event-stream', headers = { "Cache-Control": "no-cache" })
+    load = get_load_job(job_id)
+    if load is None:
+        result = { "result": "fail", "error": "Unknown load job." }
+        if verbose: print("->", result)
+        return json.dumps(result) + "\n", 404
+    if verbose: print("-> ...")
+    return Response(load.stream_sse(), mimetype = 'text/event-stream', headers = { "Cache-Control": "no-cache" })
+
+@app.route("/api/cancel_load", methods=['POST'])
+def api_cancel_load():
+    global api_lock_cancel, verbose
+    if verbose: print("/api/cancel_load")
+    with api_lock_cancel:
+        data = request.get_json(silent = True) or {}
+        if verbose: print("<-", data)
+        if worker is not None:
+            result = worker.call("cancel_load", data)
+        else:
+            canceled = cancel_load(data.get("job_id"))
+            result = { "result": "ok" if canceled else "fail" }
+        if verbose: print("->", result)
+        return json.dumps(result) + "\n"
+
 @app.route("/api/unload_model")
 def api_unload_model():
     global api_lock, verbose
     if verbose: print("/api/unload_model")
     with api_lock:
-        result = unload_model()
+        if worker is not None:
+            result = worker.call("unload_model")
+        else:
+            result = unload_model()
         if verbose: print("->", result)
         return json.dumps(result) + "\n"
 
@@ -127,7 +326,8 @@ def api_get_default_settings():
         result = { "result": "ok",
                    "session_settings": get_default_session_settings(use_model_params=False),  # Use hardcoded defaults
                    "notepad_settings": get_default_notepad_settings(),
-                   "prompt_formats": list_prompt_formats() }
+                   "prompt_formats": list_prompt_formats(),
+                   "models": list_models()[0] }
         return json.dumps(result) + "\n"
 
 @app.route("/api/set_session", methods=['POST'])
@@ -141,7 +341,8 @@ def api_set_session():
         if session is not None:
             result = { "result": "ok",
                        "session": session,
-                       "prompt_formats": list_prompt_formats() }
+                       "prompt_formats": list_prompt_formats(),
+                       "models": list_models()[0] }
             if verbose: print("-> (...)")
         else:
             result = { "result": "fail" }
@@ -237,6 +438,18 @@ def api_edit_block():
         if verbose: print("->", result)
         return json.dumps(result) + "\n"
 
+@app.route("/api/select_variant", methods=['POST'])
+def api_select_variant():
+    global api_lock, verbose
+    if verbose: print("/api/select_variant")
+    with api_lock:
+        s = get_session()
+        data = request.get_json()
+        if verbose: print("<-", data)
+        result = s.select_variant(data)
+        if verbose: print("->", result)
+        return json.dumps(result) + "\n"
+
 @app.route("/api/generate", methods=['POST'])
 def api_generate():
     global api_lock, verbose
@@ -246,7 +459,14 @@ def api_generate():
         if verbose: print("<-", data)
         s = get_session()
         if verbose: print("-> ...");
-        result = Response(stream_with_context(s.generate(data)), mimetype = 'application/json')
+        if worker is not None:
+            cancel = lambda job_id: worker.call("cancel_generate", { "job_id": job_id })
+            stream = new_stream(cancel, gen = then_reload(worker.stream("generate", { "session_uuid": s.session_uuid, "data": data }), s.load))
+        else:
+            policy = FlushPolicy.from_settings(get_settings())
+            stream = new_stream(set_cancel_signal, policy)
+            s.generate(data, stream, policy)
+        result = stream_response(stream)
         if verbose: print("->", result)
         return result
 
@@ -257,8 +477,12 @@ def api_count_tokens():
     with api_lock:
         data = request.get_json()
         if verbose: print("<-", data)
-        model = get_loaded_model()
-        if model is None:
+        # Count with the tokenizer of the model the current session generates with
+        s = get_session()
+        model = s.get_model() if s is not None else get_loaded_model()
+        if worker is not None:
+            result = worker.call("count_tokens", { "text": data["text"], "session_uuid": s.session_uuid if s is not None else None })
+        elif model is None:
             # If no model is loaded, return 0 tokens
             result = { "result": "ok", "token_count": 0 }
         else:
@@ -274,8 +498,9 @@ def api_cancel_generate():
     global api_lock_cancel, verbose
     if verbose: print("/api/cancel_generate")
     with api_lock_cancel:
-        set_cancel_signal()
-        result = { "result": "ok" }
+        job_id = request.args.get("job_id")
+        if worker is not None: result = worker.call("cancel_generate", { "job_id": job_id })
+        else: result = { "result": "ok", "canceled": set_cancel_signal(job_id) }
         if verbose: print("->", result)
         return result
 
@@ -346,9 +571,12 @@ def api_set_notepad():
         r = set_notepad(data)
         if r["notepad"] is not None:
             result = { "result": "ok",
-                       "notepad": r["notepad"] }
+                       "notepad": r["notepad"],
+                       "models": list_models()[0] }
             if "tokenized_text" in r:
                 result["tokenized_text"] = r["tokenized_text"]
+            if worker is not None:
+                result["tokenized_text"] = worker.call("notepad_tokenize", { "notepad_uuid": data["notepad_uuid"] }).get("tokenized_text")
             if verbose: print("-> (...)")
         else:
             result = { "result": "fail" }
@@ -417,11 +645,31 @@ def api_set_notepad_text():
         data = request.get_json()
         if verbose: print("<-", data)
         n.set_text(data["text"])
-        tokenized_text = n.get_tokenized_text()
+        if worker is not None:
+            tokenized_text = worker.call("notepad_tokenize", { "notepad_uuid": n.notepad_uuid }).get("tokenized_text")
+        else:
+            tokenized_text = n.get_tokenized_text()
         result = { "result": "ok", "tokenized_text": tokenized_text }
         if verbose: print("-> (...)")
         return json.dumps(result) + "\n"
 
+@app.route("/api/notepad_accept_branch", methods=['POST'])
+def api_notepad_accept_branch():
+    global api_lock, verbose
+    if verbose: print("/api/notepad_accept_branch")
+    with api_lock:
+        n = get_notepad()
+        data = request.get_json()
+        if verbose: print("<-", data)
+        result = n.accept_branch(data)
+        if result["result"] == "ok":
+            if worker is not None:
+                result["tokenized_text"] = worker.call("notepad_tokenize", { "notepad_uuid": n.notepad_uuid }).get("tokenized_text")
+            else:
+                result["tokenized_text"] = n.get_tokenized_text()
+        if verbose: print("-> (...)")
+        return json.dumps(result) + "\n"
+
 @app.route("/api/notepad_single_token", methods=['POST'])
 def api_notepad_single_token():
     global api_lock, verbose
@@ -430,7 +678,11 @@ def api_notepad_single_token():
         n = get_notepad()
         data = request.get_json()
         if verbose: print("<-", data)
-        result = n.generate_single_token(data)
+        if worker is not None:
+            result = worker.call("notepad_single_token", { "notepad_uuid": n.notepad_uuid, "data": data })
+            n.load()
+        else:
+            result = n.generate_single_token(data)
         if verbose: print("-> (...)")
         return json.dumps(result) + "\n"
 
@@ -444,7 +696,14 @@ def api_notepad_generate():
         if verbose: print("<-", data)
         n = get_notepad()
         if verbose: print("-> ...");
-        result = Response(stream_with_context(n.generate(data)), mimetype = 'application/json')
+        if worker is not None:
+            cancel = lambda job_id: worker.call("cancel_notepad_generate", { "job_id": job_id })
+            stream = new_stream(cancel, gen = then_reload(worker.stream("notepad_generate", { "notepad_uuid": n.notepad_uuid, "data": data }), n.load))
+        else:
+            policy = FlushPolicy.from_settings(get_settings())
+            stream = new_stream(set_notepad_cancel_signal, policy)
+            n.generate(data, stream, policy)
+        result = stream_response(stream)
         if verbose: print("->", result)
         return result
 
@@ -453,8 +712,9 @@ def api_cancel_notepad_generate():
     global api_lock_cancel, verbose
     if verbose: print("/api/cancel_notepad_generate")
     with api_lock_cancel:
-        set_notepad_cancel_signal()
-        result = { "result": "ok" }
+        job_id = request.args.get("job_id")
+        if worker is not None: result = worker.call("cancel_notepad_generate", { "job_id": job_id })
+        else: result = { "result": "ok", "canceled": set_notepad_cancel_signal(job_id) }
         if verbose: print("->", result)
         return result
 
@@ -463,12 +723,11 @@ def api_get_model_params():
     global api_lock, verbose
     if verbose: print("/api/get_model_params")
     with api_lock:
-        model = get_loaded_model()
-        if model is None:
+        model_dict = loaded_model_dict()
+        if model_dict is None:
             result = { "has_params": False }
         else:
             # Check if model has any sampling params defined
-            model_dict = model.model_dict
             # Track which parameters are defined in the model
             model_params = {
                 "temperature": "temperature" in model_dict,
@@ -492,7 +751,7 @@ def api_reset_to_app_defaults():
         session = get_session()
         if session is not None:
             # Get default settings
-            default_settings = get_default_session_settings(use_model_params=False)
+            default_settings = get_default_session_settings(use_model_params=False, model_uuid=session.settings.get("model_uuid"))
             
             # Define which parameters are sampling-related
             sampling_params = [
@@ -520,11 +779,10 @@ def api_apply_model_params():
     global api_lock, verbose
     if verbose: print("/api/apply_model_params")
     with api_lock:
-        model = get_loaded_model()
+        model_dict = loaded_model_dict()
         session = get_session()
-        if model is not None and session is not None:
+        if model_dict is not None and session is not None:
             # Get model's defined parameters
-            model_dict = model.model_dict
             updated_params = {}
             
             # Only update parameters that are defined in the model
@@ -550,10 +808,6 @@ def api_apply_model_params():
         return json.dumps(result) + "\n"
 
 
-# Prepare torch
-
-# torch.cuda._lazy_init()
-
 # Prepare config
 
 print(f" -- User dir: {args.dir}")
@@ -561,6 +815,31 @@ print(f" -- User dir: {args.dir}")
 set_config_dir(args.dir)
 global_state.load()
 load_models()
+restore_session()
+restore_notepad()
+
+if args.worker:
+
+    # Start the inference worker, which imports the inference stack and restores the last used model itself
+
+    worker = WorkerClient(args.worker_socket or default_socket_path(args.dir), args.dir, lazy_import = args.lazy_import)
+    worker.start()
+
+    # Stop the worker with the server, it holds VRAM and the socket. SIGTERM exits through atexit as well
+
+    atexit.register(worker.stop)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+else:
+
+    # Import inference stack in the background while the server starts
+
+    if not args.lazy_import:
+        start_runtime_import()
+
+    # Start loading the last used model in the background, clients can attach to its progress
+
+    restore_last_model()
 
 # Start server
 
@@ -576,4 +855,9 @@ print(f" -- Starting server on {host} port {port}")
 if browser_start:
     print(f" -- Opening UI in default web browser")
 
-serve(app, host = host, port = port, threads = 8)
+if args.asgi:
+    from backend.asgi import ASGIApp, serve_asgi
+    serve_asgi(ASGIApp(app, native_load_progress = worker is None), host, port)
+else:
+    # Request lookahead lets waitress notice clients that disconnect mid-stream (waitress.client_disconnected)
+    serve(app, host = host, port = port, threads = 8, channel_request_lookahead = 4)
@@ -2,11 +2,16 @@
 import * as util from "./util.js";
 import * as mainmenu from "./mainmenu.js";
 import * as globals from "./globals.js";
+import * as socket from "./socket.js";
 import * as controls from "./controls.js";
 import * as overlay from "./overlay.js";
 import * as chatsettings from "./chatsettings.js";
 import * as roles from "./roles.js";
 
+// Responses generated at once by "Alternatives"
+
+const numAlternatives = 3;
+
 // Copy button for code blocks
 
 const renderer = new marked.Renderer();
@@ -71,6 +76,10 @@ export class Chat {
         this.labels = new Map();
         this.currentView = null;
 
+        // List changes from other tabs
+
+        socket.onPush("sessions", () => { this.refreshSessionList(); });
+
         // Handle copy and save buttons in any dynamically added child elements
 
         layout.addEventListener('click', function(event) {
@@ -108,7 +117,7 @@ export class Chat {
     }
 
     onEnter(getResponse = false) {
-        fetch("/api/list_sessions")
+        socket.fetch("/api/list_sessions")
         .then(response => response.json())
         .then(response => {
             globals.receiveGlobals(response);
@@ -126,6 +135,8 @@ export class Chat {
                 this.addSession(response.sessions[session_uuid], session_uuid);
 
         this.addSession("New session", "new");
+        if (!this.lastSessionUUID && response.current_session && response.sessions.hasOwnProperty(response.current_session))
+            this.lastSessionUUID = response.current_session;
         let m = this.lastSessionUUID ? this.lastSessionUUID : "new";
         this.setSession(m, getResponse);
     }
@@ -158,7 +169,28 @@ export class Chat {
         this.labels.set(sessionID, label);
     }
 
-    setSession(sessionID, getResponse = false) {
+    refreshSessionList() {
+        socket.fetch("/api/list_sessions")
+        .then(response => response.json())
+        .then(response => {
+            this.sessionList.innerHTML = "";
+            this.items = new Map();
+            this.labels = new Map();
+
+            for (let session_uuid in response.sessions)
+                if (response.sessions.hasOwnProperty(session_uuid))
+                    this.addSession(response.sessions[session_uuid], session_uuid);
+
+            this.addSession("New session", "new");
+
+            // Keep the current view unless its session was deleted
+
+            if (this.items.has(this.lastSessionUUID)) this.markSession(this.lastSessionUUID);
+            else this.setSession("new");
+        });
+    }
+
+    markSession(sessionID) {
         this.items.forEach((v, k) => {
             let div = this.items.get(k);
             if (k == sessionID) {
@@ -171,6 +203,10 @@ export class Chat {
             let label = this.labels.get(k);
             label.setEditable(k == sessionID);
         });
+    }
+
+    setSession(sessionID, getResponse = false) {
+        this.markSession(sessionID);
 
         this.currentView = new SessionView(sessionID, this);
         this.currentView.updateView(getResponse);
@@ -186,7 +222,7 @@ export class Chat {
         let packet = {};
         packet.session_uuid = this.currentView.sessionID;
         util.assert(packet.session_uuid == this.lastSessionUUID);
-        fetch("/api/delete_session", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
+        socket.fetch("/api/delete_session", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
         .then(response => response.json())
         .then(response => {
             this.lastSessionUUID = util.getNextKey(this.items, sessionID);
@@ -237,7 +273,7 @@ class SessionView {
     async countTokens(text) {
         // Get real token count from server
         try {
-            const response = await fetch("/api/count_tokens", {
+            const response = await socket.fetch("/api/count_tokens", {
                 method: "POST",
                 headers: { "Content-Type": "application/json" },
                 body: JSON.stringify({ text: text })
@@ -318,7 +354,7 @@ const debounce = (func, delay) => {
 
     updateView(getResponse = false) {
         if (!this.sessionID || this.sessionID == "new") {
-            fetch("/api/get_default_settings")
+            socket.fetch("/api/get_default_settings")
             .then(response => response.json())
             .then(response => {
                 globals.receiveGlobals(response);
@@ -330,7 +366,7 @@ const debounce = (func, delay) => {
         } else {
             let packet = {};
             packet.session_uuid = this.sessionID;
-            fetch("/api/set_session", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
+            socket.fetch("/api/set_session", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
             .then(response => response.json())
             .then(response => {
                 globals.receiveGlobals(response);
@@ -364,13 +400,13 @@ const debounce = (func, delay) => {
         let packet = {};
         packet.new_name = new_name;
         if (!this.sessionID || this.sessionID == "new") {
-            fetch("/api/new_session", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
+            socket.fetch("/api/new_session", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
             .then(response => response.json())
             .then(response => {
                 if (post) post(response);
             });
         } else {
-            fetch("/api/rename_session", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
+            socket.fetch("/api/rename_session", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
             .then(response => response.json())
             .then(response => {
                 if (post) post(response);
@@ -399,7 +435,7 @@ const debounce = (func, delay) => {
             if (input && input != "") {
                 let packet = {};
                 packet.user_input_text = input;
-                fetch("/api/new_session", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
+                socket.fetch("/api/new_session", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
                 .then(response => response.json())
                 .then(response => {
                     //console.log(response);
@@ -411,7 +447,7 @@ const debounce = (func, delay) => {
             if (input && input != "") {
                 let packet = {};
                 packet.user_input_text = input;
-                fetch("/api/user_input", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
+                socket.fetch("/api/user_input", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
                 .then(response => response.json())
                 .then(response => {
                     this.setChatBlock(response.new_block);
@@ -448,7 +484,9 @@ const debounce = (func, delay) => {
     }
 
     cancelGen() {
-        fetch("/api/cancel_generate")
+        let url = "/api/cancel_generate";
+        if (this.jobID) url += "?job_id=" + this.jobID;
+        socket.fetch(url)
         .then(response => response.json())
         .then(response => {
         });
@@ -472,12 +510,14 @@ const debounce = (func, delay) => {
         });
     }
 
-    getModelResponse(block_id = null, prefix = null) {
+    getModelResponse(block_id = null, prefix = null, alternatives = 1) {
 
         this.disableInput();
         let packet = {};
         packet.block_id = block_id;
         packet.prefix = prefix;
+        packet.alternatives = alternatives;
+        packet.framing = "compact";
 
         let timeout = new Promise((resolve, reject) => {
             let id = setTimeout(() => {
@@ -486,7 +526,7 @@ const debounce = (func, delay) => {
             }, 180000)
         });
 
-        let fetchRequest = fetch("/api/generate", {
+        let fetchRequest = socket.fetch("/api/generate", {
             method: "POST",
             headers: { "Content-Type": "application/json", },
             body: JSON.stringify(packet)
@@ -526,6 +566,7 @@ const debounce = (func, delay) => {
                     }
                     if (json.result == "fail") {
                         console.error('Error:', json.error);
+                        self.jobID = null;
                         self.enableInput();
                         self.focusInputField();
                         return;
@@ -548,6 +589,19 @@ const debounce = (func, delay) => {
 
         this.stickyScroll = this.isNearBottom();
 
+        // Compact framing, [1, text] is text for the block being streamed
+
+        if (Array.isArray(response)) {
+            if (response[0] == 1) this.currentStreamingBlock.appendText(response[1]);
+            if (response[0] == 2) this.currentStreamingBlock.appendVariantText(response[1], response[2]);
+            if (this.stickyScroll) this.scrollToBottom();
+            return;
+        }
+
+        if (response.result == "job") {
+            this.jobID = response.job_id;
+        }
+
         if (response.result == "begin_block") {
             this.currentStreamingBlock = this.setChatBlock(response.block);
         }
@@ -560,12 +614,18 @@ const debounce = (func, delay) => {
             this.currentStreamingBlock.appendText(response.text);
         }
 
+        if (response.result == "stream_to_variant") {
+            this.currentStreamingBlock.appendVariantText(response.variant, response.text);
+        }
+
         if (response.result == "ok") {
+            this.jobID = null;
             this.currentStreamingBlock.set(response.new_block);
         }
 
-        if (response.result == "cancel_pre") {
-            // Handle cancel
+        if (response.result == "cancel") {
+            // Canceled before generating
+            this.jobID = null;
         }
 
         if (response.result == "refresh_settings") {
@@ -650,6 +710,7 @@ class ChatBlock {
         this.updateAvatarImg();
         this.updateText();
         this.updateMeta();
+        this.updateVariants();
     }
 
     getRoleID()
@@ -711,6 +772,42 @@ class ChatBlock {
         this.updateText();
     }
 
+    appendVariantText(variant, new_text) {
+        this.block.variants[variant] += new_text;
+        if (variant == this.block.variant) this.appendText(new_text);
+    }
+
+    updateVariants() {
+        if (!this.block.variants || this.block.variants.length < 2) return;
+        let current = this.block.variant || 0;
+        let p = document.createElement('p');
+        p.classList.add("meta");
+        let prev = document.createElement("span");
+        prev.classList.add("action");
+        prev.innerHTML = "‹";
+        prev.addEventListener('click', () => { this.selectVariant(current - 1); });
+        let next = document.createElement("span");
+        next.classList.add("action");
+        next.innerHTML = "›";
+        next.addEventListener('click', () => { this.selectVariant(current + 1); });
+        p.appendChild(prev);
+        p.appendChild(document.createTextNode(" " + (current + 1) + " / " + this.block.variants.length + " "));
+        p.appendChild(next);
+        this.textBlock.appendChild(p);
+    }
+
+    selectVariant(variant) {
+        if (variant < 0 || variant >= this.block.variants.length) return;
+        let packet = {};
+        packet.block_uuid = this.block.block_uuid;
+        packet.variant = variant;
+        socket.fetch("/api/select_variant", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
+        .then(response => response.json())
+        .then(response => {
+            if (response.result == "ok") this.set(response.block);
+        });
+    }
+
     cancelSpinner() {
         if (this.spinnerTimeout) {
             clearTimeout(this.spinnerTimeout);
@@ -751,6 +848,16 @@ class ChatBlock {
             let html = "prompt: " + this.block.meta.prompt_tokens.toFixed(0) + " tokens, " + ptps + " tokens/s ";
             html += " ⁄ ";
             html += "response: " + this.block.meta.gen_tokens.toFixed(0) + " tokens, " + this.block.meta.gen_speed.toFixed(2) + " tokens/s ";
+            if (this.block.meta.draft_tokens > 0) {
+                html += " ⁄ ";
+                html += this.block.meta.speculative_mode.toLowerCase() + ": " + (this.block.meta.acceptance_rate * 100).toFixed(0) + "% accepted ";
+            }
+            if (this.block.meta.grammar_filter_time !== undefined) {
+                html += " ⁄ ";
+                html += "grammar: " + (this.block.meta.grammar_time_per_token * 1000).toFixed(2) + " ms/token";
+                if (this.block.meta.grammar_compile_time >= 0.01) html += ", compiled in " + this.block.meta.grammar_compile_time.toFixed(2) + " s";
+                html += " ";
+            }
             html += " ⁄ ";
             html += "context: " + contextPercent + "% full";
             p.innerHTML = html;
@@ -794,6 +901,11 @@ class ChatBlock {
                 this.regenerateBlock(this);
             });
             this.popup.appendChild(item);
+            item = util.newDiv(null, "action", "⧻ Alternatives");
+            item.addEventListener('click', () => {
+                this.regenerateBlock(this, numAlternatives);
+            });
+            this.popup.appendChild(item);
             item = util.newDiv(null, "action", "⤑ Complete");
             item.addEventListener('click', () => {
                 this.completeBlock(this);
@@ -823,7 +935,7 @@ class ChatBlock {
         let packet = {};
         packet.block_uuid = this.block.block_uuid;
         packet.delete_from_here = deletefromhere;
-        fetch("/api/delete_block", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
+        socket.fetch("/api/delete_block", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
         .then(response => response.json())
         .then(response => {
             this.parent.removeBlock(this, deletefromhere);
@@ -848,7 +960,7 @@ class ChatBlock {
             new_block.meta = null;
             let packet = {};
             packet.block = new_block;
-            fetch("/api/edit_block", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
+            socket.fetch("/api/edit_block", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
             .then(response => response.json())
             .then(response => {
                 this.block = new_block;
@@ -899,14 +1011,14 @@ class ChatBlock {
         if (this.ddTimeout) clearTimeout(this.ddTimeout);
     }
 
-    regenerateBlock(block) {
+    regenerateBlock(block, alternatives = 1) {
         if (!globals.g.loadedModelUUID) return;
         block.block.text = "";
         block.updateText();
         if (block.parent.isNearBottom())
             block.parent.stickyScroll = true;
         block.parent.currentStreamingBlock = block;
-        block.parent.getModelResponse(block.block.block_uuid, null);
+        block.parent.getModelResponse(block.block.block_uuid, null, alternatives);
     }
 
     completeBlock(block) {
@@ -1,6 +1,7 @@
 import * as util from "./util.js";
 import * as mainmenu from "./mainmenu.js";
 import * as globals from "./globals.js";
+import * as socket from "./socket.js";
 import * as controls from "./controls.js";
 import * as overlay from "./overlay.js";
 
@@ -25,6 +26,7 @@ export class SessionSettings {
         this.sss_sampling = new controls.CollapsibleSection(null, "Sampling");
         this.sss_stopConditions = new controls.CollapsibleSection(null, "Stop conditions");
         this.sss_bannedStrings = new controls.CollapsibleSection(null, "Banned strings");
+        this.sss_grammar = new controls.CollapsibleSection(null, "Grammar");
         this.element.appendChild(this.sss_promptFormat.element);
         this.element.appendChild(this.sss_roles.element);
         this.element.appendChild(this.sss_systemPrompt.element);
@@ -32,6 +34,7 @@ export class SessionSettings {
         this.element.appendChild(this.sss_sampling.element);
         this.element.appendChild(this.sss_stopConditions.element);
         this.element.appendChild(this.sss_bannedStrings.element);
+        this.element.appendChild(this.sss_grammar.element);
 
         // Prompt format
 
@@ -58,6 +61,9 @@ export class SessionSettings {
 
         // Generation params
 
+        this.sss_i_model = new controls.LabelCombobox("sss-item-left", "Model", "sss-item-right sss-item-combobox", globals.modelOptions(), this.settings, "model_uuid", () => { this.updateView(true); } );
+        this.sss_genParams.inner.appendChild(this.sss_i_model.element);
+
         this.sss_i_minTokens   = new controls.SettingsSlider("sss-item-left", "Min tokens",    "sss-item-mid", "sss-item-right sss-item-textbox-r", 0,  1, 8192, null,                             this.settings, "mintokens",    () => { this.updateView(true); });
         this.sss_i_maxTokens   = new controls.SettingsSlider("sss-item-left", "Max tokens",    "sss-item-mid", "sss-item-right sss-item-textbox-r", 0, 16, 8192, null,                             this.settings, "maxtokens",    () => { this.updateView(true); });
         this.sss_i_chunkTokens = new controls.SettingsSlider("sss-item-left", "Chunk tokens",  "sss-item-mid", "sss-item-right sss-item-textbox-r", 0, 16, 8192, null,                             this.settings, "chunktokens",  () => { this.updateView(true); });
@@ -65,6 +71,9 @@ export class SessionSettings {
         this.sss_genParams.inner.appendChild(this.sss_i_maxTokens.element);
         this.sss_genParams.inner.appendChild(this.sss_i_chunkTokens.element);
 
+        this.sss_i_lora = new controls.LabelTextbox("sss-item-left", "LoRA", "sss-item-mid sss-item-textbox", "None", this.settings, "lora", null, () => { this.updateView(true); }, null);
+        this.sss_genParams.inner.appendChild(this.sss_i_lora.element);
+
         // Sampling
 
         this.sss_i_temperature      = new controls.SettingsSlider("sss-item-left", "Temperature",   "sss-item-mid", "sss-item-right sss-item-textbox-r", 2,     0,    5, null,                             this.settings, "temperature",  () => { this.updateView(true); });
@@ -161,7 +170,7 @@ export class SessionSettings {
         // Function to check if any sampling parameter differs from model defaults
         const checkModelParamsDiffer = async () => {
             try {
-                const response = await fetch("/api/get_model_params");
+                const response = await socket.fetch("/api/get_model_params");
                 const data = await response.json();
                 if (!data.model_params) return { hasDifferences: false, diffParams: {} };
                 
@@ -188,7 +197,7 @@ export class SessionSettings {
         // Function to check if any sampling parameter differs from app defaults
         const checkSamplingParamsDiffer = async () => {
             try {
-                const response = await fetch("/api/get_default_settings");
+                const response = await socket.fetch("/api/get_default_settings");
                 const data = await response.json();
                 if (!data.session_settings) return false;
                 
@@ -296,11 +305,11 @@ export class SessionSettings {
         // Initialize model defaults
         const initModelDefaults = async () => {
             try {
-                const paramsResponse = await fetch("/api/get_model_params");
+                const paramsResponse = await socket.fetch("/api/get_model_params");
                 const paramsData = await paramsResponse.json();
                 
                 if (paramsData.has_params && paramsData.model_params) {
-                    const modelResponse = await fetch("/api/apply_model_params", {
+                    const modelResponse = await socket.fetch("/api/apply_model_params", {
                         method: "POST",
                         headers: { "Content-Type": "application/json" }
                     });
@@ -328,6 +337,13 @@ export class SessionSettings {
         this.sss_i_bannedStrings = new controls.LargeTextbox("sss-item-big-textbox", "Banned strings...", this.settings, "banned_strings", null, () => { this.updateView(true); }, true);
         this.sss_bannedStrings.inner.appendChild(this.sss_i_bannedStrings.element);
 
+        // Grammar
+
+        this.sss_i_grammarMode = new controls.LabelCombobox("sss-item-left", "Constrain to", "sss-item-right sss-item-combobox", [ "None", "Regex", "JSON schema" ], this.settings, "grammar_mode", () => { this.updateView(true); } );
+        this.sss_i_grammar = new controls.LargeTextbox("sss-item-big-textbox", "Regex or JSON schema...", this.settings, "grammar", null, () => { this.updateView(true); }, true);
+        this.sss_grammar.inner.appendChild(this.sss_i_grammarMode.element);
+        this.sss_grammar.inner.appendChild(this.sss_i_grammar.element);
+
         // .
 
         this.updateView();
@@ -393,7 +409,7 @@ export class SessionSettings {
 
     async resetToAppDefaults() {
         try {
-            const response = await fetch("/api/reset_to_app_defaults", {
+            const response = await socket.fetch("/api/reset_to_app_defaults", {
                 method: "POST",
                 headers: { "Content-Type": "application/json" }
             });
@@ -417,11 +433,11 @@ export class SessionSettings {
 
     async applyModelDefaults() {
         try {
-            const paramsResponse = await fetch("/api/get_model_params");
+            const paramsResponse = await socket.fetch("/api/get_model_params");
             const paramsData = await paramsResponse.json();
             
             if (paramsData.has_params) {
-                const modelResponse = await fetch("/api/apply_model_params", {
+                const modelResponse = await socket.fetch("/api/apply_model_params", {
                     method: "POST",
                     headers: { "Content-Type": "application/json" }
                 });
@@ -453,7 +469,7 @@ export class SessionSettings {
                 ? "/api/new_session"
                 : "/api/update_settings";
 
-            const response = await fetch(endpoint, {
+            const response = await socket.fetch(endpoint, {
                 method: "POST",
                 headers: { "Content-Type": "application/json" },
                 body: JSON.stringify(packet)
@@ -297,7 +297,12 @@ export class LabelCombobox {
 
         this.cb = document.createElement("select");
         this.cb.className = className;
-        for (let i = 0; i < options.length; i++) this.cb.add(new Option(options[i], options[i]));
+        // options is a list of values, or an object mapping values to the labels shown
+        if (Array.isArray(options)) {
+            for (let i = 0; i < options.length; i++) this.cb.add(new Option(options[i], options[i]));
+        } else {
+            for (const [value, text] of Object.entries(options)) this.cb.add(new Option(text, value));
+        }
 
         this.cb.addEventListener("change", (event) => {
             this.data[this.data_id] = this.cb.value;
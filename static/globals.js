@@ -20,6 +20,7 @@ export const g = {
 
     promptFormats: null,
     promptFormatsOptions: null,
+    modelNames: null,
     smoothScrolling: true,
 
 }
@@ -29,6 +30,7 @@ export const g = {
 export function receiveGlobals(response) {
     if (response.current_model) g.loadedModelUUID = response.current_model;
     if (response.current_session) g.currentSessionUUID = response.current_model;
+    if (response.models) g.modelNames = response.models;
     if (response.prompt_formats) {
         g.promptFormats = [];
         g.promptFormatsOptions = {};
@@ -39,4 +41,11 @@ export function receiveGlobals(response) {
             g.promptFormatsOptions[name] = response.prompt_formats[i];
         }
     }
-}
\ No newline at end of file
+}
+//  Options for a session's or notepad's model, "" generates with the active model
+
+export function modelOptions() {
+    let options = { "": "Active model" };
+    if (g.modelNames) Object.assign(options, g.modelNames);
+    return options;
+}
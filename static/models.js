@@ -1,6 +1,7 @@
 import * as util from "./util.js";
 import * as mainmenu from "./mainmenu.js";
 import * as globals from "./globals.js";
+import * as socket from "./socket.js";
 import * as controls from "./controls.js";
 import * as overlay from "./overlay.js";
 
@@ -31,6 +32,24 @@ export class Models {
         this.labels = new Map();
         this.currentView = null;
 
+        // Model state changes from other tabs or background loads
+
+        socket.onPush("models", (data) => {
+            globals.g.loadedModelUUID = data.current_model;
+            this.setLoadedModel(globals.g.loadedModelUUID);
+        });
+
+        // Loads started elsewhere (another tab, or autoload) show their progress here while the page is open. Loads
+        // started from this tab are followed through their own stream
+
+        this.followedLoadJob = null;
+        this.loadingHere = false;
+        socket.onPush("model_load", (data) => {
+            if (this.page.style.display == "none" || this.loadingHere || this.followedLoadJob) return;
+            if (data.packet.result != "job" && data.packet.result != "progress") return;
+            this.attachLoad();
+        });
+
 
         this.lastModelUUID = null;
 
@@ -38,11 +57,64 @@ export class Models {
     }
 
     onEnter() {
-        fetch("/api/list_models")
+        socket.fetch("/api/list_models")
         .then(response => response.json())
         .then(response => {
             globals.receiveGlobals(response);
             this.populateModelList(response);
+            this.attachLoad();
+        });
+    }
+
+    attachLoad() {
+        if (this.followedLoadJob) return;
+        this.followedLoadJob = true;
+
+        socket.fetch("/api/get_load_status")
+        .then(response => response.json())
+        .then(response => {
+            let status = response.load_status;
+            if (!status || status.done || this.loadingHere) {
+                this.followedLoadJob = null;
+                return;
+            }
+            this.followedLoadJob = status.job_id;
+
+            overlay.loadingOverlay.setProgress(status.module, status.num_modules || 1);
+            overlay.pageOverlay.setMode("loading");
+
+            let source = new EventSource("/api/load_progress/" + status.job_id);
+            overlay.loadingOverlay.onCancel = () => {
+                let packet = {};
+                packet.job_id = status.job_id;
+                socket.fetch("/api/cancel_load", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) });
+            };
+            source.onmessage = (event) => {
+                let json = JSON.parse(event.data);
+                if (json.result == "progress") {
+                    overlay.loadingOverlay.setProgress(json.module, json.num_modules);
+                    return;
+                }
+                source.close();
+                this.followedLoadJob = null;
+                overlay.pageOverlay.setMode();
+                if (json.result == "ok") {
+                    globals.g.loadedModelUUID = status.model_uuid;
+                    globals.g.failedModelUUID = null;
+                } else if (json.result != "cancel") {
+                    globals.g.failedModelUUID = status.model_uuid;
+                }
+                this.setLoadedModel(globals.g.loadedModelUUID);
+                if (this.currentView) this.currentView.updateView();
+            };
+            source.onerror = () => {
+                source.close();
+                this.followedLoadJob = null;
+                overlay.pageOverlay.setMode();
+            };
+        })
+        .catch(() => {
+            this.followedLoadJob = null;
         });
     }
 
@@ -166,7 +238,7 @@ export class Models {
     removeModel() {
         let packet = {};
         packet.model_uuid = this.lastModelUUID;
-        fetch("/api/remove_model", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
+        socket.fetch("/api/remove_model", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
         .then(response => response.json())
         .then(response => {
             this.lastModelUUID = null;
@@ -209,10 +281,11 @@ export class ModelView {
          } else {
             let packet = {};
             packet.model_uuid = this.modelID;
-            fetch("/api/get_model_info", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
+            socket.fetch("/api/get_model_info", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
             .then(response => response.json())
             .then(response => {
                 Object.assign(this.modelInfo, response.model_info);
+                this.modelInfo_compiled.vram = this.compileEstimate(response.vram_estimate);
                 this.updateView_();
             });
         }
@@ -232,7 +305,7 @@ export class ModelView {
                 this.modelInfo.name = folderName;
             }
         }
-        fetch("/api/update_model", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
+        socket.fetch("/api/update_model", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
         .then(response => response.json())
         .then(response => {
             if (response.new_model_uuid) {
@@ -284,6 +357,11 @@ export class ModelView {
             this.tb_chunk_size.refresh();
             this.tb_tp.refresh();
             this.tb_gpu_split.refresh();
+            this.tb_replicas.refresh();
+            this.tb_loras.refresh();
+            this.cb_prompt_format.refresh();
+            this.tb_auto_fit.refresh();
+            this.text_vram.refresh();
 
             this.cb_speculative.refresh();
             if (this.modelInfo.speculative_mode == "Draft model") {
@@ -351,6 +429,12 @@ export class ModelView {
         return s;
     }
 
+    compileEstimate(e) {
+        if (!e) return "";
+        let gb = (b) => (b / 1024**3).toFixed(2);
+        return gb(e.total) + " GB (weights: " + gb(e.weights) + ", cache: " + gb(e.cache) + ", scratch: " + gb(e.scratch) + ")";
+    }
+
     populate() {
         this.element.innerHTML = "";
 
@@ -409,6 +493,11 @@ export class ModelView {
         this.tb_chunk_size = new controls.LabelNumbox("model-view-item-left", "Chunk size", "model-view-item-textbox shortright", "", this.modelInfo, "chunk_size", 32, 1024*1024, 0, () => { this.send() } );
         this.tb_tp = new controls.LabelCheckbox("model-view-item-left", "TP (experimental)", "model-view-item-right checkbox", "Enabled", this.modelInfo, "tensor_p", () => { this.send() } );
         this.tb_gpu_split = new controls.LabelTextbox("model-view-item-left", "GPU split", "model-view-item-textbox short", "8.5,12", this.modelInfo, "gpu_split", null, () => { this.send() }, "gpu_split_auto" );
+        this.tb_replicas = new controls.LabelTextbox("model-view-item-left", "Replicas", "model-view-item-textbox short", "0;1", this.modelInfo, "replicas", null, () => { this.send() } );
+        this.tb_loras = new controls.LabelTextbox("model-view-item-left", "LoRA adapters", "model-view-item-textbox short", "name=~/loras/x; ...", this.modelInfo, "loras", null, () => { this.send() } );
+        this.cb_prompt_format = new controls.LabelCombobox("model-view-item-left", "Prompt format", "model-view-item-combobox short", globals.g.promptFormats || [], this.modelInfo, "prompt_format", () => { this.send() } );
+        this.tb_auto_fit = new controls.LabelCheckbox("model-view-item-left", "Auto-fit context", "model-view-item-right checkbox", "Enabled", this.modelInfo, "auto_fit", () => { this.send() } );
+        this.text_vram = new controls.LabelText("model-view-item-left", "Est. VRAM", "model-view-item-right", this.modelInfo_compiled, "vram");
 //        this.chbk_ngram = new controls.LabelCheckbox("model-view-item-left", "N-gram decoding", "model-view-item-right checkbox", "Enabled", this.modelInfo, "speculative_ngram", () => { this.send() } );
 
         this.element_model.appendChild(this.tb_seq_len.element);
@@ -418,6 +507,11 @@ export class ModelView {
         this.element_model.appendChild(this.tb_chunk_size.element);
         this.element_model.appendChild(this.tb_tp.element);
         this.element_model.appendChild(this.tb_gpu_split.element);
+        this.element_model.appendChild(this.tb_replicas.element);
+        this.element_model.appendChild(this.tb_loras.element);
+        this.element_model.appendChild(this.cb_prompt_format.element);
+        this.element_model.appendChild(this.tb_auto_fit.element);
+        this.element_model.appendChild(this.text_vram.element);
 //        this.element_model.appendChild(this.chbk_ngram.element);
 
         // Speculative decoding
@@ -428,7 +522,7 @@ export class ModelView {
 
 //        this.chbk_speculative = new controls.LabelCheckbox("model-view-item-left", "Speculative decoding", "model-view-item-right checkbox", "Enabled", this.modelInfo, "draft_enabled", () => { this.send() } );
 //        this.element_model.appendChild(this.chbk_speculative.element);
-        this.cb_speculative = new controls.LabelCombobox("model-view-item-left", "Speculative decoding", "model-view-item-combobox short", [ "None", "N-gram", "Draft model" ], this.modelInfo, "speculative_mode", () => { this.send() } );
+        this.cb_speculative = new controls.LabelCombobox("model-view-item-left", "Speculative decoding", "model-view-item-combobox short", [ "None", "N-gram", "Prompt lookup", "Draft model", "Auto" ], this.modelInfo, "speculative_mode", () => { this.send() } );
         this.element_model.appendChild(this.cb_speculative.element);
 
         this.element_draft_model = util.newHFlex();
@@ -515,14 +609,20 @@ export class ModelView {
             }, 10000)
         });
 
+        this.loadJobID = null;
+        this.parent.loadingHere = true;
         overlay.loadingOverlay.onCancel = () => {
+            let cancelPacket = {};
+            cancelPacket.job_id = this.loadJobID;
+            socket.fetch("/api/cancel_load", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(cancelPacket) });
             controller.abort();
+            this.parent.loadingHere = false;
             overlay.pageOverlay.setMode();
             this.error_message = "Loading cancelled";
             this.updateView();
         };
 
-        let fetchRequest = fetch("/api/load_model", {
+        let fetchRequest = socket.fetch("/api/load_model", {
             method: "POST",
             headers: { "Content-Type": "application/json", },
             body: JSON.stringify(packet),
@@ -544,6 +644,7 @@ export class ModelView {
             let data = '';
             reader.read().then(function process({done, value}) {
                 if (done) {
+                    self.parent.loadingHere = false;
                     overlay.pageOverlay.setMode();
                     //self.error_message = null;
                     //self.parent.setLoadedModel(self.modelID);
@@ -568,6 +669,11 @@ export class ModelView {
                     } else if (json.result == "progress") {
                         overlay.loadingOverlay.setProgress(json.module, json.num_modules);
                         //console.log(json);
+                    } else if (json.result == "job") {
+                        self.loadJobID = json.job_id;
+                    } else if (json.result == "cancel") {
+                        globals.g.loadedModelUUID = null;
+                        self.error_message = "Loading cancelled";
                     } else {
                         globals.g.loadedModelUUID = null;
                         globals.g.failedModelUUID = packet.model_uuid;
@@ -584,6 +690,7 @@ export class ModelView {
             globals.g.failedModelUUID = packet.model_uuid;
             this.error_message = "" + error;
             console.error('Error:', error);
+            this.parent.loadingHere = false;
             overlay.pageOverlay.setMode();
             this.parent.setLoadedModel(null);
             this.updateView();
@@ -595,7 +702,7 @@ export class ModelView {
         overlay.loadingOverlay.setProgress(0, 1);
         overlay.pageOverlay.setMode("busy");
 
-        fetch("/api/unload_model")
+        socket.fetch("/api/unload_model")
         .then(response => response.json())
         .then(json => {
             if (json.result == "ok") {
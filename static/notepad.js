@@ -1,11 +1,14 @@
 import * as util from "./util.js";
 import * as mainmenu from "./mainmenu.js";
 import * as globals from "./globals.js";
+import * as socket from "./socket.js";
 import * as controls from "./controls.js";
 import * as overlay from "./overlay.js";
 import * as notepadsettings from "./notepadsettings.js";
 import * as roles from "./roles.js";
 
+const numBranches = 3;
+
 export class Notepad {
     constructor() {
         this.page = util.newDiv(null, "models");
@@ -30,10 +33,14 @@ export class Notepad {
         this.items = new Map();
         this.labels = new Map();
         this.currentView = null;
+
+        // List changes from other tabs
+
+        socket.onPush("notepads", () => { this.refreshNotepadList(); });
     }
 
     onEnter(getResponse = false, post = null) {
-        fetch("/api/list_notepads")
+        socket.fetch("/api/list_notepads")
         .then(response => response.json())
         .then(response => {
             globals.receiveGlobals(response);
@@ -52,6 +59,8 @@ export class Notepad {
                 this.addNotepad(response.notepads[notepad_uuid], notepad_uuid);
 
         this.addNotepad("New notepad", "new");
+        if (!this.lastNotepadUUID && response.current_notepad && response.notepads.hasOwnProperty(response.current_notepad))
+            this.lastNotepadUUID = response.current_notepad;
         let m = this.lastNotepadUUID ? this.lastNotepadUUID : "new";
         this.setNotepad(m, getResponse);
     }
@@ -84,7 +93,28 @@ export class Notepad {
         this.labels.set(notepadID, label);
     }
 
-    setNotepad(notepadID, getResponse = false) {
+    refreshNotepadList() {
+        socket.fetch("/api/list_notepads")
+        .then(response => response.json())
+        .then(response => {
+            this.notepadList.innerHTML = "";
+            this.items = new Map();
+            this.labels = new Map();
+
+            for (let notepad_uuid in response.notepads)
+                if (response.notepads.hasOwnProperty(notepad_uuid))
+                    this.addNotepad(response.notepads[notepad_uuid], notepad_uuid);
+
+            this.addNotepad("New notepad", "new");
+
+            // Keep the current view unless its notepad was deleted
+
+            if (this.items.has(this.lastNotepadUUID)) this.markNotepad(this.lastNotepadUUID);
+            else this.setNotepad("new");
+        });
+    }
+
+    markNotepad(notepadID) {
         this.items.forEach((v, k) => {
             let div = this.items.get(k);
             if (k == notepadID) {
@@ -97,6 +127,10 @@ export class Notepad {
             let label = this.labels.get(k);
             label.setEditable(k == notepadID);
         });
+    }
+
+    setNotepad(notepadID, getResponse = false) {
+        this.markNotepad(notepadID);
 
         this.currentView = new NotepadView(notepadID, this);
         this.currentView.updateView(getResponse);
@@ -111,7 +145,7 @@ export class Notepad {
         let packet = {};
         packet.notepad_uuid = this.currentView.notepadID;
         util.assert(packet.notepad_uuid == this.lastNotepadUUID);
-        fetch("/api/delete_notepad", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
+        socket.fetch("/api/delete_notepad", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
         .then(response => response.json())
         .then(response => {
             this.lastNotepadUUID = util.getNextKey(this.items, notepadID);
@@ -151,10 +185,12 @@ class NotepadView {
 
         this.generateTokenButton = new controls.Button("⏵ Token", () => { this.generateToken() }, "notepad-generate-button", "ctrl + enter");
         this.generateButton = new controls.Button("⯮ Generate", () => { this.generate() }, "notepad-generate-button", "shift + enter");
+        this.branchButton = new controls.Button("⑂ Branch", () => { this.generate(numBranches) }, "notepad-generate-button");
         this.cancelButton = new controls.Button("⏹ Stop", () => { this.cancelGenerate() }, "notepad-generate-button", "escape");
         if (!notepadID || notepadID == "new" || !globals.g.loadedModelUUID) {
             this.generateTokenButton.setEnabled(false);
             this.generateButton.setEnabled(false);
+            this.branchButton.setEnabled(false);
             this.cancelButton.setEnabled(false);
         }
         this.cancelButton.setEnabled(false);
@@ -162,10 +198,15 @@ class NotepadView {
 
         this.controlBar.appendChild(this.generateTokenButton.element);
         this.controlBar.appendChild(this.generateButton.element);
+        this.controlBar.appendChild(this.branchButton.element);
         this.controlBar.appendChild(this.cancelButton.element);
 
+        this.branchView = util.newDiv(null, "notepad-branches hidden");
+        this.branchPanes = [];
+
         this.editorView.appendChild(this.editor);
         this.editorView.appendChild(this.controlBar);
+        this.editorView.appendChild(this.branchView);
         this.editorView.appendChild(this.divider);
         this.editorView.appendChild(this.tokenView);
         this.tokenView.appendChild(this.tokenViewInner);
@@ -191,7 +232,7 @@ class NotepadView {
 
     updateView(getResponse = false) {
         if (!this.notepadID || this.notepadID == "new") {
-            fetch("/api/get_default_settings")
+            socket.fetch("/api/get_default_settings")
             .then(response => response.json())
             .then(response => {
                 globals.receiveGlobals(response);
@@ -203,7 +244,7 @@ class NotepadView {
         } else {
             let packet = {};
             packet.notepad_uuid = this.notepadID;
-            fetch("/api/set_notepad", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
+            socket.fetch("/api/set_notepad", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
             .then(response => response.json())
             .then(response => {
                 globals.receiveGlobals(response);
@@ -239,13 +280,13 @@ class NotepadView {
         let packet = {};
         packet.new_name = new_name;
         if (!this.notepadID || this.notepadID == "new") {
-            fetch("/api/new_notepad", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
+            socket.fetch("/api/new_notepad", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
             .then(response => response.json())
             .then(response => {
                 if (post) post(response);
             });
         } else {
-            fetch("/api/rename_notepad", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
+            socket.fetch("/api/rename_notepad", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
             .then(response => response.json())
             .then(response => {
                 if (post) post(response);
@@ -317,11 +358,12 @@ class NotepadView {
     }
 
     input(event) {
+        this.clearBranches();
         if (!this.notepadID || this.notepadID == "new") {
             this.saveCursor();
             let packet = {};
             packet.text = this.getText();
-            fetch("/api/new_notepad", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
+            socket.fetch("/api/new_notepad", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
             .then(response => response.json())
             .then(response => {
                 this.parent.lastNotepadUUID = response.notepad.notepad_uuid;
@@ -350,7 +392,7 @@ class NotepadView {
 
         let packet = {};
         packet.text = this.getText();
-        fetch("/api/set_notepad_text", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
+        socket.fetch("/api/set_notepad_text", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
         .then(response => response.json())
         .then(response => {
             //console.log(response);
@@ -469,7 +511,7 @@ class NotepadView {
         packet.context = this.editor.value.slice(0, pos);
         packet.context_post = this.editor.value.slice(pos);
 
-        fetch("/api/notepad_single_token", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
+        socket.fetch("/api/notepad_single_token", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
         .then(response => response.json())
         .then(response => {
             if (response.text)
@@ -483,11 +525,12 @@ class NotepadView {
             }
             this.generateButton.setEnabled(true);
             this.generateTokenButton.setEnabled(true);
+            this.branchButton.setEnabled(true);
             this.editor.disabled = false;
         });
     }
 
-    generate() {
+    generate(branches = 1) {
         if (!globals.g.loadedModelUUID) return;
 
         let pos = this.editor.selectionStart;
@@ -498,6 +541,7 @@ class NotepadView {
 
         this.generateButton.setEnabled(false);
         this.generateButton.setVisible(false);
+        this.branchButton.setEnabled(false);
         this.cancelButton.setEnabled(true);
         this.cancelButton.setVisible(true);
         this.generateTokenButton.setEnabled(false);
@@ -513,6 +557,11 @@ class NotepadView {
         packet.position = pos;
         packet.context = this.editor.value.slice(0, pos);
         packet.context_post = this.editor.value.slice(pos);
+        packet.framing = "compact";
+        packet.branches = branches;
+
+        this.clearBranches();
+        if (branches > 1) this.createBranches(branches);
 
         let timeout = new Promise((resolve, reject) => {
             let id = setTimeout(() => {
@@ -521,7 +570,7 @@ class NotepadView {
             }, 180000)
         });
 
-        let fetchRequest = fetch("/api/notepad_generate", {
+        let fetchRequest = socket.fetch("/api/notepad_generate", {
             method: "POST",
             headers: { "Content-Type": "application/json", },
             body: JSON.stringify(packet)
@@ -547,6 +596,7 @@ class NotepadView {
                     self.generateButton.setEnabled(true);
                     self.generateButton.setVisible(true);
                     self.generateTokenButton.setEnabled(true);
+                    self.branchButton.setEnabled(true);
                     self.cancelButton.setEnabled(false);
                     self.cancelButton.setVisible(false);
                     self.editor.disabled = false;
@@ -565,9 +615,11 @@ class NotepadView {
                     }
                     if (json.result == "fail") {
                         console.error('Error:', json.error);
+                        self.jobID = null;
                         self.generateButton.setEnabled(true);
                         self.generateButton.setVisible(true);
                         self.generateTokenButton.setEnabled(true);
+                        self.branchButton.setEnabled(true);
                         self.cancelButton.setEnabled(false);
                         self.cancelButton.setVisible(false);
                         self.editor.disabled = false;
@@ -591,32 +643,100 @@ class NotepadView {
     receivedStreamResponse(response) {
         //console.log(response);
 
+        if (response.result == "job") {
+            this.jobID = response.job_id;
+        }
+
+        // Compact framing, [1, text] is text to insert at the stream position
+
+        if (Array.isArray(response)) {
+            if (response[0] == 1) this.insertStreamText(response[1]);
+            if (response[0] == 3) this.appendBranchText(response[1], response[2]);
+            return;
+        }
+
+        if (response.result == "stream_branch") {
+            this.appendBranchText(response.branch, response.text);
+        }
+
+        if (response.branches) {
+            for (const pane of this.branchPanes) pane.button.setEnabled(true);
+        }
+
         if (response.result == "stream_chunk") {
-            let chunk = response.text;
-            let pos = this.receiveStreamPos;
-            this.editor.value = this.editor.value.slice(0, pos) + chunk + this.editor.value.slice(pos);
-            pos += chunk.length;
-            this.editor.setSelectionRange(pos, pos);
-            this.receiveStreamPos = pos;
+            this.insertStreamText(response.text);
         }
 
         if (response.result == "ok") {
+            this.jobID = null;
             if (response.tokenized_text) {
                 this.updateTokens(response.tokenized_text);
             }
         }
 
         if (response.result == "cancel") {
+            this.jobID = null;
             if (response.tokenized_text) {
                 this.updateTokens(response.tokenized_text);
             }
         }
     }
 
+    createBranches(num) {
+        for (let i = 0; i < num; i++) {
+            let pane = {};
+            pane.element = util.newDiv(null, "notepad-branch");
+            pane.text = util.newDiv(null, "notepad-branch-text");
+            pane.button = new controls.Button("✓ Accept", () => { this.acceptBranch(i) }, "notepad-generate-button");
+            pane.button.setEnabled(false);
+            pane.element.appendChild(pane.text);
+            pane.element.appendChild(pane.button.element);
+            this.branchView.appendChild(pane.element);
+            this.branchPanes.push(pane);
+        }
+        this.branchView.classList.remove("hidden");
+    }
+
+    clearBranches() {
+        if (this.branchPanes.length == 0) return;
+        this.branchView.innerHTML = "";
+        this.branchView.classList.add("hidden");
+        this.branchPanes = [];
+    }
+
+    appendBranchText(branch, text) {
+        this.branchPanes[branch].text.innerText += text;
+    }
+
+    acceptBranch(branch) {
+        let packet = {};
+        packet.branch = branch;
+        socket.fetch("/api/notepad_accept_branch", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
+        .then(response => response.json())
+        .then(response => {
+            if (response.result != "ok") return;
+            this.clearBranches();
+            this.editor.value = response.text;
+            this.editor.setSelectionRange(response.position, response.position);
+            this.editor.focus();
+            if (response.tokenized_text) this.updateTokens(response.tokenized_text);
+        });
+    }
+
+    insertStreamText(chunk) {
+        let pos = this.receiveStreamPos;
+        this.editor.value = this.editor.value.slice(0, pos) + chunk + this.editor.value.slice(pos);
+        pos += chunk.length;
+        this.editor.setSelectionRange(pos, pos);
+        this.receiveStreamPos = pos;
+    }
+
     cancelGenerate() {
         this.cancelButton.setEnabled(false);
         //console.log("cancel");
-        fetch("/api/cancel_notepad_generate")
+        let url = "/api/cancel_notepad_generate";
+        if (this.jobID) url += "?job_id=" + this.jobID;
+        socket.fetch(url)
         .then(response => response.json())
         .then(response => {
         });
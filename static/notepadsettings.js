@@ -2,6 +2,7 @@
 import * as util from "./util.js";
 import * as mainmenu from "./mainmenu.js";
 import * as globals from "./globals.js";
+import * as socket from "./socket.js";
 import * as controls from "./controls.js";
 import * as overlay from "./overlay.js";
 
@@ -24,14 +25,19 @@ export class NotepadSettings {
 
         // Generation params
 
+        this.sss_i_model = new controls.LabelCombobox("sss-item-left", "Model", "sss-item-right sss-item-combobox", globals.modelOptions(), this.settings, "model_uuid", () => { this.updateView(true); } );
+        this.sss_genParams.inner.appendChild(this.sss_i_model.element);
+
         this.sss_i_maxTokens   = new controls.SettingsSlider("sss-item-left", "Max tokens",    "sss-item-mid", "sss-item-right sss-item-textbox-r", 0, 16, 2048, null,                             this.settings, "maxtokens",    () => { this.updateView(true); });
         this.sss_i_chunkTokens = new controls.SettingsSlider("sss-item-left", "Chunk tokens",  "sss-item-mid", "sss-item-right sss-item-textbox-r", 0, 16, 2048, null,                             this.settings, "chunktokens",  () => { this.updateView(true); });
         this.sss_bannedStrings = new controls.CollapsibleSection(null, "Banned strings");
         this.sss_stopConditions = new controls.CollapsibleSection(null, "Stop conditions");
         this.sss_genParams.inner.appendChild(this.sss_i_maxTokens.element);
         this.sss_genParams.inner.appendChild(this.sss_i_chunkTokens.element);
+        this.sss_grammar = new controls.CollapsibleSection(null, "Grammar");
         this.element.appendChild(this.sss_bannedStrings.element);
         this.element.appendChild(this.sss_stopConditions.element);
+        this.element.appendChild(this.sss_grammar.element);
 
         // Sampling
 
@@ -82,6 +88,13 @@ export class NotepadSettings {
         this.sss_i_bannedStrings = new controls.LargeTextbox("sss-item-big-textbox", "Banned strings...", this.settings, "banned_strings", null, () => { this.updateView(true); }, true);
         this.sss_bannedStrings.inner.appendChild(this.sss_i_bannedStrings.element);
 
+        // Grammar
+
+        this.sss_i_grammarMode = new controls.LabelCombobox("sss-item-left", "Constrain to", "sss-item-right sss-item-combobox", [ "None", "Regex", "JSON schema" ], this.settings, "grammar_mode", () => { this.updateView(true); } );
+        this.sss_i_grammar = new controls.LargeTextbox("sss-item-big-textbox", "Regex or JSON schema...", this.settings, "grammar", null, () => { this.updateView(true); }, true);
+        this.sss_grammar.inner.appendChild(this.sss_i_grammarMode.element);
+        this.sss_grammar.inner.appendChild(this.sss_i_grammar.element);
+
         this.populate_stop_conditions();
 
         this.updateView();
@@ -147,7 +160,7 @@ export class NotepadSettings {
         let packet = {};
         packet.settings = this.settings;
         if (!this.parent.notepadID || this.parent.notepadID == "new") {
-            fetch("/api/new_notepad", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
+            socket.fetch("/api/new_notepad", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
             .then(response => response.json())
             .then(response => {
                 this.parent.parent.lastNotepadUUID = response.notepad.notepad_uuid;
@@ -155,7 +168,7 @@ export class NotepadSettings {
                 if (post) post(response);
             });
         } else {
-            fetch("/api/update_notepad_settings", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
+            socket.fetch("/api/update_notepad_settings", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
             .then(response => response.json())
             .then(response => {
                 if (post) post(response);
@@ -64,18 +64,8 @@ class LoadingOverlay extends Overlay {
         this.box.appendChild(this.bar);
 
         this.cancelButton = new controls.Button("✖ Cancel", () => {
-            // First call the cancel handler to abort the fetch request
+            // The cancel handler cancels the load job, which frees any partially loaded model on the server
             if (this.onCancel) this.onCancel();
-            
-            // Then unload the model to release GPU memory
-            fetch("/api/unload_model")
-            .then(response => response.json())
-            .then(json => {
-                if (json.result == "ok") {
-                    globals.g.loadedModelUUID = null;
-                    globals.g.failedModelUUID = null;
-                }
-            });
         });
         this.cancelButton.setEnabled(true);
         this.element.appendChild(this.cancelButton.element);
@@ -1,6 +1,7 @@
 import * as util from "./util.js";
 import * as controls from "./controls.js";
 import * as globals from "./globals.js";
+import * as socket from "./socket.js";
 import * as theme from "./theme.js";
 
 export class SettingsPopup {
@@ -22,7 +23,7 @@ export class SettingsPopup {
     }
 
     loadSettings() {
-        fetch("/api/get_settings")
+        socket.fetch("/api/get_settings")
         .then(response => response.json())
         .then(response => {
             this.settings = response.settings;
@@ -55,7 +56,7 @@ export class SettingsPopup {
 
         let packet = {}
         packet.settings = this.settings;
-        fetch("/api/set_settings", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
+        socket.fetch("/api/set_settings", { method: "POST", headers: { "Content-Type": "application/json", }, body: JSON.stringify(packet) })
         .then(response => response.json())
         .then(response => {
         });
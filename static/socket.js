@@ -0,0 +1,125 @@
+
+// Single WebSocket per tab carrying API calls, streams and server pushes (server.py --asgi). socket.fetch() has the
+// same interface as fetch() for the API calls made by the UI and falls back to plain fetch() when the server has no
+// WebSocket endpoint
+
+let ws = null;
+let wsReady = null;
+let nextID = 1;
+const calls = new Map();
+const pushHandlers = {};
+const encoder = new TextEncoder();
+
+function connect() {
+    if (wsReady) return wsReady;
+
+    wsReady = new Promise((resolve) => {
+        let opened = false;
+        let scheme = window.location.protocol == "https:" ? "wss://" : "ws://";
+        try {
+            ws = new WebSocket(scheme + window.location.host + "/ws");
+        } catch (e) {
+            resolve(false);
+            return;
+        }
+
+        ws.onopen = () => {
+            opened = true;
+            resolve(true);
+        };
+
+        ws.onmessage = (event) => {
+            receive(JSON.parse(event.data));
+        };
+
+        ws.onclose = () => {
+            ws = null;
+            for (const call of calls.values()) call.fail(new Error("Connection closed"));
+            calls.clear();
+            // Keep using fetch() if the socket never opened, otherwise reconnect on the next call
+            if (opened) wsReady = null;
+            resolve(false);
+        };
+    });
+
+    return wsReady;
+}
+
+function receive(message) {
+    if (message.push) {
+        let handlers = pushHandlers[message.push] || [];
+        for (const handler of handlers) handler(message.data);
+        return;
+    }
+
+    let call = calls.get(message.id);
+    if (!call) return;
+
+    if (message.status !== undefined) {
+        call.start(message.status);
+    } else if (message.chunk !== undefined) {
+        call.controller.enqueue(encoder.encode(message.chunk));
+    } else if (message.end) {
+        calls.delete(message.id);
+        call.controller.close();
+    }
+}
+
+function wsFetch(url, options) {
+    return new Promise((resolve, reject) => {
+        let id = nextID++;
+        let call = { started: false };
+
+        let stream = new ReadableStream({
+            start(controller) { call.controller = controller; }
+        });
+
+        call.start = (status) => {
+            call.started = true;
+            let noBody = [101, 204, 205, 304].includes(status);
+            resolve(new Response(noBody ? null : stream, { status: status }));
+        };
+
+        call.fail = (error) => {
+            if (call.started) call.controller.error(error);
+            else reject(error);
+        };
+
+        calls.set(id, call);
+
+        if (options.signal) {
+            options.signal.addEventListener("abort", () => {
+                if (!calls.has(id)) return;
+                calls.delete(id);
+                if (ws) ws.send(JSON.stringify({ id: id, cancel: true }));
+                call.fail(new DOMException("Aborted", "AbortError"));
+            });
+        }
+
+        let message = {};
+        message.id = id;
+        message.method = options.method || "GET";
+        message.path = url;
+        message.body = options.body || null;
+
+        // The socket can close between connect() resolving and this call, send over HTTP instead
+        try {
+            if (!ws || ws.readyState != WebSocket.OPEN) throw new Error("Connection closed");
+            ws.send(JSON.stringify(message));
+        } catch (e) {
+            calls.delete(id);
+            window.fetch(url, options).then(resolve, reject);
+        }
+    });
+}
+
+export async function fetch(url, options = {}) {
+    if (await connect() && ws && ws.readyState == WebSocket.OPEN) return wsFetch(url, options);
+    return window.fetch(url, options);
+}
+
+export function onPush(topic, handler) {
+    if (!pushHandlers[topic]) pushHandlers[topic] = [];
+    pushHandlers[topic].push(handler);
+    connect();
+}
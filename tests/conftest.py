@@ -0,0 +1,5 @@
+import os, sys
+
+# Tests import the backend package from the repository root, without torch or exllamav2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
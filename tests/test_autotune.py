@@ -0,0 +1,34 @@
+from backend.autotune import rank_trials
+
+
+def trial(cache_mode, chunk_size, speed):
+    return { "cache_mode": cache_mode, "chunk_size": chunk_size, "prompt_speed": speed * 10, "decode_speed": speed }
+
+
+trials = \
+[
+    trial("FP16", 512, 40.0),
+    trial("FP16", 2048, 45.0),
+    trial("Q8", 2048, 46.0),
+    trial("Q4", 2048, 50.0),
+]
+
+
+def test_best_is_never_lossier_than_current():
+    best, by_mode = rank_trials(trials, "FP16")
+    assert (best["cache_mode"], best["chunk_size"]) == ("FP16", 2048)
+    assert set(by_mode) == { "FP16", "Q8", "Q4" }
+    assert by_mode["Q4"]["score"] < best["score"]
+
+
+def test_lossier_current_mode_allows_faster_precise_modes():
+    best, by_mode = rank_trials(trials, "Q8")
+    assert best["cache_mode"] == "Q8"
+    best, by_mode = rank_trials(trials, "Q4")
+    assert best["cache_mode"] == "Q4"
+
+
+def test_no_allowed_trial():
+    best, by_mode = rank_trials([trial("Q4", 512, 50.0)], "FP16")
+    assert best is None
+    assert list(by_mode) == ["Q4"]
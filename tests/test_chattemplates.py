@@ -0,0 +1,34 @@
+import pytest
+
+import backend.chattemplates as chattemplates
+
+pytest.importorskip("jinja2")
+
+chatml = \
+    "{% for message in messages %}<|im_start|>{{ message['role'] }}\n{{ message['content'] }}<|im_end|>\n{% endfor %}" \
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+
+
+def chat_template(source):
+    return { "template": source, "bos_token": "<s>", "eos_token": "</s>" }
+
+
+def test_turn_end_renders_once_per_template(monkeypatch):
+    renders = []
+    render = chattemplates.render
+    monkeypatch.setattr(chattemplates, "render", lambda *args: renders.append(args) or render(*args))
+
+    source = chatml + "{# turn_end test #}"
+    for _ in range(3):
+        assert chattemplates.turn_end(chat_template(source)) == "<|im_end|>"
+    assert len(renders) == 1
+
+    # Same template, same entry as the compiled template
+    entry = chattemplates.compiled_entry(source)
+    assert entry["template"] is chattemplates.compile_template(source)
+    assert entry["turn_ends"] == { ("<s>", "</s>"): "<|im_end|>" }
+
+
+def test_turn_end_of_broken_template_is_none():
+    assert chattemplates.turn_end(chat_template("{% for %}")) is None
+    assert chattemplates.turn_end(chat_template("{{ raise_exception('no') }}")) is None
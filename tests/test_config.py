@@ -0,0 +1,48 @@
+import threading
+
+from backend.config import locked_file, merge_json, read_json, write_json
+
+
+def test_merge_keeps_changes_from_both_sides():
+    base = { "a": { "name": "A", "seq_len": 4096 }, "b": { "name": "B" } }
+    ours = { "a": { "name": "A", "seq_len": 8192 }, "b": { "name": "B" }, "c": { "name": "C" } }
+    theirs = { "a": { "name": "A2", "seq_len": 4096 }, "d": { "name": "D" } }
+    merged = merge_json(base, ours, theirs, depth = 1)
+    assert merged == { "a": { "name": "A2", "seq_len": 8192 }, "c": { "name": "C" }, "d": { "name": "D" } }
+
+
+def test_merge_conflict_prefers_ours():
+    base = { "a": { "x": 1 } }
+    assert merge_json(base, { "a": { "x": 2 } }, { "a": { "x": 3 } }, depth = 1) == { "a": { "x": 2 } }
+    assert merge_json(base, { "a": { "x": 2 } }, { "a": { "x": 3, "y": 1 } }, depth = 0) == { "a": { "x": 2 } }
+
+
+def test_merge_deletions():
+    base = { "a": 1, "b": 2 }
+    assert merge_json(base, { "b": 2 }, { "a": 1, "b": 3 }) == { "b": 3 }
+    assert merge_json(base, { "a": 1, "b": 2 }, { "a": 1 }) == { "a": 1 }
+
+
+def test_concurrent_writers_merge(tmp_path):
+    filename = str(tmp_path / "models.json")
+    write_json(filename, {})
+
+    def writer(i):
+        for n in range(20):
+            with locked_file(filename):
+                data = read_json(filename, {})
+                data[f"{i}.{n}"] = n
+                write_json(filename, data)
+
+    threads = [threading.Thread(target = writer, args = (i,)) for i in range(4)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert len(read_json(filename)) == 80
+
+
+def test_locked_file_is_reentrant(tmp_path):
+    filename = str(tmp_path / "state.json")
+    with locked_file(filename):
+        with locked_file(filename):
+            write_json(filename, { "x": 1 })
+    assert read_json(filename) == { "x": 1 }
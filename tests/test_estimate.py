@@ -0,0 +1,155 @@
+import json, struct
+
+import pytest
+
+from backend.estimate import (
+    auto_fit, auto_fit_cache_modes, cache_bytes, device_reserve_bytes, estimate_vram, fits, max_fitting_seq_len,
+    seq_len_granularity, weights_breakdown,
+)
+
+# A small Llama-shaped model. Tensor sizes come from a fake safetensors file holding only a header
+
+num_layers = 4
+embed_size = 1000 * 256 * 2
+head_size = 1000 * 256 * 2
+layer_size = 3 * 1024**2
+
+
+def write_safetensors(path, sizes):
+    header = {}
+    offset = 0
+    for name, size in sizes.items():
+        header[name] = { "dtype": "F16", "shape": [size // 2], "data_offsets": [offset, offset + size] }
+        offset += size
+    data = json.dumps(header).encode("utf-8")
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(data)))
+        f.write(data)
+
+
+@pytest.fixture
+def model(tmp_path):
+    sizes = { "model.embed_tokens.weight": embed_size, "lm_head.weight": head_size }
+    for i in range(num_layers):
+        sizes[f"model.layers.{i}.self_attn.q_proj.weight"] = layer_size // 2
+        sizes[f"model.layers.{i}.mlp.up_proj.weight"] = layer_size // 2
+    write_safetensors(tmp_path / "model.safetensors", sizes)
+
+    stats = \
+    {
+        "hidden_size": 256,
+        "intermediate_size": 512,
+        "num_attention_heads": 4,
+        "num_key_value_heads": 2,
+        "num_hidden_layers": num_layers,
+        "vocab_size": 1000,
+        "head_dim": 64,
+        "default_seq_len": 8192,
+    }
+    stats.update(weights_breakdown(str(tmp_path)))
+    return { "stats": stats, "cache_mode": "FP16", "chunk_size": 512 }
+
+
+def exact_budget(model, seq_len, cache_mode):
+    # Everything on one device, as the autosplit loader would place it
+    return device_reserve_bytes + estimate_vram(model, seq_len = seq_len, cache_mode = cache_mode)["total"]
+
+
+def test_weights_breakdown(model):
+    stats = model["stats"]
+    assert stats["embed_bytes"] == embed_size
+    assert stats["head_bytes"] == head_size
+    assert stats["layers_bytes"] == num_layers * layer_size
+
+
+def test_estimate_components(model):
+    e = estimate_vram(model, seq_len = 1024, cache_mode = "Q4")
+    assert e["weights"] == num_layers * layer_size + head_size
+    assert e["cache"] == cache_bytes(model["stats"], 1024, "Q4")
+    assert e["draft"] == 0
+    assert e["total"] == e["weights"] + e["cache"] + e["scratch"]
+
+    draft = dict(model, speculative_mode = "Draft model", draft_stats = model["stats"])
+    d = estimate_vram(draft, seq_len = 1024, cache_mode = "Q4")
+    assert d["draft"] > 0
+    assert d["total"] == e["total"] + d["draft"]
+
+
+def test_cache_modes_shrink_in_fallback_order(model):
+    sizes = [cache_bytes(model["stats"], 4096, m) for m in auto_fit_cache_modes]
+    assert sizes == sorted(sizes, reverse = True)
+
+
+def test_fits_single_device_boundary(model):
+    budget = exact_budget(model, 4096, "FP16")
+    assert fits(model, [budget + 1], 4096, "FP16")
+    assert not fits(model, [budget - 1024], 4096, "FP16")
+    assert not fits(model, [], 4096, "FP16")
+
+
+def test_fits_spills_layers_to_next_device(model):
+    budget = exact_budget(model, 4096, "FP16")
+    half = budget // 2
+    assert not fits(model, [half], 4096, "FP16")
+    assert fits(model, [half, half + 8 * 1024**2], 4096, "FP16")
+
+
+def test_fits_tail_needs_room_after_last_layer(model):
+    # Room for every layer on the first device but not the head and scratch, which have to go to a later device
+    e = estimate_vram(model, seq_len = 4096, cache_mode = "FP16")
+    layers = device_reserve_bytes + e["weights"] - head_size + e["cache"] + 1
+    tail = head_size + e["scratch"]
+    assert not fits(model, [layers], 4096, "FP16")
+    assert fits(model, [layers, tail + 1], 4096, "FP16")
+    assert not fits(model, [layers, tail - 1], 4096, "FP16")
+
+
+def test_tensor_parallel_pools_devices(model):
+    budget = exact_budget(model, 4096, "FP16")
+    assert fits(model, [budget // 2 + 1, budget // 2 + 1], 4096, "FP16", tensor_p = True)
+
+
+def test_max_fitting_seq_len_matches_linear_scan(model):
+    g = seq_len_granularity
+    native = model["stats"]["default_seq_len"]
+    for budget in [exact_budget(model, s, "Q6") + 1 for s in (0, 300, 1000, 2560, 5000)] + [0, 10**12]:
+        expected = 0
+        for n in range(1, native // g + 1):
+            if fits(model, [budget], n * g, "Q6"): expected = n * g
+        result = max_fitting_seq_len(model, [budget], "Q6")
+        assert result == expected
+        assert result % g == 0
+
+
+def test_max_fitting_seq_len_rounds_down(model):
+    budget = exact_budget(model, 3000, "FP16")
+    assert max_fitting_seq_len(model, [budget], "FP16") == 2816
+
+
+def test_auto_fit_prefers_fp16(model):
+    best = auto_fit(model, [10**12])
+    assert best["cache_mode"] == "FP16"
+    assert best["seq_len"] == model["stats"]["default_seq_len"]
+    assert best["estimate"]["total"] == estimate_vram(model, seq_len = best["seq_len"], cache_mode = "FP16")["total"]
+
+
+@pytest.mark.parametrize("mode", ["Q8", "Q6", "Q4"])
+def test_auto_fit_falls_back_to_first_mode_reaching_native(model, mode):
+    native = model["stats"]["default_seq_len"]
+    best = auto_fit(model, [exact_budget(model, native, mode) + 1])
+    assert best["cache_mode"] == mode
+    assert best["seq_len"] == native
+
+
+def test_auto_fit_longest_context_when_nothing_reaches_native(model):
+    # Q4 gives the longest context below native length, the other modes fit shorter ones
+    budget = exact_budget(model, 4096, "Q4") + 1
+    best = auto_fit(model, [budget])
+    assert best["cache_mode"] == "Q4"
+    assert best["seq_len"] == 4096
+    assert max_fitting_seq_len(model, [budget], "FP16") < 4096
+
+
+def test_auto_fit_nothing_fits(model):
+    assert auto_fit(model, [1024]) is None
+    assert auto_fit({ "cache_mode": "FP16" }, [10**12]) is None
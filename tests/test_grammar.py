@@ -0,0 +1,123 @@
+import json, random, string, time
+
+import pytest
+
+from backend.grammar import Grammar, RegexParser, dead, json_schema, parse_grammar
+
+
+class TrieNode:
+
+    def __init__(self):
+        self.children = {}
+        self.leaf = []
+
+
+def char_trie(pieces):
+    # Same shape as ExLlamaV2Tokenizer.get_char_trie()
+    root = TrieNode()
+    for token, piece in enumerate(pieces):
+        node = root
+        for c in piece:
+            node = node.children.setdefault(c, TrieNode())
+        node.leaf.append(token)
+    return root
+
+
+def vocabulary(size, seed = 0):
+    rng = random.Random(seed)
+    alphabet = string.ascii_letters + string.digits + " \"{}[],:.-_\n"
+    pieces = set(alphabet)
+    while len(pieces) < size:
+        pieces.add("".join(rng.choice(alphabet) for _ in range(rng.randint(2, 8))))
+    return sorted(pieces)
+
+
+def full_match(pattern, text):
+    g = Grammar(RegexParser(pattern).parse())
+    return g.accepting(g.advance(g.start, text))
+
+
+def test_regex_escapes():
+    assert full_match(r"\d+\.\d\d", "12.50")
+    assert full_match(r"a\tb\n", "a\tb\n")
+    assert full_match(r"\x41é", "Aé")
+    assert full_match(r"[\w\-]+", "a_b-c")
+    assert full_match(r"\W\S", "!x")
+    assert not full_match(r"\S", " ")
+    assert not full_match(r"\d", "a")
+
+
+@pytest.mark.parametrize("pattern", [r"\b", r"a\bc", r"\B", r"(a)\1", r"\A", r"\Z", r"\z", r"\k", r"\p", r"[\b]", r"[\q]"])
+def test_regex_rejects_unsupported_escapes(pattern):
+    with pytest.raises(ValueError, match = "is not supported"):
+        RegexParser(pattern).parse()
+
+
+def test_json_schema_output():
+    schema = { "type": "object", "properties": { "name": { "type": "string" }, "age": { "type": "integer" } } }
+    g = Grammar(json_schema(schema))
+    assert g.accepting(g.advance(g.start, json.dumps({ "name": "x", "age": 3 })))
+    assert g.advance(g.start, '{"age"') == dead
+
+
+def test_mask_allows_only_tokens_in_language():
+    pieces = ["1", "12", "a", "1a", ".", "3.5"]
+    g = Grammar(RegexParser(r"\d+(\.\d+)?").parse())
+    (pass_tokens, end_tokens), _ = g.mask(g.start, char_trie(pieces))
+    assert {pieces[t] for t in pass_tokens} == {"1", "12", "3.5"}
+    assert end_tokens == frozenset()
+
+
+def benchmark(grammar_mode, source, text, vocab_size = 32000):
+    """
+    Build masks and filter text token by token like GrammarFilter, returning the time spent building masks and the
+    filter time per token once they are built
+    """
+
+    pieces = vocabulary(vocab_size)
+    trie = char_trie(pieces)
+    ids = { p: i for i, p in enumerate(pieces) }
+    tokens = [ids[c] for c in text]
+
+    def run(g):
+        state = g.start
+        mask_time = 0.0
+        for token in tokens:
+            (pass_tokens, _), elapsed = g.mask(state, trie)
+            mask_time += elapsed
+            assert token in pass_tokens
+            state = g.advance(state, pieces[token])
+        assert g.accepting(state)
+        return mask_time
+
+    g = Grammar(parse_grammar(grammar_mode, source))
+    mask_time = run(g)
+    t = time.time()
+    run(g)
+    per_token = (time.time() - t) / len(tokens)
+    return { "compile_time": g.compile_time, "masks": len(g.masks), "mask_time": mask_time, "filter_time_per_token": per_token }
+
+
+def test_benchmark_mask_and_filter_time():
+    schema = { "type": "object", "properties": { "name": { "type": "string" }, "tags": { "type": "array", "items": { "type": "string" } } } }
+    text = json.dumps({ "name": "ab c", "tags": ["x", "y1"] })
+    r = benchmark("JSON schema", json.dumps(schema), text, vocab_size = 4000)
+    print(f"\n -- {r['masks']} masks built in {r['mask_time'] * 1000:.1f} ms, {r['filter_time_per_token'] * 1e6:.1f} us per token after")
+    assert r["masks"] > 0
+    assert r["mask_time"] > 0
+    # Once built, masks are dictionary lookups
+    assert r["filter_time_per_token"] < r["mask_time"] / r["masks"]
+
+
+if __name__ == "__main__":
+    # python -m tests.test_grammar, timings at a realistic vocabulary size
+    schema = { "type": "object", "properties": { "name": { "type": "string" }, "tags": { "type": "array", "items": { "type": "string" } } } }
+    cases = \
+    [
+        ("Regex", r"\d{3}-\d{4}", "555-1234"),
+        ("JSON schema", json.dumps(schema), json.dumps({ "name": "ab c", "tags": ["x", "y1"] })),
+    ]
+    for mode, source, text in cases:
+        r = benchmark(mode, source, text)
+        print(f" -- {mode}: compile {r['compile_time'] * 1000:.2f} ms, {r['masks']} masks in {r['mask_time'] * 1000:.1f} ms "
+              f"({r['mask_time'] / r['masks'] * 1000:.2f} ms each), filter {r['filter_time_per_token'] * 1e6:.1f} us per token")
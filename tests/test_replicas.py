@@ -0,0 +1,125 @@
+import pytest
+
+from backend.replicas import ReplicaRouter, group_split, parse_device_groups
+
+
+class StubBackend:
+
+    def __init__(self, name):
+        self.name = name
+
+
+def make_router(n = 2):
+    return ReplicaRouter([StubBackend(f"r{i}") for i in range(n)])
+
+
+def test_parse_device_groups():
+    assert parse_device_groups("0;1") == [[0], [1]]
+    assert parse_device_groups(" 0, 1 ; 2,3 ") == [[0, 1], [2, 3]]
+    assert parse_device_groups("") == []
+    assert parse_device_groups("  ") == []
+    assert parse_device_groups(None) == []
+
+
+@pytest.mark.parametrize("spec", ["0,;1", "0;;1", "0;", ";1", "0,,1", "a;1", "-1", "0;0", "0,1;1"])
+def test_parse_device_groups_rejects_malformed(spec):
+    with pytest.raises(ValueError):
+        parse_device_groups(spec)
+
+
+def test_group_split_sets_aside_scratch_and_cache():
+    gb = 1024**3
+    split = group_split([1, 2], [8 * gb, 10 * gb, 10 * gb], weights = 3 * gb, cache = 1 * gb, scratch = 2 * gb)
+    assert split == [0.0, 6.0, 6.0]
+    assert group_split([0], [gb], scratch = 2 * gb) == [0.0]
+    with pytest.raises(ValueError):
+        group_split([3], [gb, gb])
+
+
+def test_assignment_is_sticky():
+    router = make_router()
+    a = router.assign("a")
+    b = router.assign("b")
+    assert a is not b
+    for _ in range(3):
+        assert router.assign("a") is a
+        assert router.assign("b") is b
+
+
+def test_least_active_generations_first():
+    router = make_router()
+    with router.acquire("a") as a:
+        # "a" is generating on its replica, which also has fewer sessions than the other one
+        router.replicas[1 - a.index].sessions.update(["x", "y"])
+        assert router.assign("c") is not a
+
+
+def test_ties_broken_by_sessions_then_index():
+    router = make_router(3)
+    assert router.assign("a").index == 0
+    assert router.assign("b").index == 1
+    assert router.assign("c").index == 2
+    router.release("b")
+    assert router.assign("d").index == 1
+    assert router.assign(None).index == 0
+
+
+def test_release_forgets_assignment():
+    router = make_router()
+    a = router.assign("a")
+    router.release("a")
+    assert "a" not in a.sessions
+    router.release("a")
+    router.replicas[a.index].sessions.add("z")
+    assert router.assign("a") is not a
+
+
+def test_acquire_releases_on_error():
+    router = make_router()
+    with pytest.raises(RuntimeError):
+        with router.acquire("a") as replica:
+            assert replica.active == 1
+            assert replica.lock.locked()
+            raise RuntimeError("generation failed")
+    assert replica.active == 0
+    assert not replica.lock.locked()
+    assert router.assign("a") is replica
+
+
+def test_submitted_tasks_run_in_order_on_one_worker():
+    import threading
+
+    router = make_router(1)
+    done = threading.Event()
+    ran = []
+
+    def task(n):
+        def run(replica):
+            ran.append((n, threading.current_thread().name, replica.active, replica.lock.locked()))
+            if n == 4: done.set()
+        return run
+
+    for n in range(5): router.submit(task(n), "a")
+    assert done.wait(5)
+    assert [r[0] for r in ran] == list(range(5))
+    assert len(set(r[1] for r in ran)) == 1
+    assert all(r[3] for r in ran)
+    assert ran[0][2] >= 1
+
+
+def test_closed_router_tasks_get_no_replica():
+    import threading
+
+    router = make_router(1)
+    gate = threading.Event()
+    got = []
+    finished = threading.Event()
+    router.submit(lambda r: gate.wait(5), "a")
+    router.submit(lambda r: got.append(r), "a")
+    router.close()
+    gate.set()
+    router.submit(lambda r: (got.append(r), finished.set()), "a")
+    assert finished.wait(5)
+    router.replicas[0].worker.join(5)
+    assert got == [None, None]
+    assert router.replicas[0].active == 0
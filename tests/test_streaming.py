@@ -0,0 +1,83 @@
+import json, threading
+
+from backend.replicas import ReplicaRouter
+from backend.streaming import DecoupledStream
+
+
+def job_packet(job_id):
+    return json.dumps({ "result": "job", "job_id": job_id }) + "\n"
+
+
+def test_queued_stream_needs_no_thread():
+    before = threading.active_count()
+    streams = [DecoupledStream() for _ in range(200)]
+    assert threading.active_count() == before
+    for i, stream in enumerate(streams):
+        stream.put(job_packet(str(i)))
+    assert streams[7].job_id == "7"
+
+
+def test_put_and_finish():
+    stream = DecoupledStream()
+    stream.put(job_packet("a"))
+    stream.put('{"result": "ok"}\n')
+    stream.finish()
+    assert "".join(stream) == job_packet("a") + '{"result": "ok"}\n'
+    assert stream.finished
+
+
+def test_close_cancels_unfinished_job():
+    canceled = []
+    closed = []
+    stream = DecoupledStream(cancel = canceled.append)
+    stream.on_close = lambda: closed.append(True)
+    stream.put(job_packet("a"))
+    stream.close()
+    stream.close()
+    assert canceled == ["a"]
+    assert closed == [True]
+
+
+def test_close_after_finish_doesnt_cancel():
+    canceled = []
+    stream = DecoupledStream(cancel = canceled.append)
+    stream.put(job_packet("a"))
+    stream.finish()
+    stream.close()
+    assert canceled == []
+
+
+def test_produce_reports_failure():
+    def gen():
+        yield job_packet("a")
+        raise RuntimeError("boom")
+
+    stream = DecoupledStream()
+    stream.produce(gen())
+    text, finished = stream.take()
+    assert json.loads(text.splitlines()[-1])["result"] == "fail"
+    assert stream.take() == ("", True)
+
+
+def test_generations_queue_on_replica_worker():
+    router = ReplicaRouter([object()])
+    gate = threading.Event()
+    threads = threading.active_count()
+
+    def run(n):
+        def gen(replica):
+            gate.wait(5)
+            yield json.dumps({ "n": n }) + "\n"
+        return gen
+
+    streams = []
+    for n in range(50):
+        stream = DecoupledStream()
+        router.submit(lambda replica, s = stream, g = run(n): s.produce(g(replica)), "a")
+        streams.append(stream)
+
+    # Fifty waiting generations, one worker thread
+    assert threading.active_count() == threads + 1
+    assert router.replicas[0].active == 50
+    gate.set()
+    assert [json.loads("".join(s))["n"] for s in streams] == list(range(50))